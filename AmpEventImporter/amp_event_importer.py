@@ -7,6 +7,7 @@ This script is used to import Cisco AMP for Endpoints events into Cisco Command
 
 import json
 import os
+import resource
 import time
 
 import pymongo
@@ -16,11 +17,19 @@ from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from requests.auth import HTTPBasicAuth
 
+import event_store
+
 load_dotenv()
 
+# The name of this importer's record in the 'importer_state' collection
+IMPORTER_NAME = "amp_event_importer"
+
+# The product name stored on this importer's events
+PRODUCT_NAME = "AMP for Endpoints"
 
-def get_events(start_date=None):
-    """Get AMP events from the specified start date."""
+
+def get_event_pages(start_date=None):
+    """Yield pages of AMP events from the specified start date, following the 'next' links."""
 
     # Format the date for AMP
     start_date = start_date.isoformat()
@@ -29,17 +38,49 @@ def get_events(start_date=None):
     api_url = f"https://{os.getenv('AMP_API_FQDN')}/v1/events?start_date={start_date}" \
               f"&event_type[]=1090519054&event_type[]=553648147&event_type[]=553648168&event_type[]=1090519084"
 
-    print(f"Fetching {api_url}")
+    # Reuse one connection for every page
+    with requests.Session() as session:
+
+        session.auth = HTTPBasicAuth(os.getenv("AMP_API_CLIENT_ID"), os.getenv("AMP_API_KEY"))
+
+        while api_url:
+
+            print(f"Fetching {api_url}")
+
+            # Get AMP Events
+            http_request = session.get(api_url)
+
+            # Check to make sure the GET was successful
+            if http_request.status_code == 200:
+                response = http_request.json()
+            else:
+                print(f"AMP Connection Failure - HTTP Return Code: {http_request.status_code}\nResponse: {http_request.text}")
+                exit(1)
+
+            yield response["data"]
+
+            # Only one page is held at a time, the next is fetched when the caller asks for it
+            api_url = response.get("metadata", {}).get("links", {}).get("next")
+
+
+def get_event_id(event):
+    """Get the AMP ID that identifies an event"""
+
+    return event["id"]
+
 
-    # Get AMP Events
-    http_request = requests.get(api_url, auth=HTTPBasicAuth(os.getenv("AMP_API_CLIENT_ID"), os.getenv("AMP_API_KEY")))
+def ensure_indexes(event_table):
+    """Make sure the indexes behind the latest event lookup and the duplicate check exist"""
 
-    # Check to make sure the GET was successful
-    if http_request.status_code == 200:
-        return http_request.json()
-    else:
-        print(f"AMP Connection Failure - HTTP Return Code: {http_request.status_code}\nResponse: {http_request.text}")
-        exit(1)
+    # Same definition as the 'product_timestamp' index managed by the Web app
+    event_table.create_index([("product", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                             name="product_timestamp")
+
+    # Rejects an event that is already stored, only events imported since checkpoints carry an 'import_id'
+    event_table.create_index([("product", pymongo.ASCENDING), ("import_id", pymongo.ASCENDING)],
+                             name="product_import_id",
+                             unique=True,
+                             partialFilterExpression={"import_id": {"$exists": True}})
 
 
 def run():
@@ -56,62 +97,102 @@ def run():
     # Use the 'events' collection from the specified database
     command_center_events = command_center_db["events"]
 
-    # Get the count of AMP for Endpoints documents
-    event_count = command_center_events.count_documents({"product": "AMP for Endpoints"})
+    # Make sure the latest event lookup is indexed
+    ensure_indexes(command_center_events)
+
+    # Use the 'importer_state' collection for this importer's checkpoint
+    command_center_state = command_center_db["importer_state"]
 
-    # If we have previous events, import from that point in time, otherwise, import the last 30 days
-    if event_count:
+    # Resume from the checkpoint if there is one, otherwise, import the last 30 days
+    checkpoint = event_store.get_checkpoint(command_center_state, command_center_events,
+                                            IMPORTER_NAME, PRODUCT_NAME, get_event_id)
 
-        # Get the latest 'AMP for Endpoints' event
-        latest_event = command_center_events.find({"product": "AMP for Endpoints"}).sort("timestamp", -1)
-        latest_event = latest_event[0]
-    else:
+    if not checkpoint:
         print("No events in database.  Setting latest_event timestamp to 30 days ago.")
         start_date = datetime.utcnow().replace(microsecond=0) + timedelta(-30)
-        latest_event = {"timestamp": start_date}
+        checkpoint = {"timestamp": start_date, "last_ids": []}
+
+    print("Latest AMP Event: ", checkpoint["timestamp"])
+
+    # Compare events against where this cycle started, the checkpoint itself moves as events are stored
+    resume_point = {"timestamp": checkpoint["timestamp"], "last_ids": list(checkpoint["last_ids"])}
+
+    # Time the cycle for the throughput log
+    cycle_start = time.perf_counter()
+
+    # Keep track of the pages and events stored this cycle
+    page_count = 0
+    inserted_count = 0
+
+    # Walk every page of the latest AMP events
+    for amp_events in get_event_pages(resume_point["timestamp"]):
+
+        page_count += 1
+
+        # The new events on this page
+        page_events = []
+
+        # Iterate through all fetched events
+        for event in amp_events:
+
+            current_event_time = datetime.strptime(event["date"], "%Y-%m-%dT%H:%M:%S+00:00")
+            event_id = get_event_id(event)
+
+            src_ip = None
+
+            # Get the first network address that isn't empty
+            for network_address in event["computer"]["network_addresses"]:
+                if network_address["ip"]:
+                    src_ip = network_address["ip"]
+                    break
+
+            # If no internal network address was found, then fall back to the external IP
+            if not src_ip:
+                src_ip = event["computer"]["external_ip"]
 
-    print("Latest AMP Event: ", latest_event["timestamp"])
+            if event_store.is_after_checkpoint(resume_point, current_event_time, event_id):
 
-    # Get the latest AMP events
-    amp_events = get_events(latest_event["timestamp"])
+                # Make common fields for the event
+                event_common_fields = {
+                    "event_name": event["event_type"],
+                    "event_details": event["detection"],
+                    "product": "AMP for Endpoints",
+                    "src_ip": src_ip,
+                    "timestamp": current_event_time,
+                    "formatted_timestamp": current_event_time.strftime("%b %d, %Y %H:%M:%S UTC"),
+                    "import_id": event_id
+                }
 
-    # Iterate through all fetched events
-    for event in amp_events["data"]:
+                # Add the common fields to the event
+                event.update(event_common_fields)
 
-        current_event_time = datetime.strptime(event["date"], "%Y-%m-%dT%H:%M:%S+00:00")
-        latest_event_time = latest_event["timestamp"]
+                page_events.append(event)
+                event_store.advance_checkpoint(checkpoint, current_event_time, event_id)
 
-        src_ip = None
+        if page_events:
 
-        # Get the first network address that isn't empty
-        for network_address in event["computer"]["network_addresses"]:
-            if network_address["ip"]:
-                src_ip = network_address["ip"]
-                break
+            # Store the page in the database with a single insert, a retried page only adds what's missing
+            page_events = event_store.insert_new_events(command_center_events, page_events)
+            inserted_count += len(page_events)
 
-        # If no internal network address was found, then fall back to the external IP
-        if not src_ip:
-            src_ip = event["computer"]["external_ip"]
+            # Count the new events into the 5-minute rollups
+            event_store.update_event_counts(command_center_db["event_counts"], page_events)
 
-        if current_event_time > latest_event_time:
+            # Add the new events to their hosts' summaries
+            event_store.update_hosts(command_center_db["hosts"], page_events)
 
-            # Make common fields for the event
-            event_common_fields = {
-                "event_name": event["event_type"],
-                "event_details": event["detection"],
-                "product": "AMP for Endpoints",
-                "src_ip": src_ip,
-                "timestamp": current_event_time,
-                "formatted_timestamp": current_event_time.strftime("%b %d, %Y %H:%M:%S UTC")
-            }
+    # Move the checkpoint past everything that was stored, pages come newest first so this waits for the last one,
+    # if the cycle fails before here the next one fetches the same pages and the duplicate check skips what's stored
+    if inserted_count:
+        event_store.save_checkpoint(command_center_state, IMPORTER_NAME, checkpoint)
 
-            # Add the common fields to the event
-            event.update(event_common_fields)
+    cycle_seconds = time.perf_counter() - cycle_start
 
-            # Store the event in the database
-            x = command_center_events.insert_one(event)
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
-            print(x.inserted_id)
+    print(f"Inserted {inserted_count} AMP events from {page_count} pages in {cycle_seconds:.1f} seconds "
+          f"({inserted_count / cycle_seconds:.1f} events/sec), peak memory {peak_memory_mb:.1f} MB")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks how many events per second the correlator can process
+
+Each run generates a synthetic stream of AMP, Firepower, Stealthwatch and Umbrella events spread over a set of
+hosts, a few of them busy and most of them quiet, with some events arriving late. It feeds the stream to the
+correlator in batches with the rules from correlation_rules.json, and flushes every --flush-every events to a
+stand-in that only counts the writes.
+
+    python benchmark_correlator.py --hosts 1000 10000 --events 1000000
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+import event_correlator
+
+# The products and some of the event names each importer stores
+PRODUCT_EVENTS = {
+    "AMP for Endpoints": ["Threat Detected", "Threat Quarantined", "Executed malware", "Policy Update"],
+    "Firepower": ["ET POLICY Vulnerable Java Version 1.8.x Detected", "ET SCAN Nmap Scripting Engine User-Agent"],
+    "Stealthwatch": ["Suspect Data Hoarding", "High Concern Index", "Recon"],
+    "Umbrella": ["Umbrella Blocked Destination", "Umbrella Allowed Destination"],
+}
+
+
+class CountingTable():
+    """
+    A stand-in for the 'incidents' collection that only counts the writes it is given.
+    """
+
+    def __init__(self):
+        self.write_count = 0
+
+    def bulk_write(self, operations, ordered=True):
+        self.write_count += len(operations)
+
+
+def generate_events(event_count, host_count, events_per_second, late_fraction, seed):
+    """Build the synthetic stream, in insert order with a few events timestamped well before their neighbours."""
+
+    generator = random.Random(seed)
+    products = list(PRODUCT_EVENTS)
+    hosts = [f"10.{index // 65536}.{index // 256 % 256}.{index % 256}" for index in range(host_count)]
+
+    start_time = datetime(2026, 1, 1)
+    events = []
+
+    for index in range(event_count):
+
+        product = generator.choice(products)
+        timestamp = start_time + timedelta(seconds=index / events_per_second)
+
+        # Importers poll on an interval, so some events are stored minutes after they happened
+        if generator.random() < late_fraction:
+            timestamp -= timedelta(seconds=generator.uniform(60, 900))
+
+        events.append({
+            "_id": ObjectId(),
+            # A few chatty hosts and a long tail of quiet ones, as on a real network
+            "src_ip": hosts[int(host_count * generator.random() ** 3)],
+            "product": product,
+            "event_name": generator.choice(PRODUCT_EVENTS[product]),
+            "timestamp": timestamp,
+        })
+
+    return events
+
+
+def run(args, host_count):
+    """Measure events per second for one host count."""
+
+    events = generate_events(args.events, host_count, args.events_per_second, args.late_fraction, args.seed)
+    rules = event_correlator.load_rules(args.rules)
+    incident_table = CountingTable()
+
+    if args.memory:
+        tracemalloc.start()
+
+    correlator = event_correlator.EventCorrelator(rules, incident_table)
+
+    start_time = time.perf_counter()
+    flush_time = 0.0
+    unflushed_count = 0
+
+    for batch_start in range(0, len(events), args.batch_size):
+
+        batch = events[batch_start:batch_start + args.batch_size]
+        correlator.process(batch)
+        unflushed_count += len(batch)
+
+        # Flush without a clock, so incidents close on the stream's own time as they would live
+        if unflushed_count >= args.flush_every:
+            flush_start = time.perf_counter()
+            correlator.flush()
+            flush_time += time.perf_counter() - flush_start
+            unflushed_count = 0
+
+    correlator.flush()
+
+    elapsed = time.perf_counter() - start_time
+    stats = correlator.stats()
+
+    print(f"{host_count:>7} hosts: {args.events / elapsed:>10,.0f} events/s over {elapsed:.2f} s "
+          f"({flush_time / elapsed:.0%} flushing), {stats['matched']:,} matches, {stats['opened']:,} incidents, "
+          f"{incident_table.write_count:,} incident writes, {stats['open_incidents']:,} still open, "
+          f"{stats['partial_matches']:,} partial matches")
+
+    if args.memory:
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'':>7}        peak correlator memory {peak / 1024 / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--events", type=int, default=500000)
+    parser.add_argument("--events-per-second", type=float, default=5.0,
+                        help="the rate of the synthetic stream, which sets how many events share a window")
+    parser.add_argument("--late-fraction", type=float, default=0.02)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--flush-every", type=int, default=20000)
+    parser.add_argument("--rules", default="correlation_rules.json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--memory", action="store_true", help="also report peak memory, which slows the run")
+    args = parser.parse_args()
+
+    for host_count in args.hosts:
+        run(args, host_count)
+
+
+if __name__ == "__main__":
+    main()
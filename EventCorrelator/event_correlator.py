@@ -0,0 +1,600 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script correlates the events from every product into incidents for Cisco Command Center
+
+It reads new events from the 'events' collection in insert order, matches them against the rules in
+correlation_rules.json and groups the matches by source IP within each rule's sliding time window. Incidents
+that are still open are kept in memory and flushed to the 'incidents' collection every few seconds, and a
+checkpoint in 'importer_state' records how far the stream has been read, so history is never scanned again.
+"""
+
+import collections
+import json
+import os
+import time
+
+import pymongo
+
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from pymongo.errors import PyMongoError
+
+load_dotenv()
+
+# The name of the correlator's record in the 'importer_state' collection
+CORRELATOR_NAME = "event_correlator"
+
+# The event fields the correlator reads
+EVENT_PROJECTION = {"src_ip": 1, "product": 1, "event_name": 1, "timestamp": 1}
+
+
+class CorrelationRule():
+    """
+    A class to hold one correlation rule and decide which events it applies to.
+    """
+
+    def __init__(self, name, match, severity="medium", window_minutes=60, min_events=2, min_products=2):
+        self.name = name
+        self.severity = severity
+        self.window = timedelta(minutes=window_minutes)
+        self.min_events = min_events
+        self.min_products = min_products
+
+        # Each condition is a product, an event name or both, a list means any of them, a missing field means any
+        self.conditions = [(_as_set(condition.get("product")), _as_set(condition.get("event_name")))
+                           for condition in match]
+
+    @classmethod
+    def from_dict(cls, rule):
+        """
+        Build a rule from its entry in the rules file.
+        """
+
+        return cls(rule["name"], rule["match"],
+                   severity=rule.get("severity", "medium"),
+                   window_minutes=rule.get("window_minutes", 60),
+                   min_events=rule.get("min_events", 2),
+                   min_products=rule.get("min_products", 2))
+
+    def matches(self, product, event_name):
+        """
+        Check whether an event meets any of the rule's conditions.
+        """
+
+        for (products, event_names) in self.conditions:
+            if (products is None or product in products) and (event_names is None or event_name in event_names):
+                return True
+
+        return False
+
+
+class Incident():
+    """
+    A class to hold an incident that is open in memory.
+    """
+
+    __slots__ = ("_id", "rule", "src_ip", "first_seen", "last_seen", "event_count", "products", "event_names",
+                 "event_ids", "last_event_id", "status", "dirty")
+
+    def __init__(self, rule, src_ip):
+        self._id = ObjectId()
+        self.rule = rule
+        self.src_ip = src_ip
+        self.first_seen = None
+        self.last_seen = None
+        self.event_count = 0
+        self.products = set()
+        self.event_names = set()
+        self.event_ids = []
+        self.last_event_id = None
+        self.status = "open"
+        self.dirty = True
+
+    @classmethod
+    def from_document(cls, rule, document):
+        """
+        Rebuild an open incident from its document in the 'incidents' collection.
+        """
+
+        incident = cls(rule, document["src_ip"])
+        incident._id = document["_id"]
+        incident.first_seen = document["first_seen"]
+        incident.last_seen = document["last_seen"]
+        incident.event_count = document["event_count"]
+        incident.products = set(document["products"])
+        incident.event_names = set(document["event_names"])
+        incident.event_ids = document["event_ids"]
+        incident.last_event_id = document["last_event_id"]
+        incident.dirty = False
+
+        return incident
+
+    def add(self, event_id, product, event_name, timestamp, max_event_ids):
+        """
+        Add an event to the incident, only the first few event IDs are kept.
+        """
+
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+        self.event_count += 1
+        self.products.add(product)
+        self.event_names.add(event_name)
+
+        if len(self.event_ids) < max_event_ids:
+            self.event_ids.append(event_id)
+
+        if self.last_event_id is None or event_id > self.last_event_id:
+            self.last_event_id = event_id
+
+        self.dirty = True
+
+    def to_document(self):
+        """
+        Build the incident's document for the 'incidents' collection.
+        """
+
+        return {
+            "rule": self.rule.name,
+            "severity": self.rule.severity,
+            "src_ip": self.src_ip,
+            "status": self.status,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "event_count": self.event_count,
+            "products": sorted(self.products),
+            "event_names": sorted(self.event_names),
+            "event_ids": self.event_ids,
+            "last_event_id": self.last_event_id,
+            "updated_at": datetime.utcnow(),
+        }
+
+
+class Candidate():
+    """
+    A class to hold the recent matches for a rule and host that haven't made an incident yet.
+    """
+
+    __slots__ = ("events", "product_counts")
+
+    def __init__(self):
+        # (timestamp, event ID, product, event name) in time order, trimmed to the rule's window
+        self.events = collections.deque()
+        self.product_counts = collections.Counter()
+
+    def add(self, event_id, product, event_name, timestamp, window):
+        """
+        Add a match and forget the matches that have slid out of the window behind the newest one.
+        """
+
+        match = (timestamp, event_id, product, event_name)
+
+        # Events mostly arrive in time order, the odd late one is slotted in so the oldest stay at the front
+        if self.events and timestamp < self.events[-1][0]:
+            index = len(self.events)
+
+            while index and self.events[index - 1][0] > timestamp:
+                index -= 1
+
+            self.events.insert(index, match)
+        else:
+            self.events.append(match)
+
+        self.product_counts[product] += 1
+
+        cutoff = self.events[-1][0] - window
+
+        while self.events[0][0] < cutoff:
+            (_, _, expired_product, _) = self.events.popleft()
+            self.product_counts[expired_product] -= 1
+
+            if not self.product_counts[expired_product]:
+                del self.product_counts[expired_product]
+
+    def newest(self):
+        """
+        Return the newest timestamp in the window.
+        """
+
+        return self.events[-1][0]
+
+
+class EventCorrelator():
+    """
+    A class to group a stream of events into incidents by rule, source IP and sliding time window.
+    """
+
+    def __init__(self, rules, incident_table=None, max_event_ids=100, allowed_lateness=300, max_clock_skew=300):
+        self.rules = rules
+        self.rules_by_name = {rule.name: rule for rule in rules}
+        self.max_event_ids = max_event_ids
+        self.allowed_lateness = timedelta(seconds=allowed_lateness)
+        self.max_clock_skew = timedelta(seconds=max_clock_skew)
+
+        self._incident_table = incident_table
+
+        # Rules that name products are looked up by product, the rest are checked against every event
+        self._rules_by_product = collections.defaultdict(list)
+        self._any_product_rules = []
+
+        for rule in rules:
+            products = set()
+
+            for (condition_products, _) in rule.conditions:
+                if condition_products is None:
+                    products = None
+                    break
+                products.update(condition_products)
+
+            if products is None:
+                self._any_product_rules.append(rule)
+            else:
+                for product in products:
+                    self._rules_by_product[product].append(rule)
+
+        # Open incidents and partial matches, keyed on (rule name, source IP)
+        self._incidents = {}
+        self._candidates = {}
+
+        # Incidents that closed since the last flush
+        self._closed = []
+
+        # The newest event timestamp seen, incidents close once it's a window past their last event
+        self._watermark = None
+
+        # Events up to this ID were read before a restart and only rebuild the partial matches
+        self._replay_until = None
+
+        # Counters exposed through stats()
+        self._processed_count = 0
+        self._matched_count = 0
+        self._opened_count = 0
+        self._closed_count = 0
+        self._late_count = 0
+        self._future_count = 0
+
+    def load_open_incidents(self):
+        """
+        Pick up the incidents that were still open when the correlator last stopped.
+        """
+
+        for document in self._incident_table.find({"status": "open"}):
+
+            rule = self.rules_by_name.get(document["rule"])
+
+            # Close incidents whose rule has since been removed
+            if rule is None:
+                self._incident_table.update_one({"_id": document["_id"]},
+                                                {"$set": {"status": "closed", "updated_at": datetime.utcnow()}})
+                continue
+
+            self._incidents[(rule.name, document["src_ip"])] = Incident.from_document(rule, document)
+
+        return len(self._incidents)
+
+    def replay_until(self, event_id):
+        """
+        Treat the events up to an ID as already correlated, they can fill partial matches but not open incidents.
+        """
+
+        self._replay_until = event_id
+
+    def process(self, events):
+        """
+        Correlate a batch of events, in insert order.
+        """
+
+        # A device with a wrong clock mustn't drag the stream into the future and close every incident
+        latest_watermark = datetime.utcnow() + self.max_clock_skew
+
+        for event in events:
+
+            self._processed_count += 1
+
+            src_ip = event.get("src_ip")
+            product = event.get("product")
+            timestamp = event.get("timestamp")
+
+            if not src_ip or not timestamp:
+                continue
+
+            if timestamp > latest_watermark:
+                self._future_count += 1
+
+            if self._watermark is None or timestamp > self._watermark:
+                self._watermark = min(timestamp, latest_watermark)
+
+            event_name = event.get("event_name")
+
+            for rule in self._rules_by_product.get(product, ()):
+                if rule.matches(product, event_name):
+                    self._correlate(rule, event["_id"], src_ip, product, event_name, timestamp)
+
+            for rule in self._any_product_rules:
+                if rule.matches(product, event_name):
+                    self._correlate(rule, event["_id"], src_ip, product, event_name, timestamp)
+
+    def _correlate(self, rule, event_id, src_ip, product, event_name, timestamp):
+        """
+        Add a matching event to its open incident, or to the partial match that may become one.
+        """
+
+        self._matched_count += 1
+
+        key = (rule.name, src_ip)
+        incident = self._incidents.get(key)
+
+        if incident is not None:
+
+            # Skip events the incident already holds, which happens when a restart replays them
+            if incident.last_event_id is not None and event_id <= incident.last_event_id:
+                return
+
+            # Only an event a window after the incident shows it's over, a late one older than it doesn't
+            if timestamp <= incident.last_seen + rule.window:
+
+                # Within a window of the incident, the event belongs to it
+                if timestamp >= incident.first_seen - rule.window:
+                    incident.add(event_id, product, event_name, timestamp, self.max_event_ids)
+                else:
+                    # Far too late to be part of it, and while it's open there's no partial match to join
+                    self._late_count += 1
+
+                return
+
+            # Otherwise the incident is over and this event starts again
+            self._close(key, incident)
+
+        candidate = self._candidates.get(key)
+
+        if candidate is None:
+            candidate = self._candidates[key] = Candidate()
+
+        candidate.add(event_id, product, event_name, timestamp, rule.window)
+
+        # Replayed events had their chance to open an incident before the restart
+        if self._replay_until is not None and event_id <= self._replay_until:
+            return
+
+        if len(candidate.events) >= rule.min_events and len(candidate.product_counts) >= rule.min_products:
+
+            incident = Incident(rule, src_ip)
+
+            for (candidate_timestamp, candidate_event_id, candidate_product, candidate_event_name) in candidate.events:
+                incident.add(candidate_event_id, candidate_product, candidate_event_name, candidate_timestamp,
+                             self.max_event_ids)
+
+            self._incidents[key] = incident
+            del self._candidates[key]
+
+            self._opened_count += 1
+
+    def _close(self, key, incident):
+        """
+        Close an incident, it's written out and forgotten at the next flush.
+        """
+
+        incident.status = "closed"
+        incident.dirty = True
+
+        self._closed.append(incident)
+        del self._incidents[key]
+
+        self._closed_count += 1
+
+    def expire(self, now=None):
+        """
+        Close the incidents and drop the partial matches that are a window behind the stream.
+
+        Only pass 'now' once the backlog has been read, it lets the clock move the stream along when it's quiet.
+        """
+
+        if self._watermark is None:
+            return
+
+        # Fall back on the clock, less the time the importers may lag behind, when no new events arrive
+        horizon = self._watermark
+
+        if now is not None:
+            horizon = max(horizon, now - self.allowed_lateness)
+
+        for (key, incident) in list(self._incidents.items()):
+            if incident.last_seen + incident.rule.window < horizon:
+                self._close(key, incident)
+
+        for (key, candidate) in list(self._candidates.items()):
+            if candidate.newest() + self.rules_by_name[key[0]].window < horizon:
+                del self._candidates[key]
+
+    def flush(self, now=None):
+        """
+        Write the incidents that changed since the last flush with a single unordered bulk write.
+        """
+
+        self.expire(now)
+
+        dirty_incidents = [incident for incident in self._incidents.values() if incident.dirty] + self._closed
+
+        operations = [pymongo.UpdateOne({"_id": incident._id}, {"$set": incident.to_document()}, upsert=True)
+                      for incident in dirty_incidents]
+
+        if operations:
+            self._incident_table.bulk_write(operations, ordered=False)
+
+        # Only mark them clean once they're stored, so a failed write is retried at the next flush
+        for incident in dirty_incidents:
+            incident.dirty = False
+
+        self._closed = []
+
+        return len(operations)
+
+    def stats(self):
+        """
+        Return the event and incident counters and the size of the in-memory state.
+        """
+
+        return {
+            "processed": self._processed_count,
+            "matched": self._matched_count,
+            "opened": self._opened_count,
+            "closed": self._closed_count,
+            "open_incidents": len(self._incidents),
+            "partial_matches": len(self._candidates),
+            "late_dropped": self._late_count,
+            "future_timestamps": self._future_count,
+            "watermark": self._watermark.isoformat() if self._watermark else None,
+        }
+
+
+def _as_set(value):
+    """
+    Turn a rule field into a set of accepted values, or None when any value is accepted.
+    """
+
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        return {value}
+
+    return set(value)
+
+
+def load_rules(rules_path):
+    """
+    Load the correlation rules from a JSON file.
+    """
+
+    with open(rules_path) as rules_file:
+        rules = [CorrelationRule.from_dict(rule) for rule in json.load(rules_file)]
+
+    # Incidents are keyed on the rule name, so the names must be unique
+    names = [rule.name for rule in rules]
+
+    if len(names) != len(set(names)):
+        raise ValueError(f"Correlation rule names in {rules_path} must be unique")
+
+    return rules
+
+
+def ensure_indexes(incident_table):
+    """
+    Make sure the open incident lookup and the per-host incident lookup are indexed.
+    """
+
+    incident_table.create_index([("status", pymongo.ASCENDING)], name="status")
+    incident_table.create_index([("src_ip", pymongo.ASCENDING), ("last_seen", pymongo.DESCENDING)],
+                                name="src_ip_last_seen")
+
+
+def save_checkpoint(state_table, event_id):
+    """
+    Store the ID of the last event correlated, a single document update so it's atomic.
+    """
+
+    state_table.update_one({"_id": CORRELATOR_NAME},
+                           {"$set": {"event_id": event_id, "updated_at": datetime.utcnow()}},
+                           upsert=True)
+
+
+def run():
+    """
+    Main function to correlate new events into incidents until interrupted.
+    """
+
+    # Connect to the MongoDB instance
+    db_client = pymongo.MongoClient(f"mongodb://{os.getenv('MONGO_INITDB_ADDRESS')}/",
+                                    username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
+                                    password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
+
+    # Use the specified database
+    command_center_db = db_client[os.getenv("MONGO_INITDB_DATABASE")]
+
+    command_center_events = command_center_db["events"]
+    command_center_incidents = command_center_db["incidents"]
+    command_center_state = command_center_db["importer_state"]
+
+    ensure_indexes(command_center_incidents)
+
+    rules = load_rules(os.getenv("CORRELATION_RULES_PATH", "correlation_rules.json"))
+
+    print(f"Loaded {len(rules)} correlation rules: {', '.join(rule.name for rule in rules)}")
+
+    correlator = EventCorrelator(rules, command_center_incidents,
+                                 max_event_ids=int(os.getenv("CORRELATION_MAX_INCIDENT_EVENTS", "100")),
+                                 allowed_lateness=int(os.getenv("CORRELATION_ALLOWED_LATENESS", "300")),
+                                 max_clock_skew=int(os.getenv("CORRELATION_MAX_CLOCK_SKEW", "300")))
+
+    print(f"Resumed {correlator.load_open_incidents()} open incidents")
+
+    batch_size = int(os.getenv("CORRELATION_BATCH_SIZE", "5000"))
+    poll_interval = float(os.getenv("CORRELATION_POLL_INTERVAL", "5"))
+    flush_interval = float(os.getenv("CORRELATION_FLUSH_INTERVAL", "10"))
+    settle_time = timedelta(seconds=int(os.getenv("CORRELATION_SETTLE_SECONDS", "10")))
+
+    checkpoint = command_center_state.find_one({"_id": CORRELATOR_NAME})
+
+    if checkpoint:
+        # Read one window back from the checkpoint to rebuild the partial matches, which aren't stored
+        last_event_id = checkpoint["event_id"]
+        correlator.replay_until(last_event_id)
+
+        longest_window = max((rule.window for rule in rules), default=timedelta(0))
+        read_from = ObjectId.from_datetime(last_event_id.generation_time - longest_window)
+    else:
+        # Start with the events from the last day rather than the whole history
+        print("No correlator checkpoint.  Starting from events stored in the last 24 hours.")
+        last_event_id = read_from = ObjectId.from_datetime(datetime.utcnow() - timedelta(hours=24))
+
+    next_flush = time.monotonic() + flush_interval
+
+    while True:
+
+        # Leave the newest few seconds alone, an importer may still be inserting events with IDs from that time
+        read_until = ObjectId.from_datetime(datetime.utcnow() - settle_time)
+
+        events = list(command_center_events.find({"_id": {"$gt": read_from, "$lt": read_until}}, EVENT_PROJECTION)
+                      .sort("_id", pymongo.ASCENDING)
+                      .limit(batch_size))
+
+        if events:
+            correlator.process(events)
+            read_from = events[-1]["_id"]
+
+            if read_from > last_event_id:
+                last_event_id = read_from
+
+        # Write out the incidents, then move the checkpoint past the events they hold
+        if time.monotonic() >= next_flush:
+
+            # Only let the clock close incidents once the backlog is read, while catching up the events are far
+            # behind the clock and it would close every incident between batches
+            caught_up = len(events) < batch_size
+
+            try:
+                flushed_count = correlator.flush(now=datetime.utcnow() if caught_up else None)
+                save_checkpoint(command_center_state, last_event_id)
+                print(f"Flushed {flushed_count} incidents, correlator stats: {json.dumps(correlator.stats())}")
+            except PyMongoError as error:
+                print(f"Incident flush failed: {error}")
+
+            next_flush = time.monotonic() + flush_interval
+
+        # Keep reading while there's a backlog, otherwise wait for the importers
+        if len(events) < batch_size:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+
+    try:
+        run()
+    except KeyboardInterrupt:
+        print("Crtl+C Pressed. Shutting down.")
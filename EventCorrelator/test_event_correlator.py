@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the event correlator's incident windows
+
+    python -m unittest test_event_correlator
+"""
+
+import unittest
+
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+import event_correlator
+
+
+class RecordingTable():
+    """
+    A stand-in for the 'incidents' collection that keeps the latest document written for each incident.
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.documents[operation._filter["_id"]] = operation._doc["$set"]
+
+
+class IncidentWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        rule = event_correlator.CorrelationRule("Intrusion with Suspicious Traffic",
+                                                [{"product": "Firepower"}, {"product": "Stealthwatch"}],
+                                                window_minutes=60)
+
+        self.incident_table = RecordingTable()
+        self.correlator = event_correlator.EventCorrelator([rule], self.incident_table)
+
+        # Keep the stream in the recent past, so the clock never limits it
+        self.start_time = datetime.utcnow().replace(microsecond=0) - timedelta(hours=3)
+
+    def event(self, product, minutes):
+        return {"_id": ObjectId(), "src_ip": "10.1.1.1", "product": product, "event_name": product,
+                "timestamp": self.start_time + timedelta(minutes=minutes)}
+
+    def test_late_event_older_than_incident_leaves_it_open(self):
+        self.correlator.process([self.event("Firepower", 120), self.event("Stealthwatch", 121)])
+        self.correlator.process([self.event("Firepower", 0)])
+        self.correlator.process([self.event("Stealthwatch", 122)])
+        self.correlator.flush()
+
+        incidents = list(self.incident_table.documents.values())
+
+        self.assertEqual(len(incidents), 1)
+        self.assertEqual(incidents[0]["status"], "open")
+        self.assertEqual(incidents[0]["event_count"], 3)
+        self.assertEqual(self.correlator.stats()["late_dropped"], 1)
+
+    def test_event_a_window_after_the_incident_closes_it(self):
+        self.correlator.process([self.event("Firepower", 0), self.event("Stealthwatch", 1)])
+        self.correlator.process([self.event("Firepower", 62)])
+        self.correlator.flush()
+
+        self.assertEqual(sorted(incident["status"] for incident in self.incident_table.documents.values()),
+                         ["closed"])
+
+    def test_future_timestamp_does_not_close_open_incidents(self):
+        self.correlator.process([self.event("Firepower", 170), self.event("Stealthwatch", 171)])
+
+        # A device whose clock is a year ahead reports an event for another host
+        future_event = self.event("Firepower", 0)
+        future_event["src_ip"] = "10.2.2.2"
+        future_event["timestamp"] = datetime.utcnow() + timedelta(days=365)
+
+        self.correlator.process([future_event])
+        self.correlator.flush()
+
+        stats = self.correlator.stats()
+
+        self.assertEqual(stats["open_incidents"], 1)
+        self.assertEqual(stats["future_timestamps"], 1)
+        self.assertLess(datetime.fromisoformat(stats["watermark"]),
+                        datetime.utcnow() + self.correlator.max_clock_skew + timedelta(seconds=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
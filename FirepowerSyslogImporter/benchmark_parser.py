@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks the Firepower syslog parser against benchmark_corpus.log
+
+Lines the parser accepts and lines it rejects are timed separately, and the previous per-call regex and
+strptime approach is timed on the same input for comparison.
+
+    PYTHONPATH=../Shared python benchmark_parser.py --repeat 2000
+"""
+
+import argparse
+import os
+import re
+import time
+
+from datetime import datetime
+
+import firepower_syslog_event_importer as importer
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_corpus.log")
+
+
+def _legacy_parse_event(data):
+    """The parser as it was before the regex was compiled and prefiltered."""
+
+    regex_string = r"([a-zA-z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}) (\S*) SFIMS: \[([0-9:]*)\] \"([^\"]*)\"\s*" \
+                   r"\[Impact: ([^\]]*)\]?\s*From \"([^\"]*)\" at ([a-zA-Z]{3}\s[a-zA-Z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}\s\d{4}\s\S*)\s*" \
+                   r"\[Classification: ([^\]]*)\]?\s*\[Priority: ([^\]]*)\]\s\{([^\}]*)\} ([0-9.]*):?([0-9]*)?\s?\(?([^\)]*)\)?->([0-9.]*)" \
+                   r":?([0-9]*)?\s*\(?([^\)]*)\)?"
+
+    parsed_event = re.search(regex_string, data, re.MULTILINE)
+
+    if parsed_event:
+        current_event_time = datetime.strptime(parsed_event.group(7), "%a %b %d %H:%M:%S %Y %Z")
+        return (parsed_event.groups(), current_event_time, current_event_time.strftime("%b %d, %Y %H:%M:%S UTC"))
+
+    return None
+
+
+def _lines_per_second(parse, lines, repeat):
+    """Parse every line 'repeat' times and return the throughput."""
+
+    start_time = time.perf_counter()
+
+    for _ in range(repeat):
+        for line in lines:
+            parse(line)
+
+    return len(lines) * repeat / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    event_parser = importer.FirepowerSyslogHandler()
+
+    with open(CORPUS_PATH) as corpus:
+        lines = [line.strip() for line in corpus if line.strip()]
+
+    matching = [line for line in lines if event_parser._parse_event(line)]
+    non_matching = [line for line in lines if line not in matching]
+
+    print(f"Corpus: {len(matching)} matching lines, {len(non_matching)} non-matching lines")
+
+    for (label, sample) in (("matching", matching), ("non-matching", non_matching)):
+        current = _lines_per_second(event_parser._parse_event, sample, args.repeat)
+        legacy = _lines_per_second(_legacy_parse_event, sample, args.repeat)
+
+        print(f"{label:<13} current={current:12,.0f} lines/s  legacy={legacy:12,.0f} lines/s  "
+              f"speedup={current / legacy:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
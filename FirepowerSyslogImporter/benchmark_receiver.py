@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks how many syslog packets per second the Firepower receivers can process
+
+Each run starts the requested number of receiver processes on a local port with SO_REUSEPORT, replaces
+the database writer with a counter, and floods the port from several sender processes.
+
+    PYTHONPATH=../Shared python benchmark_receiver.py --processes 1 2 4 --seconds 5
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+
+import firepower_syslog_event_importer as importer
+
+SAMPLE_EVENT = "Oct 18 12:00:00 fmc01 SFIMS: [1:2019401:2] \"ET POLICY Vulnerable Java Version 1.8.x Detected\" " \
+               "[Impact: Unknown] From \"DataCenter/ftd01\" at Sun Oct 18 12:00:00 2020 UTC " \
+               "[Classification: Potential Corporate Privacy Violation] [Priority: 1] {tcp} " \
+               "10.1.1.10:51234 (unknown)->93.184.216.34:80 (united states)"
+
+
+class CountingWriter():
+    """
+    A stand-in for FirepowerEventWriter that only counts the events it is given.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def submit(self, event_json):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+        return True
+
+
+def _receive(port, counter, receive_buffer_size):
+    """Run a receiver that counts parsed events instead of writing them."""
+
+    server = importer.FirepowerSyslogServer(("127.0.0.1", port), importer.SyslogHandler, CountingWriter(counter),
+                                            reuse_port=True,
+                                            receive_buffer_size=receive_buffer_size)
+
+    # Silence the per-packet logging so it doesn't dominate the measurement
+    importer.print = lambda *args, **kwargs: None
+
+    server.serve_forever()
+
+
+def _send(port, seconds):
+    """Send the sample event as fast as possible from a few source ports."""
+
+    payload = SAMPLE_EVENT.encode()
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(8)]
+    deadline = time.monotonic() + seconds
+    sent = 0
+
+    while time.monotonic() < deadline:
+        # Rotate source ports so the kernel hashes packets across every receiver
+        sockets[sent % len(sockets)].sendto(payload, ("127.0.0.1", port))
+        sent += 1
+
+    return sent
+
+
+def run(process_count, sender_count, seconds, port, receive_buffer_size):
+    """Measure processed packets per second for one receiver process count."""
+
+    counter = multiprocessing.Value("l", 0)
+    receivers = [multiprocessing.Process(target=_receive, args=(port, counter, receive_buffer_size), daemon=True)
+                 for _ in range(process_count)]
+
+    for receiver in receivers:
+        receiver.start()
+
+    # Give the receivers time to bind
+    time.sleep(0.5)
+
+    with multiprocessing.Pool(sender_count) as pool:
+        sent = sum(pool.starmap(_send, [(port, seconds)] * sender_count))
+
+    # Let the receivers drain their socket buffers
+    time.sleep(0.5)
+
+    for receiver in receivers:
+        receiver.terminate()
+        receiver.join()
+
+    processed = counter.value
+
+    print(f"receivers={process_count:<3} sent={sent / seconds:10.0f} pps  processed={processed / seconds:10.0f} pps  "
+          f"lost={100 * (1 - processed / max(sent, 1)):5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, multiprocessing.cpu_count()])
+    parser.add_argument("--senders", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--port", type=int, default=14514)
+    parser.add_argument("--receive-buffer", type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args()
+
+    for process_count in args.processes:
+        run(process_count, args.senders, args.seconds, args.port, args.receive_buffer)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,52 +5,90 @@
 This module is used to import Firepower syslog events into Cisco Command Center
 """
 
+import functools
 import json
+import multiprocessing
 import os
+import queue
 import re
+import socket
 import socketserver
+import threading
+import time
 
 import pymongo
 
 from datetime import datetime
 from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import event_store
 
 load_dotenv()
 
+# Firepower IPS events generated by the FMC are the only messages carrying this tag
+FIREPOWER_IPS_TAG = "SFIMS:"
 
-class FirepowerSyslogHandler():
+# A Regex for parsing Firepower IPS events generated by the FMC, compiled once per process
+FIREPOWER_IPS_REGEX = re.compile(
+    r"([a-zA-z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}) (\S*) SFIMS: \[([0-9:]*)\] \"([^\"]*)\"\s*"
+    r"\[Impact: ([^\]]*)\]?\s*From \"([^\"]*)\" at ([a-zA-Z]{3}\s[a-zA-Z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}\s\d{4}\s\S*)\s*"
+    r"\[Classification: ([^\]]*)\]?\s*\[Priority: ([^\]]*)\]\s\{([^\}]*)\} ([0-9.]*):?([0-9]*)?\s?\(?([^\)]*)\)?->([0-9.]*)"
+    r":?([0-9]*)?\s*\(?([^\)]*)\)?"
+)
+
+# Month abbreviations for the fast timestamp path
+MONTHS = {month: number for number, month in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                                                          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], start=1)}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_event_time(event_time):
     """
-    A class to parse Firepower syslog events.
+    Parse an FMC event time such as 'Sun Oct 18 12:00:00 2020 UTC' into a datetime and a display string.
+
+    Bursts of events share the same second, so results are cached.
     """
 
-    __db_address = None
-    __db_username = None
-    __db_password = None
+    try:
+        (_, month, day, clock, year, zone) = event_time.split()
+
+        if zone not in ("UTC", "GMT"):
+            raise ValueError(zone)
+
+        (hour, minute, second) = clock.split(":")
+
+        current_event_time = datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+
+    except (KeyError, ValueError):
+        # Anything unusual goes through the strict parser
+        current_event_time = datetime.strptime(event_time, "%a %b %d %H:%M:%S %Y %Z")
 
-    def __init__(self):
-        self.__db_address = os.getenv("MONGO_INITDB_ADDRESS")
-        self.__db_username = os.getenv("MONGO_INITDB_ROOT_USERNAME")
-        self.__db_password = os.getenv("MONGO_INITDB_ROOT_PASSWORD")
+    return (current_event_time, current_event_time.strftime("%b %d, %Y %H:%M:%S UTC"))
+
+
+class FirepowerSyslogHandler():
+    """
+    A class to parse Firepower syslog events.
+    """
 
     def _parse_event(self, data):
         """
         Parse the data using regex to extract the pertinent Firepower data.
         """
 
-        # A Regex string for parsing Firepower IPS events generated by the FMC
-        regex_string = r"([a-zA-z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}) (\S*) SFIMS: \[([0-9:]*)\] \"([^\"]*)\"\s*" \
-                       r"\[Impact: ([^\]]*)\]?\s*From \"([^\"]*)\" at ([a-zA-Z]{3}\s[a-zA-Z]{3}\s*\d{1,2}\s\d{2}:\d{2}:\d{2}\s\d{4}\s\S*)\s*" \
-                       r"\[Classification: ([^\]]*)\]?\s*\[Priority: ([^\]]*)\]\s\{([^\}]*)\} ([0-9.]*):?([0-9]*)?\s?\(?([^\)]*)\)?->([0-9.]*)" \
-                       r":?([0-9]*)?\s*\(?([^\)]*)\)?"
+        # Most syslog traffic isn't an IPS event, so skip it before running the regex
+        if FIREPOWER_IPS_TAG not in data:
+            return None
 
         # Try to parse the event, if this fails None is returned
-        parsed_event = re.search(regex_string, data, re.MULTILINE)
+        parsed_event = FIREPOWER_IPS_REGEX.search(data)
 
         # If we properly parsed the event, do stuff
         if parsed_event:
 
             # Parse the current event time
-            current_event_time = datetime.strptime(parsed_event.group(7), "%a %b %d %H:%M:%S %Y %Z")
+            (current_event_time, formatted_timestamp) = parse_event_time(parsed_event.group(7))
 
             # Store the parsed data into a dict
             event_json = {
@@ -63,7 +101,7 @@ class FirepowerSyslogHandler():
                 "impact_level": parsed_event.group(5),
                 "sensor_name": parsed_event.group(6),
                 "timestamp": current_event_time,
-                "formatted_timestamp": current_event_time.strftime("%b %d, %Y %H:%M:%S UTC"),
+                "formatted_timestamp": formatted_timestamp,
                 "classification": parsed_event.group(8),
                 "priority": parsed_event.group(9),
                 "protocol": parsed_event.group(10),
@@ -80,26 +118,198 @@ class FirepowerSyslogHandler():
         else:
             return None
 
-    def _commit_to_db(self, event_json):
+
+class FirepowerEventWriter():
+    """
+    A class to buffer parsed events and write them to the database in batches.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue_size=10000, stats_interval=60):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+
+        # A bounded queue so that a storm can't exhaust memory, events past the bound are dropped and counted
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+        # Counters exposed through stats()
+        self._received_count = 0
+        self._dropped_count = 0
+        self._inserted_count = 0
+        self._failed_count = 0
+        self._flush_count = 0
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+
+        # One client for the life of the process
+        db_client = pymongo.MongoClient(f"mongodb://{os.getenv('MONGO_INITDB_ADDRESS')}/",
+                                        username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
+                                        password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
+
+        # Use the 'events', 'event_counts' and 'hosts' collections from the 'commandcenter' database
+        self._events_collection = db_client["commandcenter"]["events"]
+        self._event_counts_collection = db_client["commandcenter"]["event_counts"]
+        self._hosts_collection = db_client["commandcenter"]["hosts"]
+
+    def start(self):
+        """
+        Start the background flusher thread.
+        """
+
+        self._thread = threading.Thread(target=self._run, name="firepower-event-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the flusher once everything that is queued has been written.
+        """
+
+        self._stop_event.set()
+
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, event_json):
+        """
+        Queue a parsed event for writing, returns False if the queue is full and the event was dropped.
+        """
+
+        try:
+            self._queue.put_nowait(event_json)
+        except queue.Full:
+            with self._stats_lock:
+                self._dropped_count += 1
+            return False
+
+        with self._stats_lock:
+            self._received_count += 1
+
+        return True
+
+    def stats(self):
+        """
+        Return the current queue depth, flush latency and event counters.
+        """
+
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "received": self._received_count,
+                "dropped": self._dropped_count,
+                "inserted": self._inserted_count,
+                "failed": self._failed_count,
+                "flushes": self._flush_count,
+                "last_flush_latency_ms": round(self._last_flush_latency * 1000, 3),
+                "max_flush_latency_ms": round(self._max_flush_latency * 1000, 3),
+            }
+
+    def _run(self):
         """
-        Commit the provided Event JSON to the database.
+        Collect events into batches and flush them when the batch is full or the interval elapses.
         """
 
-        # Connect to the MongoDB instance
-        db_client = pymongo.MongoClient(f"mongodb://{self.__db_address}/",
-                                        username=self.__db_username,
-                                        password=self.__db_password)
+        next_report = time.monotonic() + self.stats_interval
+
+        while not self._stop_event.is_set() or not self._queue.empty():
+
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
 
-        # Use the 'commandcenter' database
-        command_center_db = db_client["commandcenter"]
+            # Fill the batch until it is full or the flush interval runs out
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
 
-        # Use the 'events' collection from the 'commandcenter' database
-        command_center_events = command_center_db["events"]
+                if timeout <= 0:
+                    break
 
-        # Store the event in the database
-        db_record = command_center_events.insert_one(event_json)
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
 
-        print(f"Inserted Firepower event at MongoDB ID {db_record.inserted_id}")
+            if batch:
+                self._flush(batch)
+
+            # Periodically report the pipeline stats
+            if self.stats_interval and time.monotonic() >= next_report:
+                print(f"Firepower writer stats: {json.dumps(self.stats())}")
+                next_report = time.monotonic() + self.stats_interval
+
+    def _flush(self, batch):
+        """
+        Write a batch of events to the database with a single unordered insert.
+        """
+
+        start_time = time.perf_counter()
+
+        try:
+            self._events_collection.insert_many(batch, ordered=False)
+            inserted_events = batch
+        except BulkWriteError as error:
+            # Unordered inserts carry on past bad documents, so only leave out the ones that failed
+            failed_indexes = {write_error["index"] for write_error in error.details.get("writeErrors", [])}
+            inserted_events = [event for (index, event) in enumerate(batch) if index not in failed_indexes]
+            print(f"Firepower batch insert had {len(failed_indexes)} write errors")
+        except PyMongoError as error:
+            inserted_events = []
+            print(f"Firepower batch insert failed: {error}")
+
+        inserted_count = len(inserted_events)
+
+        # Count the stored events into the 5-minute rollups
+        try:
+            event_store.update_event_counts(self._event_counts_collection, inserted_events)
+        except PyMongoError as error:
+            print(f"Firepower event count update failed: {error}")
+
+        # Add the stored events to their hosts' summaries
+        try:
+            event_store.update_hosts(self._hosts_collection, inserted_events)
+        except PyMongoError as error:
+            print(f"Firepower host summary update failed: {error}")
+
+        flush_latency = time.perf_counter() - start_time
+
+        with self._stats_lock:
+            self._inserted_count += inserted_count
+            self._failed_count += len(batch) - inserted_count
+            self._flush_count += 1
+            self._last_flush_latency = flush_latency
+            self._max_flush_latency = max(self._max_flush_latency, flush_latency)
+
+        print(f"Inserted {inserted_count} of {len(batch)} Firepower events in {flush_latency * 1000:.1f} ms")
+
+
+class FirepowerSyslogServer(socketserver.UDPServer):
+    """
+    A UDP server that shares one parser and one event writer across all packets.
+    """
+
+    def __init__(self, server_address, handler_class, event_writer, reuse_port=False, receive_buffer_size=None):
+        self.event_parser = FirepowerSyslogHandler()
+        self.event_writer = event_writer
+        self.reuse_port = reuse_port
+        self.receive_buffer_size = receive_buffer_size
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        """
+        Apply the socket options before binding.
+        """
+
+        # Let several receiver processes bind the same port so the kernel spreads datagrams across them
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # A larger receive buffer absorbs bursts while the handler is busy
+        if self.receive_buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
+        super().server_bind()
 
 
 class SyslogHandler(socketserver.BaseRequestHandler):
@@ -117,24 +327,85 @@ class SyslogHandler(socketserver.BaseRequestHandler):
 
         print(f"{self.client_address[0]} sent the following: {self.data}")
 
-        event_parser = FirepowerSyslogHandler()
-
         # Try to parse the event data
-        event_json = event_parser._parse_event(self.data)
+        event_json = self.server.event_parser._parse_event(self.data)
 
         # If the event was parsed
         if event_json:
 
-            # Store the event
-            event_parser._commit_to_db(event_json)
+            # Queue the event for the next batch write
+            self.server.event_writer.submit(event_json)
 
 
-if __name__ == "__main__":
+def build_event_writer():
+    """
+    Build a batched event writer from the environment.
+    """
+
+    return FirepowerEventWriter(batch_size=int(os.getenv("FIREPOWER_BATCH_SIZE", "500")),
+                                flush_interval=float(os.getenv("FIREPOWER_FLUSH_INTERVAL", "1.0")),
+                                max_queue_size=int(os.getenv("FIREPOWER_QUEUE_SIZE", "10000")),
+                                stats_interval=int(os.getenv("FIREPOWER_STATS_INTERVAL", "60")))
+
+
+def run_receiver(server_address=("0.0.0.0", 4514), reuse_port=False, receive_buffer_size=None):
+    """
+    Run one syslog receiver with its own event writer until interrupted.
+    """
+
+    # The writer owns a MongoClient, so every receiver process builds its own after the fork
+    event_writer = build_event_writer()
+    event_writer.start()
 
     try:
-        server = socketserver.UDPServer(("0.0.0.0", 4514), SyslogHandler)
+        server = FirepowerSyslogServer(server_address, SyslogHandler, event_writer,
+                                       reuse_port=reuse_port,
+                                       receive_buffer_size=receive_buffer_size)
         server.serve_forever()
     except (IOError, SystemExit):
         raise
+    except KeyboardInterrupt:
+        print(f"Crtl+C Pressed. Shutting down receiver {os.getpid()}.")
+    finally:
+        # Write out anything still queued
+        event_writer.stop()
+
+
+def run_receivers(process_count, server_address=("0.0.0.0", 4514), receive_buffer_size=None):
+    """
+    Run several receiver processes bound to the same port with SO_REUSEPORT.
+    """
+
+    receivers = []
+
+    for _ in range(process_count):
+        receiver = multiprocessing.Process(target=run_receiver,
+                                           args=(server_address, True, receive_buffer_size))
+        receiver.start()
+        receivers.append(receiver)
+
+    print(f"Started {process_count} Firepower syslog receivers on {server_address[0]}:{server_address[1]}")
+
+    try:
+        for receiver in receivers:
+            receiver.join()
     except KeyboardInterrupt:
         print("Crtl+C Pressed. Shutting down.")
+
+        # The receivers got the same SIGINT, so give them a chance to flush
+        for receiver in receivers:
+            receiver.join()
+
+
+if __name__ == "__main__":
+
+    # The number of receiver processes, 0 means one per core
+    process_count = int(os.getenv("FIREPOWER_RECEIVER_PROCESSES") or 1) or os.cpu_count()
+
+    # The socket receive buffer in bytes, unset or empty keeps the OS default
+    receive_buffer_size = int(os.getenv("FIREPOWER_RECEIVE_BUFFER") or 0) or None
+
+    if process_count > 1:
+        run_receivers(process_count, receive_buffer_size=receive_buffer_size)
+    else:
+        run_receiver(receive_buffer_size=receive_buffer_size)
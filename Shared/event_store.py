@@ -0,0 +1,233 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module holds the event store helpers that every Cisco Command Center component shares
+
+The importers resume from checkpoints in 'importer_state' and keep the 5-minute rollups in 'event_counts' and the
+per-host summaries in 'hosts' up to date as they store events. The Web app reads and rebuilds the same documents.
+Each component is its own Docker image, so this file is copied into every image when it's built rather than
+installed as a package.
+"""
+
+import collections
+
+from datetime import datetime, timedelta
+
+import pymongo
+
+from pymongo.errors import BulkWriteError
+
+# The width of an 'event_counts' rollup
+BUCKET_MINUTES = 5
+
+# How many of a host's most recent events its summary keeps
+HOST_LATEST_EVENTS = 10
+
+# How long events are kept, the TTL on the 'events' collection set in mongo-init.js
+EVENT_RETENTION_SECONDS = 2678400
+
+
+def get_checkpoint(state_table, event_table, importer_name, product_name, get_event_id):
+    """Get an importer's high-water mark from the 'importer_state' collection"""
+
+    checkpoint = state_table.find_one({"_id": importer_name})
+
+    if checkpoint:
+        return checkpoint
+
+    # Installs from before checkpoints have none yet, so seed it once from the newest stored event
+    latest_event = event_table.find_one({"product": product_name}, sort=[("timestamp", -1)])
+
+    if latest_event:
+        return {"timestamp": latest_event["timestamp"], "last_ids": [get_event_id(latest_event)]}
+
+    return None
+
+
+def is_after_checkpoint(checkpoint, event_time, event_id):
+    """Check whether an event is past the high-water mark and so hasn't been imported yet"""
+
+    # Events sharing the high-water mark's timestamp are only new if their ID wasn't seen at that time
+    return event_time > checkpoint["timestamp"] or \
+        (event_time == checkpoint["timestamp"] and event_id not in checkpoint["last_ids"])
+
+
+def advance_checkpoint(checkpoint, event_time, event_id):
+    """Move the high-water mark forward past an imported event"""
+
+    if event_time > checkpoint["timestamp"]:
+        checkpoint["timestamp"] = event_time
+        checkpoint["last_ids"] = [event_id]
+
+    elif event_time == checkpoint["timestamp"] and event_id not in checkpoint["last_ids"]:
+        checkpoint["last_ids"].append(event_id)
+
+
+def save_checkpoint(state_table, importer_name, checkpoint):
+    """Store an importer's high-water mark, a single document update so it's atomic"""
+
+    state_table.update_one({"_id": importer_name},
+                           {"$set": {"timestamp": checkpoint["timestamp"],
+                                     "last_ids": checkpoint["last_ids"],
+                                     "updated_at": datetime.utcnow()}},
+                           upsert=True)
+
+
+def insert_new_events(event_table, events):
+    """Insert a page of events, skipping any already stored, and return the ones that were inserted"""
+
+    try:
+        event_table.insert_many(events, ordered=False)
+        return events
+    except BulkWriteError as error:
+
+        # A cycle that failed before saving its checkpoint stored some of these already, anything else is a real error
+        write_errors = error.details.get("writeErrors", [])
+
+        if any(write_error["code"] != 11000 for write_error in write_errors):
+            raise
+
+        duplicate_indexes = {write_error["index"] for write_error in write_errors}
+
+        # An ID repeated within the page means two different events got the same one, which loses events
+        page_counts = collections.Counter(event["import_id"] for event in events)
+        collided_count = sum(1 for index in duplicate_indexes if page_counts[events[index]["import_id"]] > 1)
+
+        if collided_count:
+            print(f"WARNING: Dropped {collided_count} events whose import_id repeats another event on the page")
+
+        if len(duplicate_indexes) > collided_count:
+            print(f"Skipped {len(duplicate_indexes) - collided_count} events an earlier attempt at this cycle stored")
+
+        return [event for (index, event) in enumerate(events) if index not in duplicate_indexes]
+
+
+def bucket_start(timestamp):
+    """Get the start of the 5-minute bucket that a timestamp falls into"""
+
+    return timestamp - timedelta(minutes=timestamp.minute % BUCKET_MINUTES,
+                                 seconds=timestamp.second,
+                                 microseconds=timestamp.microsecond)
+
+
+def rollup_key(event):
+    """Get the (bucket, product, event name, source IP) rollup an event is counted in"""
+
+    return (bucket_start(event["timestamp"]), event["product"], event["event_name"], event.get("src_ip"))
+
+
+def increment_event_counts(count_table, counts):
+    """Apply a Counter of (bucket, product, event name, source IP) changes to the 'event_counts' collection"""
+
+    operations = [pymongo.UpdateOne({"bucket": bucket, "product": product, "event_name": event_name, "src_ip": src_ip},
+                                    {"$inc": {"count": count}},
+                                    upsert=True)
+                  for ((bucket, product, event_name, src_ip), count) in counts.items() if count]
+
+    if operations:
+        count_table.bulk_write(operations, ordered=False)
+
+
+def update_event_counts(count_table, events):
+    """Add stored events to the 5-minute rollups in the 'event_counts' collection"""
+
+    # Count the events per rollup so each rollup gets a single $inc
+    increment_event_counts(count_table, collections.Counter(rollup_key(event) for event in events))
+
+
+def move_event_counts(count_table, moved_events):
+    """Move updated events from the rollup of their stored time to the rollup of their new time
+
+    'moved_events' are (stored copy, new copy) pairs."""
+
+    counts = collections.Counter()
+
+    for (stored_event, event) in moved_events:
+        counts[rollup_key(stored_event)] -= 1
+        counts[rollup_key(event)] += 1
+
+    increment_event_counts(count_table, counts)
+
+
+def summary_key(name):
+    """Make a product or event name safe to use as a field name in a host summary"""
+
+    return str(name).replace("$", "\uff04").replace(".", "\uff0e")
+
+
+def summary_name(key):
+    """Turn a field name made by summary_key() back into the product or event name"""
+
+    return key.replace("\uff04", "$").replace("\uff0e", ".")
+
+
+def latest_event(event, event_id=None):
+    """Get the short form of an event that a host summary keeps in its latest events"""
+
+    return {"_id": event_id or event["_id"],
+            "product": event.get("product"),
+            "event_name": event.get("event_name"),
+            "timestamp": event.get("timestamp")}
+
+
+def update_hosts(host_table, events):
+    """Add stored events to the per-host summaries in the 'hosts' collection"""
+
+    # Group the events by host so each host gets a single update
+    host_events = collections.defaultdict(list)
+
+    for event in events:
+        if event.get("src_ip"):
+            host_events[event["src_ip"]].append(event)
+
+    operations = []
+
+    for (src_ip, events_for_host) in host_events.items():
+
+        # Count the events per product and per event name
+        increments = collections.Counter({"event_count": len(events_for_host)})
+        increments.update(f"product_counts.{summary_key(event['product'])}" for event in events_for_host)
+        increments.update(f"event_name_counts.{summary_key(event['event_name'])}" for event in events_for_host)
+
+        operations.append(pymongo.UpdateOne(
+            {"_id": src_ip},
+            {"$min": {"first_seen": min(event["timestamp"] for event in events_for_host)},
+             "$max": {"last_seen": max(event["timestamp"] for event in events_for_host)},
+             "$inc": dict(increments),
+             # Keep only the newest few events, however many the host has had
+             "$push": {"latest_events": {"$each": [latest_event(event) for event in events_for_host],
+                                         "$sort": {"timestamp": -1},
+                                         "$slice": HOST_LATEST_EVENTS}}},
+            upsert=True))
+
+    if operations:
+        host_table.bulk_write(operations, ordered=False)
+
+
+def move_host_events(host_table, moved_events):
+    """Bring the host summaries up to date with updated events, their counts are unchanged
+
+    'moved_events' are (stored copy, new copy) pairs, the stored copy gives the event's ID."""
+
+    operations = []
+
+    for (stored_event, event) in moved_events:
+
+        if not event.get("src_ip"):
+            continue
+
+        # Take the old copy out of the latest events first, the same field can't be pulled and pushed at once
+        operations.append(pymongo.UpdateOne({"_id": event["src_ip"]},
+                                            {"$max": {"last_seen": event["timestamp"]},
+                                             "$pull": {"latest_events": {"_id": stored_event["_id"]}}}))
+
+        operations.append(pymongo.UpdateOne(
+            {"_id": event["src_ip"]},
+            {"$push": {"latest_events": {"$each": [latest_event(event, stored_event["_id"])],
+                                         "$sort": {"timestamp": -1},
+                                         "$slice": HOST_LATEST_EVENTS}}}))
+
+    # In order, so each pull lands before its push
+    if operations:
+        host_table.bulk_write(operations, ordered=True)
@@ -5,6 +5,7 @@
 This module is used to import Cisco Stealthwatch events into Cisco Command Center
 """
 
+import concurrent.futures
 import json
 import os
 import time
@@ -17,8 +18,16 @@ from dotenv import load_dotenv
 from requests.auth import HTTPBasicAuth
 from requests.packages import urllib3
 
+import event_store
+
 load_dotenv()
 
+# The name of this importer's record in the 'importer_state' collection
+IMPORTER_NAME = "stealthwatch_event_importer"
+
+# The product name stored on this importer's events
+PRODUCT_NAME = "Stealthwatch"
+
 try:
     urllib3.disable_warnings()
 except:
@@ -84,26 +93,27 @@ def get_event_names():
         exit(1)
 
 
-def get_events(start_date=None, end_date=None):
-    """Get Stealthwatch Events"""
+def get_time_slices(start_datetime, end_datetime, slice_minutes):
+    """Split a time window into consecutive slices of at most 'slice_minutes'"""
+
+    slices = []
+    slice_start = start_datetime
+
+    while slice_start < end_datetime:
+        slice_end = min(slice_start + timedelta(minutes=slice_minutes), end_datetime)
+        slices.append((slice_start, slice_end))
+        slice_start = slice_end
+
+    return slices
+
+
+def run_search(start_datetime, end_datetime):
+    """Run one Stealthwatch security event search and return its results"""
 
     # Set the URL for the query to POST the filter and initiate the search
     url = f"https://{os.getenv('STEALTHWATCH_API_ADDRESS')}/sw-reporting/v1/tenants/{os.getenv('STEALTHWATCH_API_TENANT')}" \
            "/security-events/queries"
 
-    # If an end date is specified, use it, otherwise set it to now
-    if end_date is None:
-        # Set the current time as the end
-        end_datetime = datetime.utcnow()
-    else:
-        end_datetime = end_date
-
-    # If a start date is specified, use it, otherwise get the previous day
-    if start_date is None:
-        start_datetime = end_datetime - timedelta(days=1)
-    else:
-        start_datetime = start_date
-
     # Format the timestamps for Stealtwatch
     end_timestamp = end_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
     start_timestamp = start_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -124,19 +134,22 @@ def get_events(start_date=None, end_date=None):
 
     # If successfully able to initiate search, grab the search details
     if (response.status_code == 200):
-        print("Getting Event Query results. Please wait...")
         search = json.loads(response.content)["data"]["searchJob"]
         search_id = search["id"]
 
         # Set the URL to check the search status
         url = url + "/" + search_id
 
-        # While search status is not complete, check the status every second
+        # Poll quickly at first for short searches, then back off so long ones don't hammer the SMC
+        poll_interval = float(os.getenv("STEALTHWATCH_POLL_INITIAL_INTERVAL", "0.5"))
+        poll_max_interval = float(os.getenv("STEALTHWATCH_POLL_MAX_INTERVAL", "10"))
+
         while search["percentComplete"] != 100.0:
+            time.sleep(poll_interval)
             response = API_SESSION.request("GET", url, verify=False)
             search = json.loads(response.content)["data"]
-            print(f"{search['percentComplete']}% Complete...")
-            time.sleep(1)
+            print(f"{start_timestamp} to {end_timestamp}: {search['percentComplete']}% Complete...")
+            poll_interval = min(poll_interval * 1.5, poll_max_interval)
 
         # Set the URL to check the search results and get them
         url = f"https://{os.getenv('STEALTHWATCH_API_ADDRESS')}/sw-reporting/v1/tenants/{os.getenv('STEALTHWATCH_API_TENANT')}" \
@@ -145,36 +158,116 @@ def get_events(start_date=None, end_date=None):
         response = API_SESSION.request("GET", url, verify=False)
 
         # Return the results
-        return response.json()
+        return response.json()["data"]["results"]
 
-    # If unable to update the IPs for a given tag (host group)
+    # If unable to initiate the search
     else:
         print(f"An error has ocurred, while getting security events, with the following code {response.status_code}")
         exit(1)
 
 
-def get_existing_event(event_table, event):
-    """A function to search the database for an existing active event"""
+def get_events(start_date=None, end_date=None):
+    """Get Stealthwatch Events"""
+
+    # If an end date is specified, use it, otherwise set it to now
+    if end_date is None:
+        # Set the current time as the end
+        end_datetime = datetime.utcnow()
+    else:
+        end_datetime = end_date
+
+    # If a start date is specified, use it, otherwise get the previous day
+    if start_date is None:
+        start_datetime = end_datetime - timedelta(days=1)
+    else:
+        start_datetime = start_date
+
+    # Split the window so large windows and catch-up after downtime run as several smaller searches
+    time_slices = get_time_slices(start_datetime,
+                                  end_datetime,
+                                  int(os.getenv("STEALTHWATCH_QUERY_SLICE_MINUTES", "60")))
+
+    # Cap the searches in flight so the SMC isn't overwhelmed
+    max_concurrent_queries = int(os.getenv("STEALTHWATCH_MAX_CONCURRENT_QUERIES", "4"))
 
-    # Set up a query to look for an identical active event
-    active_event_query = {
-        "id": 0,
+    print(f"Getting Event Query results in {len(time_slices)} slices, {max_concurrent_queries} at a time. Please wait...")
+
+    results = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_queries) as executor:
+
+        searches = {executor.submit(run_search, slice_start, slice_end): (slice_start, slice_end)
+                    for (slice_start, slice_end) in time_slices}
+
+        # Merge each slice as soon as it finishes, events that span slices are collapsed later by identity
+        for search in concurrent.futures.as_completed(searches):
+            slice_results = search.result()
+            results.extend(slice_results)
+
+            (slice_start, slice_end) = searches[search]
+            print(f"Slice {slice_start} to {slice_end} returned {len(slice_results)} events")
+
+    return {"data": {"results": results}}
+
+
+def get_event_identity(event):
+    """A function to build the query that identifies a Stealthwatch event across updates"""
+
+    # An event keeps these fields while it's active and after it closes, so they identify it
+    return {
         "product": "Stealthwatch",
-        "firstActiveTime": event["firstActiveTime"],
         "securityEventType": event["securityEventType"],
+        "firstActiveTime": event["firstActiveTime"],
         "source": event["source"],
         "target": event["target"]
     }
 
-    # Get the event
-    event = event_table.find_one(active_event_query)
 
-    return event
+def get_event_id(event):
+    """Build an ID for a Stealthwatch event from its identity, active events all have an 'id' of 0"""
+
+    return f"{event['securityEventType']}|{event['firstActiveTime']}|" \
+           f"{event['source'].get('ipAddress')}|{event['target'].get('ipAddress')}"
+
+
+def ensure_indexes(event_table):
+    """Make sure the indexes behind the latest event lookup and the event upserts exist"""
+
+    # Same definition as the 'product_timestamp' index managed by the Web app
+    event_table.create_index([("product", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                             name="product_timestamp")
+
+    # Lets each upsert find its event without scanning, only Stealthwatch events carry these fields
+    event_table.create_index([("securityEventType", pymongo.ASCENDING), ("firstActiveTime", pymongo.ASCENDING)],
+                             name="stealthwatch_identity",
+                             partialFilterExpression={"product": "Stealthwatch"})
+
+
+def get_stored_events(event_table, identities, batch_size=500):
+    """Get the stored copies of the events with these identities, keyed the same way as the upserts"""
+
+    stored_events = {}
+
+    # Look them up a batch at a time, each identity is an equality match on the 'stealthwatch_identity' index
+    for batch_start in range(0, len(identities), batch_size):
+
+        batch = identities[batch_start:batch_start + batch_size]
+
+        for event in event_table.find({"$or": batch}, {"_id": 1, "timestamp": 1, "src_ip": 1, "product": 1,
+                                                         "event_name": 1, "securityEventType": 1,
+                                                         "firstActiveTime": 1, "source": 1, "target": 1}):
+            stored_events[json.dumps(get_event_identity(event), sort_keys=True)] = event
+
+    return stored_events
 
 
 def run():
     """Main function to get new Stealthwatch events and commit them to the MongoDB database"""
 
+    # Time the cycle and count the database round-trips it costs
+    cycle_start = time.perf_counter()
+    db_round_trips = 0
+
     # Connect to the MongoDB instance
     db_client = pymongo.MongoClient(f"mongodb://{os.getenv('MONGO_INITDB_ADDRESS')}/",
                                     username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
@@ -186,18 +279,28 @@ def run():
     # Use the 'events' collection from the 'commandcenter' database
     command_center_events = command_center_db["events"]
 
-    # Get the latest 'Stealthwatch' event
-    latest_event = command_center_events.find({"product": "Stealthwatch"}).sort("timestamp", -1)
+    # Make sure the latest event lookup and upserts are indexed
+    ensure_indexes(command_center_events)
+    db_round_trips += 2
 
-    # If there's no latest event, the Event collection is empty, so we create a timestamp to import from.
-    if latest_event.count():
-        latest_event = latest_event[0]
-    else:
+    # Use the 'importer_state' collection for this importer's checkpoint
+    command_center_state = command_center_db["importer_state"]
+
+    # Resume from the checkpoint, a single document read rather than a sort over every Stealthwatch event
+    checkpoint = event_store.get_checkpoint(command_center_state, command_center_events,
+                                            IMPORTER_NAME, PRODUCT_NAME, get_event_id)
+    db_round_trips += 1
+
+    # If there's no checkpoint, the Event collection is empty, so we create a timestamp to import from.
+    if not checkpoint:
         print("No events in database.  Setting latest_event timestamp to 1 days ago.")
         start_date = datetime.utcnow().replace(microsecond=0) + timedelta(-1)
-        latest_event = {"timestamp": start_date}
+        checkpoint = {"timestamp": start_date, "last_ids": []}
+
+    print("Latest Stealtwatch Event: ", checkpoint["timestamp"])
 
-    print("Latest Stealtwatch Event: ", latest_event["timestamp"])
+    # Compare events against where this cycle started, the checkpoint itself moves as events are stored
+    resume_point = {"timestamp": checkpoint["timestamp"], "last_ids": list(checkpoint["last_ids"])}
 
     # Log in to Stealtwatch
     login()
@@ -206,10 +309,13 @@ def run():
     event_names = get_event_names()
 
     # Get the latest Stealthwatch events
-    stealthwatch_events = get_events(latest_event["timestamp"])
+    stealthwatch_events = get_events(checkpoint["timestamp"])
 
     print("Total Events Returned: ", len(stealthwatch_events["data"]["results"]))
 
+    # The newest copy of each event, keyed on its identity so an event returned twice is only written once
+    upsert_events = {}
+
     # Iterate through all fetched events
     for event in stealthwatch_events["data"]["results"]:
 
@@ -219,13 +325,10 @@ def run():
         if event["securityEventType"] in [262, 310]:
             continue
 
-        # Check to see if there's an existing active event
-        existing_event = get_existing_event(command_center_events, event)
-
         current_event_time = datetime.strptime(event["lastActiveTime"], "%Y-%m-%dT%H:%M:%S.%f+0000")
-        latest_event_time = latest_event["timestamp"]
+        event_id = get_event_id(event)
 
-        if current_event_time > latest_event_time:
+        if event_store.is_after_checkpoint(resume_point, current_event_time, event_id):
 
             # Make common fields for the event
             (event["event_name"], event["event_details"]) = event_names[event["securityEventType"]]
@@ -240,19 +343,61 @@ def run():
             # Add the common fields to the event
             event.update(event_common_fields)
 
-            if existing_event:
+            identity = get_event_identity(event)
+            identity_key = json.dumps(identity, sort_keys=True)
+
+            # Slices finish in any order, so only keep this copy if it's newer than the one already kept
+            kept = upsert_events.get(identity_key)
+
+            if kept is None or event["timestamp"] > kept[1]["timestamp"]:
+                upsert_events[identity_key] = (identity, event)
+
+            event_store.advance_checkpoint(checkpoint, current_event_time, event_id)
+
+    events = [event for (_, event) in upsert_events.values()]
+
+    # Replace active events that were already stored and insert new ones, all in one bulk write
+    operations = [pymongo.ReplaceOne(identity, event, upsert=True) for (identity, event) in upsert_events.values()]
+
+    if operations:
+
+        # An active event's time moves on with each update, so read where it was counted before replacing it
+        stored_events = get_stored_events(command_center_events,
+                                          [identity for (identity, _) in upsert_events.values()])
+        db_round_trips += (len(upsert_events) + 499) // 500
+
+        result = command_center_events.bulk_write(operations, ordered=False)
+        db_round_trips += 1
+
+        # Only the upserted operations are new events, the rest were updates to active ones
+        inserted_events = [dict(events[index], _id=event_id) for (index, event_id) in result.upserted_ids.items()]
+
+        # Count the new events into the 5-minute rollups and their hosts' summaries
+        if inserted_events:
+            event_store.update_event_counts(command_center_db["event_counts"], inserted_events)
+            event_store.update_hosts(command_center_db["hosts"], inserted_events)
+            db_round_trips += 2
+
+        # Updated events that have moved on keep their rollups and host summaries in step with them
+        moved_events = [(stored_events[identity_key], event)
+                        for (identity_key, (_, event)) in upsert_events.items()
+                        if identity_key in stored_events and
+                        stored_events[identity_key]["timestamp"] != event["timestamp"]]
 
-                # Update the event in the database
-                x = command_center_events.replace_one({"_id": existing_event["_id"]}, event)
+        if moved_events:
+            event_store.move_event_counts(command_center_db["event_counts"], moved_events)
+            event_store.move_host_events(command_center_db["hosts"], moved_events)
+            db_round_trips += 2
 
-                print(f"Updated Stealthwatch Event ID {event['id']} at MongoDB ID {existing_event['_id']}")
+        print(f"Inserted {result.upserted_count} and updated {result.modified_count} Stealthwatch events")
 
-            else:
+        # Move the checkpoint past everything that was written
+        event_store.save_checkpoint(command_center_state, IMPORTER_NAME, checkpoint)
+        db_round_trips += 1
 
-                # Store the event in the database
-                x = command_center_events.insert_one(event)
+    print(f"Stealthwatch cycle took {time.perf_counter() - cycle_start:.2f} seconds "
+          f"and {db_round_trips} database round-trips for {len(operations)} events")
 
-                print(f"Inserted Stealthwatch Event ID {event['id']} at MongoDB ID {x.inserted_id}")
 
 ###################
 # !!! DO WORK !!! #
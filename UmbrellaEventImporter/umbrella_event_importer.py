@@ -5,6 +5,8 @@
 This script is used to import Cisco Umbrella events into Cisco Command Center
 """
 
+import collections
+import concurrent.futures
 import json
 import os
 import time
@@ -16,17 +18,30 @@ from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from requests.auth import HTTPBasicAuth
 
+import event_store
+
 load_dotenv()
 
+# The name of this importer's record in the 'importer_state' collection
+IMPORTER_NAME = "umbrella_event_importer"
+
+# The product name stored on this importer's events
+PRODUCT_NAME = "Umbrella"
+
+# The largest page the Umbrella reporting API returns
+PAGE_LIMIT = 500
 
-def get_events(start_date=None):
-    """Get Umbrella events from the specified start date."""
 
-    # Format the date for AMP
+def get_events(start_date=None, stop_date=None, page=1):
+    """Get one page of Umbrella events between the specified start and stop dates."""
+
+    # Format the dates for Umbrella
     start_date = int(start_date.replace(tzinfo=timezone.utc).timestamp())
+    stop_date = int(stop_date.replace(tzinfo=timezone.utc).timestamp())
 
     # Build the API URL
-    api_url = f"https://reports.api.umbrella.com/v1/organizations/{os.getenv('UMBRELLA_API_ORG_ID')}/security-activity?limit=500&start={start_date}"
+    api_url = f"https://reports.api.umbrella.com/v1/organizations/{os.getenv('UMBRELLA_API_ORG_ID')}/security-activity" \
+              f"?limit={PAGE_LIMIT}&start={start_date}&stop={stop_date}&page={page}"
 
     print(f"Fetching {api_url}")
 
@@ -35,12 +50,69 @@ def get_events(start_date=None):
 
     # Check to make sure the GET was successful
     if http_request.status_code == 200:
-        return http_request.json()
+        return http_request.json()["requests"]
     else:
         print(f"Umbrella Connection Failure - HTTP Return Code: {http_request.status_code}\nResponse: {http_request.text}")
         exit(1)
 
 
+def get_event_pages(start_date=None, stop_date=None):
+    """Yield every page of Umbrella events in order, fetching a few pages at a time."""
+
+    # How many pages to request at once
+    concurrent_pages = int(os.getenv("UMBRELLA_API_CONCURRENT_PAGES", "4"))
+
+    page = 1
+    previous_first_id = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrent_pages) as executor:
+
+        while True:
+
+            # Request the next window of pages together
+            requests_in_flight = [executor.submit(get_events, start_date, stop_date, page_number)
+                                  for page_number in range(page, page + concurrent_pages)]
+
+            # Hand pages over in order, a short page means there is nothing after it
+            for request_in_flight in requests_in_flight:
+                events = request_in_flight.result()
+
+                # Stop if the API hands back the same page again rather than paging forever
+                if events and get_event_id(events[0]) == previous_first_id:
+                    print("Umbrella returned a repeated page, stopping")
+                    return
+
+                if events:
+                    previous_first_id = get_event_id(events[0])
+                    yield events
+
+                if len(events) < PAGE_LIMIT:
+                    return
+
+            page += concurrent_pages
+
+
+def get_event_id(event):
+    """Build an ID for an Umbrella event, which has no ID of its own"""
+
+    return f"{event['datetime']}|{event.get('originId')}|{event.get('internalIp')}|{event.get('externalIp')}|" \
+           f"{event['destination']}"
+
+
+def ensure_indexes(event_table):
+    """Make sure the indexes behind the latest event lookup and the duplicate check exist"""
+
+    # Same definition as the 'product_timestamp' index managed by the Web app
+    event_table.create_index([("product", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                             name="product_timestamp")
+
+    # Rejects an event that is already stored, only events imported since checkpoints carry an 'import_id'
+    event_table.create_index([("product", pymongo.ASCENDING), ("import_id", pymongo.ASCENDING)],
+                             name="product_import_id",
+                             unique=True,
+                             partialFilterExpression={"import_id": {"$exists": True}})
+
+
 def run():
     """Main function to get new Umbrella events and commit them to the MongoDB database"""
 
@@ -55,55 +127,101 @@ def run():
     # Use the 'events' collection from the specified database
     command_center_events = command_center_db["events"]
 
-    # Get the count of Umbrella documents
-    event_count = command_center_events.count_documents({"product": "Umbrella"})
+    # Make sure the latest event lookup is indexed
+    ensure_indexes(command_center_events)
 
-    # If we have previous events, import from that point in time, otherwise, import the last day
-    if event_count:
+    # Use the 'importer_state' collection for this importer's checkpoint
+    command_center_state = command_center_db["importer_state"]
 
-        # Get the latest 'Umbrella' event
-        latest_event = command_center_events.find({"product": "Umbrella"}).sort("timestamp", -1)
-        latest_event = latest_event[0]
-    else:
+    # Resume from the checkpoint if there is one, otherwise, import the last day
+    checkpoint = event_store.get_checkpoint(command_center_state, command_center_events,
+                                            IMPORTER_NAME, PRODUCT_NAME, get_event_id)
+
+    if not checkpoint:
         print("No events in database.  Setting latest_event timestamp to 24 hours ago. (The maximum for Umbrella)")
         start_date = datetime.utcnow().replace(microsecond=0) + timedelta(hours=-24)
-        latest_event = {"timestamp": start_date}
+        checkpoint = {"timestamp": start_date, "last_ids": []}
+
+    print("Latest Umbrella Event: ", checkpoint["timestamp"])
+
+    # Compare events against where this cycle started, the checkpoint itself moves as events are stored
+    resume_point = {"timestamp": checkpoint["timestamp"], "last_ids": list(checkpoint["last_ids"])}
+
+    # Checkpoints from before events were numbered hold bare IDs, which were each the first of their kind
+    resume_point["last_ids"] += [f"{event_id}|1" for event_id in checkpoint["last_ids"] if event_id.count("|") == 4]
+
+    # Umbrella events have no ID of their own, and the same request can repeat within a millisecond, so number
+    # the repeats in the order the pages list them, a retried cycle reads the same pages and numbers them the same
+    occurrences = collections.Counter()
+
+    # Fix the end of the window so pages don't shift while new events arrive
+    stop_date = datetime.utcnow().replace(microsecond=0)
+
+    # Keep track of the pages and events stored this cycle
+    page_count = 0
+    inserted_count = 0
+
+    # Walk every page of the latest Umbrella events
+    for umbrella_events in get_event_pages(resume_point["timestamp"], stop_date):
+
+        page_count += 1
+
+        # The new events on this page
+        page_events = []
+
+        # Iterate through all fetched events
+        for event in umbrella_events:
+
+            current_event_time = datetime.strptime(event["datetime"], "%Y-%m-%dT%H:%M:%S.%fZ")
+            event_id = get_event_id(event)
+            occurrences[event_id] += 1
+            event_id = f"{event_id}|{occurrences[event_id]}"
+
+            if event_store.is_after_checkpoint(resume_point, current_event_time, event_id):
+
+                if event["internalIp"]:
+                    src_ip = event["internalIp"]
+                else:
+                    src_ip = event["externalIp"]
 
-    print("Latest Umbrella Event: ", latest_event["timestamp"])
+                # Make common fields for the event
+                event_common_fields = {
+                    "event_name": f"Umbrella {event['actionTaken']} Destination",
+                    "event_details": f"Umbrella {event['actionTaken']} the following destination: {event['destination']}",
+                    "product": "Umbrella",
+                    "src_ip": src_ip,
+                    "timestamp": current_event_time,
+                    "formatted_timestamp": current_event_time.strftime("%b %d, %Y %H:%M:%S UTC"),
+                    "import_id": event_id
+                }
 
-    # Get the latest Umbrella events
-    umbrella_events = get_events(latest_event["timestamp"])
+                # Add the common fields to the event
+                event.update(event_common_fields)
 
-    # Iterate through all fetched events
-    for event in umbrella_events["requests"]:
+                page_events.append(event)
+                event_store.advance_checkpoint(checkpoint, current_event_time, event_id)
 
-        current_event_time = datetime.strptime(event["datetime"], "%Y-%m-%dT%H:%M:%S.%fZ")
-        latest_event_time = latest_event["timestamp"]
+        if page_events:
 
-        if current_event_time > latest_event_time:
+            # Store the page in the database with a single insert, a retried page only adds what's missing
+            page_events = event_store.insert_new_events(command_center_events, page_events)
+            inserted_count += len(page_events)
 
-            if event["internalIp"]:
-                src_ip = event["internalIp"]
-            else:
-                src_ip = event["externalIp"]
+            # Count the new events into the 5-minute rollups
+            event_store.update_event_counts(command_center_db["event_counts"], page_events)
 
-            # Make common fields for the event
-            event_common_fields = {
-                "event_name": f"Umbrella {event['actionTaken']} Destination",
-                "event_details": f"Umbrella {event['actionTaken']} the following destination: {event['destination']}",
-                "product": "Umbrella",
-                "src_ip": src_ip,
-                "timestamp": current_event_time,
-                "formatted_timestamp": current_event_time.strftime("%b %d, %Y %H:%M:%S UTC")
-            }
+            # Add the new events to their hosts' summaries
+            event_store.update_hosts(command_center_db["hosts"], page_events)
 
-            # Add the common fields to the event
-            event.update(event_common_fields)
+    # Move the checkpoint past everything that was stored, pages come newest first so this waits for the last one,
+    # if the cycle fails before here the next one fetches the same pages and the duplicate check skips what's stored
+    if inserted_count:
+        event_store.save_checkpoint(command_center_state, IMPORTER_NAME, checkpoint)
 
-            # Store the event in the database
-            x = command_center_events.insert_one(event)
+    # How far the newest stored Umbrella event trails real time
+    lag = datetime.utcnow() - checkpoint["timestamp"]
 
-            print(x.inserted_id)
+    print(f"Inserted {inserted_count} Umbrella events from {page_count} pages, {lag.total_seconds():.0f} seconds behind")
 
 
 if __name__ == "__main__":
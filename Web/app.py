@@ -7,27 +7,43 @@ and the Vue.js frontend (/) for Cisco Command Center.
 """
 
 
+import base64
+import binascii
+import concurrent.futures
+import functools
+import itertools
 import json
 import os
 import pprint
+import socket
+import threading
 import time
 import uuid
-from bson.json_util import dumps
+import zlib
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import flask
 import pymongo
 import requests
-import xmltodict
 
 from dotenv import load_dotenv
 from flask import Flask, jsonify, make_response, render_template, request
 from flask_compress import Compress
 from flask_cors import CORS
 from modules import amp_client
+from modules import bson_json
+from modules import event_counts
+from modules import host_summaries
+from modules import ise_sessions
+from modules import mongo_indexes
+from modules import mongo_pool
 from modules import pxgrid_controller
+from modules import response_cache
+from modules import stealthwatch_stream
 from requests.auth import HTTPBasicAuth
+from xml.etree import ElementTree
 
 # Load the .env
 load_dotenv()
@@ -44,16 +60,72 @@ COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/xml', 'application/json', '
 COMPRESS_LEVEL = 6
 COMPRESS_MIN_SIZE = 500
 
+# The largest page of events a single request may ask for
+EVENTS_PAGE_MAX_LIMIT = 5000
+
+# The event fields that can be filtered on with several values and are counted by /api/events/facets
+EVENTS_FACET_FIELDS = ('product', 'event_name', 'src_ip')
+
+# How many source IPs /api/events/facets returns by default, and at most
+EVENTS_FACET_DEFAULT_TOP = 25
+EVENTS_FACET_MAX_TOP = 1000
+
+# The fields /api/hosts can sort on, and the largest page of hosts a single request may ask for
+HOSTS_SORT_FIELDS = ('last_seen', 'first_seen', 'event_count', 'src_ip')
+HOSTS_PAGE_DEFAULT_LIMIT = 100
+HOSTS_PAGE_MAX_LIMIT = 1000
+
+# How often each worker takes expired events out of the host summaries, in seconds
+HOSTS_EXPIRY_INTERVAL = int(os.getenv("HOSTS_EXPIRY_INTERVAL", "300"))
+
+# The most flows the SMC returns for one request, and how much of its response to parse at a time
+STEALTHWATCH_FLOWS_MAX_ROWS = 10000
+STEALTHWATCH_STREAM_CHUNK_SIZE = 64 * 1024
+
 # Instantiate the app
 app = Flask(__name__, static_folder="./frontend/dist/static", template_folder="./frontend/dist")
 app.config.from_object(__name__)
 
+# Let jsonify() handle ObjectIds and datetimes directly
+app.json_encoder = bson_json.BsonJSONEncoder
+
 # Enable Flask-Compress
 Compress(app)
 
 # Enable CORS
 CORS(app)
 
+# How many requests to the AMP, ISE and Stealthwatch APIs each worker lets wait at once, and for how long
+# (the rest of a gthread worker's threads are kept free for the event endpoints)
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("WEB_UPSTREAM_MAX_IN_FLIGHT", "48"))
+UPSTREAM_TIMEOUT = float(os.getenv("WEB_UPSTREAM_TIMEOUT", "60"))
+
+_upstream_slots = threading.BoundedSemaphore(UPSTREAM_MAX_IN_FLIGHT)
+
+
+def upstream_proxy(view):
+    """A decorator for routes that wait on an upstream API, so they can't take every thread in the worker"""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+
+        # Turn the request away rather than queue it behind the slow ones
+        if not _upstream_slots.acquire(blocking=False):
+            return json_service_unavailable("Too many upstream requests in progress, try again shortly")
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            _upstream_slots.release()
+            raise
+
+        # A streamed response is still reading from upstream after we return, so free the slot once it's sent
+        response.call_on_close(_upstream_slots.release)
+
+        return response
+
+    return wrapper
+
 
 # Sanity check route
 @app.route('/ping', methods=['GET'])
@@ -61,21 +133,43 @@ def ping_pong():
     return jsonify('pong!')
 
 
+@app.route('/api/health', methods=['GET'])
+def get_health():
+    """A function to check that the database is reachable through the shared client"""
+
+    # Ping MongoDB
+    mongodb_health = mongo_pool.health_check()
+
+    response_object = {
+        'status': mongodb_health['status'],
+        'mongodb': mongodb_health,
+    }
+
+    if mongodb_health['status'] == 'success':
+        return jsonify(response_object)
+    else:
+        return jsonify(response_object), 503
+
+
+@app.route('/api/admin/indexes', methods=['GET'])
+def get_admin_indexes():
+    """A function to report index usage on the events collection"""
+
+    response_object = {
+        'status': 'success',
+        'report': mongo_indexes.index_report(mongo_pool.get_database()),
+    }
+
+    return bson_json.jsonify(response_object)
+
+
 # Events Functions
 @app.route('/api/event/<event_id>', methods=['GET'])
 def get_event(event_id):
     """A function to retrieve an event from the database and return it as JSON"""
 
-    # Connect to the MongoDB instance
-    db_client = pymongo.MongoClient("mongodb://{}/".format(os.getenv("MONGO_INITDB_ADDRESS")),
-                                    username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
-                                    password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
-
-    # Use the 'commandcenter' database
-    command_center_db = db_client['commandcenter']
-
-    # Use the 'events' collection from the 'commandcenter' database
-    command_center_events = command_center_db['events']
+    # Use the 'events' collection from the shared MongoDB client
+    command_center_events = mongo_pool.get_collection('events')
 
     # Set up a basic query filter
     query_filter = {}
@@ -89,53 +183,52 @@ def get_event(event_id):
     # Make a human readable timestamp
     event['formatted_timestamp'] = event["timestamp"].strftime("%b %d, %Y %H:%M:%S UTC")
 
-    # Parse the bson event into json
-    event = json.loads(dumps(event))
-
     # Set up a response object
     response_object = {
         'status': 'success',
         'event': [event],
     }
 
-    return jsonify(response_object)
+    return bson_json.jsonify(response_object)
 
 
 @app.route('/api/events', methods=['GET'])
 def get_events():
-    """A function to retrieve events from the database and return them as JSON"""
+    """A function to retrieve events from the database and return them as JSON, or as streamed NDJSON"""
 
-    # Connect to the MongoDB instance
-    db_client = pymongo.MongoClient("mongodb://{}/".format(os.getenv("MONGO_INITDB_ADDRESS")),
-                                    username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
-                                    password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
+    # Use the 'events' collection from the shared MongoDB client
+    command_center_events = mongo_pool.get_collection('events')
 
-    # Use the 'commandcenter' database
-    command_center_db = db_client['commandcenter']
+    # Filter on the host, time range, products, event names and source IPs that were asked for
+    (query_filter, error) = _get_events_filter()
+    if error:
+        return json_bad_request(error)
 
-    # Use the 'events' collection from the 'commandcenter' database
-    command_center_events = command_center_db['events']
+    # If a page size is specified, then only return that many events.
+    limit = None
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            limit = 0
 
-    # Set up a basic query filter
-    query_filter = {}
+        if limit < 1 or limit > EVENTS_PAGE_MAX_LIMIT:
+            return json_bad_request("'limit' must be between 1 and {}".format(EVENTS_PAGE_MAX_LIMIT))
 
-    # If the host IP is specified, then only return those events.
-    if 'host_ip' in request.args:
-        query_filter['src_ip'] = request.args['host_ip']
+    # If a cursor is specified, then continue after the event it points to.
+    if 'after' in request.args:
+        cursor = _decode_events_cursor(request.args['after'])
 
-    # If a timeframe is specified, then use it.
-    if 'timeframe' in request.args:
-        timeframe = int(request.args['timeframe'])
-        query_date = datetime.utcnow().replace(microsecond=0) - timedelta(hours=timeframe)
-        query_filter['timestamp'] = {'$gte': query_date}
+        if cursor is None:
+            return json_bad_request("'after' is not a valid cursor")
 
-    # If a product is specified, then use it.
-    if 'product' in request.args:
-        query_filter['product'] = {'$eq': request.args['product']}
+        (cursor_timestamp, cursor_id) = cursor
 
-    # If an event name is specified, then use it.
-    if 'event_name' in request.args:
-        query_filter['event_name'] = {'$eq': request.args['event_name']}
+        # Keyset range on (timestamp, _id) so each page is an index seek rather than a skip
+        query_filter['$or'] = [
+            {'timestamp': {'$lt': cursor_timestamp}},
+            {'timestamp': cursor_timestamp, '_id': {'$lt': cursor_id}}
+        ]
 
     # Projection to return a subset of fields
     projection = {
@@ -146,42 +239,264 @@ def get_events():
         'timestamp': 1
     }
 
-    # Get the events
-    latest_events = command_center_events.find(query_filter, projection).sort('timestamp', -1)
+    # Get the events, newest first with the ID as a tie-breaker so pages never overlap
+    latest_events = command_center_events.find(query_filter, projection).sort([('timestamp', -1), ('_id', -1)])
+
+    # Fetch one extra event to find out whether there is another page
+    if limit:
+        latest_events = latest_events.limit(limit + 1)
+
+    # If streaming was requested, write events straight from the cursor instead of building a list
+    if _wants_ndjson():
+        return flask.Response(_generate_events_ndjson(latest_events, limit), mimetype='application/x-ndjson')
 
     # Set up a response object
     response_object = {
         'status': 'success',
         'events': [],
+        'next': None,
     }
 
     # Iterate through all events
-    for event in latest_events:
+    for (index, event) in enumerate(latest_events):
+
+        # If there is more than a page, point the next cursor at the last event on this page
+        if limit and index == limit:
+            response_object['next'] = _encode_events_cursor(last_event)
+            break
+
+        last_event = event
 
         # Make a human readable date if one doesn't exist - starting to do this on event import now
         if 'formatted_timestamp' not in event.keys():
             event['formatted_timestamp'] = event["timestamp"].strftime("%b %d, %Y %H:%M:%S UTC")
 
         # Append the event to the response
-        response_object['events'].append(json.loads(dumps(event)))
+        response_object['events'].append(event)
 
-    return jsonify(response_object)
+    return bson_json.jsonify(response_object)
 
 
-@app.route('/api/events-over-time', methods=['GET'])
-def get_events_over_time():
-    """A function to retrieve event counts from the database aggregated into intervals and return them as JSON"""
+def _get_events_filter():
+    """A function to build the events query filter from the request, returning (filter, error)"""
+
+    # Set up a basic query filter
+    query_filter = {}
+
+    # If a timeframe is specified, then use it.
+    if 'timeframe' in request.args:
+        timeframe = int(request.args['timeframe'])
+        query_date = datetime.utcnow().replace(microsecond=0) - timedelta(hours=timeframe)
+        query_filter['timestamp'] = {'$gte': query_date}
+
+    # If a start or end time is specified, then narrow the range to it.
+    for (argument, operator) in (('start', '$gte'), ('end', '$lt')):
+        if argument in request.args:
+            timestamp = _parse_utc_timestamp(request.args[argument])
+
+            if timestamp is None:
+                return (None, "'{}' must be an ISO 8601 timestamp".format(argument))
+
+            query_filter.setdefault('timestamp', {})
+
+            # Keep the later start when both a timeframe and a start are given
+            if operator in query_filter['timestamp']:
+                timestamp = max(timestamp, query_filter['timestamp'][operator])
+
+            query_filter['timestamp'][operator] = timestamp
+
+    # If products, event names or source IPs are specified, then only return events matching one of each.
+    for field in EVENTS_FACET_FIELDS:
+        values = request.args.getlist(field)
+
+        # The host pages ask for their host as 'host_ip'
+        if field == 'src_ip':
+            values += request.args.getlist('host_ip')
+
+        if len(values) == 1:
+            query_filter[field] = {'$eq': values[0]}
+        elif values:
+            query_filter[field] = {'$in': values}
+
+    return (query_filter, None)
+
+
+def _parse_utc_timestamp(value):
+    """A function to turn an ISO 8601 timestamp into a naive UTC datetime, or None if it is invalid"""
+
+    try:
+        timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+    # Events are stored in naive UTC
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return timestamp
+
+
+def _wants_ndjson():
+    """A function to check whether the client asked for newline-delimited JSON"""
+
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def _generate_events_ndjson(latest_events, limit=None):
+    """A generator that yields one JSON line per event, then a {"next": cursor} line if another page exists"""
+
+    last_event = None
+
+    for (index, event) in enumerate(latest_events):
+
+        # If there is more than a page, finish with a cursor to the next one
+        if limit and index == limit:
+            yield bson_json.dumps({'next': _encode_events_cursor(last_event)}) + '\n'
+            break
+
+        last_event = event
+
+        # Make a human readable date if one doesn't exist
+        if 'formatted_timestamp' not in event.keys():
+            event['formatted_timestamp'] = event["timestamp"].strftime("%b %d, %Y %H:%M:%S UTC")
+
+        yield bson_json.dumps(event) + '\n'
+
+
+def _encode_events_cursor(event):
+    """A function to build an opaque paging cursor from an event's timestamp and ID"""
+
+    cursor = {
+        't': event['timestamp'].isoformat(),
+        'id': str(event['_id'])
+    }
+
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def _decode_events_cursor(cursor):
+    """A function to turn a paging cursor back into a timestamp and ID, or None if it is invalid"""
+
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (datetime.fromisoformat(cursor['t']), ObjectId(cursor['id']))
+    except (binascii.Error, ValueError, KeyError, TypeError, InvalidId):
+        return None
+
+
+@app.route('/api/events/facets', methods=['GET'])
+def get_events_facets():
+    """A function to count events by product, event name and source IP in one aggregation"""
+
+    (query_filter, error) = _get_events_filter()
+    if error:
+        return json_bad_request(error)
+
+    # How many source IPs to return
+    try:
+        top = int(request.args.get('top', EVENTS_FACET_DEFAULT_TOP))
+    except ValueError:
+        top = 0
+
+    if top < 1 or top > EVENTS_FACET_MAX_TOP:
+        return json_bad_request("'top' must be between 1 and {}".format(EVENTS_FACET_MAX_TOP))
+
+    # Count from the 5-minute rollups unless an explicit start or end falls inside a bucket
+    timestamp_range = query_filter.pop('timestamp', {})
+
+    explicit_timestamps = [_parse_utc_timestamp(request.args[argument]) for argument in ('start', 'end')
+                           if argument in request.args]
+
+    # The raw events to count alongside the rollups, for a bucket the range only partly covers
+    leading_range = None
 
-    # Connect to the MongoDB instance
-    db_client = pymongo.MongoClient("mongodb://{}/".format(os.getenv("MONGO_INITDB_ADDRESS")),
-                                    username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
-                                    password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
+    if all(timestamp == event_counts.bucket_start(timestamp) for timestamp in explicit_timestamps):
+        collection_name = 'event_counts'
+        count = '$count'
 
-    # Use the 'commandcenter' database
-    command_center_db = db_client['commandcenter']
+        if timestamp_range:
+            query_filter['bucket'] = {operator: event_counts.bucket_start(timestamp)
+                                      for (operator, timestamp) in timestamp_range.items()}
 
-    # Use the 'events' collection from the 'commandcenter' database
-    command_center_events = command_center_db['events']
+        # A timeframe rarely starts on a bucket boundary, so count its first bucket from the events in range
+        start = timestamp_range.get('$gte')
+
+        if start is not None and start != event_counts.bucket_start(start):
+            next_bucket = event_counts.bucket_start(start) + timedelta(minutes=event_counts.BUCKET_MINUTES)
+
+            query_filter['bucket']['$gte'] = next_bucket
+            leading_range = {'$gte': start, '$lt': min(next_bucket, timestamp_range.get('$lt', next_bucket))}
+    else:
+        collection_name = 'events'
+        count = 1
+
+        if timestamp_range:
+            query_filter['timestamp'] = timestamp_range
+
+    # Each facet leaves out its own filter, so a selected product still shows the other products
+    facet_filters = {field: query_filter.pop(field) for field in EVENTS_FACET_FIELDS if field in query_filter}
+
+    facet_pipelines = {}
+
+    for field in EVENTS_FACET_FIELDS:
+
+        facet_pipeline = [
+            {'$match': {other_field: value for (other_field, value) in facet_filters.items() if other_field != field}},
+            {'$group': {'_id': '$' + field, 'count': {'$sum': count}}},
+            {'$sort': {'count': -1, '_id': 1}},
+        ]
+
+        if field == 'src_ip':
+            facet_pipeline.append({'$limit': top})
+
+        facet_pipelines[field] = facet_pipeline
+
+    # The total has every filter applied
+    facet_pipelines['total'] = [
+        {'$match': facet_filters},
+        {'$group': {'_id': None, 'count': {'$sum': count}}},
+    ]
+
+    pipeline = [{'$match': query_filter}]
+
+    # Shape the leading events like rollups of one, so the facets count both the same way
+    if leading_range is not None:
+        pipeline.append({'$unionWith': {
+            'coll': 'events',
+            'pipeline': [
+                {'$match': {'timestamp': leading_range}},
+                {'$project': {'product': 1, 'event_name': 1, 'src_ip': 1, 'count': {'$literal': 1}}},
+            ],
+        }})
+
+    pipeline.append({'$facet': facet_pipelines})
+
+    aggregated_facets = next(mongo_pool.get_collection(collection_name).aggregate(pipeline))
+
+    # Set up a response object
+    response_object = {
+        'status': 'success',
+        'source': collection_name,
+        'total': aggregated_facets['total'][0]['count'] if aggregated_facets['total'] else 0,
+        'facets': {},
+    }
+
+    for field in EVENTS_FACET_FIELDS:
+        response_object['facets'][field] = [{'name': facet['_id'], 'count': facet['count']}
+                                            for facet in aggregated_facets[field]]
+
+    return bson_json.jsonify(response_object)
+
+
+@app.route('/api/events-over-time', methods=['GET'])
+def get_events_over_time():
+    """A function to retrieve event counts from the 5-minute rollups and return them as JSON"""
+
+    # Use the 'event_counts' rollup collection from the shared MongoDB client
+    command_center_event_counts = mongo_pool.get_collection('event_counts')
 
     # Set up a basic query filter
     query_filter = {}
@@ -194,7 +509,7 @@ def get_events_over_time():
     if 'timeframe' in request.args:
         timeframe = int(request.args['timeframe'])
         query_date = datetime.utcnow().replace(microsecond=0) - timedelta(hours=timeframe)
-        query_filter['timestamp'] = {'$gte': query_date}
+        query_filter['bucket'] = {'$gte': event_counts.bucket_start(query_date)}
 
     # If a product is specified, then use it.
     if 'product' in request.args:
@@ -204,20 +519,10 @@ def get_events_over_time():
     if 'event_name' in request.args:
         query_filter['event_name'] = {'$eq': request.args['event_name']}
 
-    # Get the aggregated events
-    aggregated_events = command_center_events.aggregate([
+    # Sum the rollups for each bucket, this touches one document per bucket and key rather than per event
+    aggregated_events = command_center_event_counts.aggregate([
         {"$match": query_filter},
-        {"$group":
-            {"_id":
-                {"$toDate":
-                    {"$subtract": [
-                        {"$toLong": "$timestamp"},
-                        {"$mod": [
-                            {"$toLong": "$timestamp"},
-                            1000 * 60 * 5
-                        ]}
-                    ]}},
-                "count": {"$sum": 1}}},
+        {"$group": {"_id": "$bucket", "count": {"$sum": "$count"}}},
         {"$sort": {"_id": 1}}
     ])
 
@@ -231,13 +536,233 @@ def get_events_over_time():
     for event in aggregated_events:
 
         # Append the event to the response
-        response_object['event_counts'].append(json.loads(dumps(event)))
+        response_object['event_counts'].append(event)
 
-    return jsonify(response_object)
+    return bson_json.jsonify(response_object)
+
+
+# Hosts Functions
+@app.route('/api/hosts', methods=['GET'])
+def get_hosts():
+    """A function to retrieve a page of per-host summaries, sorted as requested, and return them as JSON"""
+
+    # Keep the counts in step with the events that have expired since the last check
+    expire_host_summaries()
+
+    # Use the 'hosts' summary collection from the shared MongoDB client
+    command_center_hosts = mongo_pool.get_collection('hosts')
+
+    # Sort on the last time each host was seen unless told otherwise
+    sort_field = request.args.get('sort', 'last_seen')
+    if sort_field not in HOSTS_SORT_FIELDS:
+        return json_bad_request("'sort' must be one of {}".format(", ".join(HOSTS_SORT_FIELDS)))
+
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        return json_bad_request("'order' must be 'asc' or 'desc'")
+
+    direction = pymongo.ASCENDING if order == 'asc' else pymongo.DESCENDING
+    comparison = '$gt' if order == 'asc' else '$lt'
+
+    # If a page size is specified, then use it.
+    try:
+        limit = int(request.args.get('limit', HOSTS_PAGE_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+
+    if limit < 1 or limit > HOSTS_PAGE_MAX_LIMIT:
+        return json_bad_request("'limit' must be between 1 and {}".format(HOSTS_PAGE_MAX_LIMIT))
+
+    # The host's IP is its ID, so sorting on it needs no tie-breaker
+    if sort_field == 'src_ip':
+        sort = [('_id', direction)]
+    else:
+        sort = [(sort_field, direction), ('_id', direction)]
+
+    query_filter = {}
+
+    # If a cursor is specified, then continue after the host it points to.
+    if 'after' in request.args:
+        cursor = _decode_hosts_cursor(request.args['after'], sort_field)
+
+        if cursor is None:
+            return json_bad_request("'after' is not a valid cursor")
+
+        (cursor_value, cursor_id) = cursor
+
+        # Keyset range on the sort field and ID, which the summary indexes serve in either direction
+        if sort_field == 'src_ip':
+            query_filter['_id'] = {comparison: cursor_id}
+        else:
+            query_filter['$or'] = [
+                {sort_field: {comparison: cursor_value}},
+                {sort_field: cursor_value, '_id': {comparison: cursor_id}}
+            ]
+
+    # Fetch one extra host to find out whether there is another page
+    hosts = command_center_hosts.find(query_filter).sort(sort).limit(limit + 1)
+
+    # Set up a response object
+    response_object = {
+        'status': 'success',
+        'hosts': [],
+        'next': None,
+    }
+
+    # Iterate through all hosts
+    for (index, host) in enumerate(hosts):
+
+        # If there is more than a page, point the next cursor at the last host on this page
+        if index == limit:
+            response_object['next'] = _encode_hosts_cursor(last_host, sort_field)
+            break
+
+        last_host = host
+
+        # Append the host to the response
+        response_object['hosts'].append(host_summaries.to_response(host))
+
+    return bson_json.jsonify(response_object)
+
+
+_host_expiry_due = 0.0
+_host_expiry_lock = threading.Lock()
+
+
+def expire_host_summaries():
+    """A function to start taking expired events out of the host summaries in the background, when it's due"""
+
+    global _host_expiry_due
+
+    # Only one check per interval in each worker, the page is served from the summaries as they are meanwhile
+    with _host_expiry_lock:
+        if time.monotonic() < _host_expiry_due:
+            return
+
+        _host_expiry_due = time.monotonic() + HOSTS_EXPIRY_INTERVAL
+
+    threading.Thread(target=_run_host_expiry, daemon=True).start()
+
+
+def _run_host_expiry():
+    """A function to take expired events out of the host summaries"""
+
+    try:
+        host_count = host_summaries.expire(mongo_pool.get_database())
+    except pymongo.errors.PyMongoError as error:
+        print("Unable to expire host summaries: {}".format(error))
+        return
+
+    if host_count:
+        print("Took expired events out of {} host summaries".format(host_count))
+
+
+def _encode_hosts_cursor(host, sort_field):
+    """A function to build an opaque paging cursor from a host summary's sort value and IP"""
+
+    value = host.get(sort_field) if sort_field != 'src_ip' else None
+
+    if isinstance(value, datetime):
+        value = value.isoformat()
+
+    cursor = {
+        'v': value,
+        'id': host['_id']
+    }
+
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def _decode_hosts_cursor(cursor, sort_field):
+    """A function to turn a hosts paging cursor back into a sort value and IP, or None if it is invalid"""
+
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value = cursor['v']
+
+        if sort_field in ('last_seen', 'first_seen'):
+            value = datetime.fromisoformat(value)
+        elif sort_field == 'event_count':
+            value = int(value)
+
+        return (value, str(cursor['id']))
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
 
 
 # AMP Functions
+_amp_client = None
+_amp_cache = None
+_amp_client_pid = None
+_amp_client_lock = threading.Lock()
+
+
+def get_amp_client():
+    """Returns the AMP API client for this worker, creating it on first use."""
+
+    global _amp_client, _amp_cache, _amp_client_pid
+
+    # The client's pooled connections can't be shared across a fork, so each gunicorn worker builds its own
+    if _amp_client is None or _amp_client_pid != os.getpid():
+
+        with _amp_client_lock:
+
+            if _amp_client is None or _amp_client_pid != os.getpid():
+
+                # Cache the slow-changing lookups, optionally in MongoDB so every worker shares them
+                if os.getenv("AMP_CACHE_SHARED") == "True":
+                    shared_collection = mongo_pool.get_collection("amp_cache")
+                else:
+                    shared_collection = None
+
+                cache = response_cache.ResponseCache(max_entries=int(os.getenv("AMP_CACHE_MAX_ENTRIES", "256")),
+                                                     shared_collection=shared_collection)
+
+                cache_ttls = {
+                    "groups": int(os.getenv("AMP_CACHE_GROUPS_TTL", "300")),
+                    "policies": int(os.getenv("AMP_CACHE_POLICIES_TTL", "300")),
+                    "computers": int(os.getenv("AMP_CACHE_COMPUTERS_TTL", "30")),
+                }
+
+                # Computers carry their isolation status, and an isolation change only clears the cache of the
+                # worker that made it, so only cache them when every worker shares the cache
+                if shared_collection is None:
+                    cache_ttls["computers"] = 0
+
+                _amp_client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
+                                                   api_key=os.getenv("AMP_API_KEY"),
+                                                   pool_size=int(os.getenv("AMP_API_POOL_SIZE", "10")),
+                                                   max_retries=int(os.getenv("AMP_API_MAX_RETRIES", "3")),
+                                                   backoff_factor=float(os.getenv("AMP_API_BACKOFF_FACTOR", "0.5")),
+                                                   timeout=float(os.getenv("AMP_API_TIMEOUT", "30")),
+                                                   page_size=int(os.getenv("AMP_API_PAGE_SIZE", "500")),
+                                                   page_workers=int(os.getenv("AMP_API_PAGE_WORKERS", "1")),
+                                                   cache=cache,
+                                                   cache_ttls=cache_ttls)
+                _amp_cache = cache
+                _amp_client_pid = os.getpid()
+
+    return _amp_client
+
+
+@app.route('/api/admin/amp-cache', methods=['GET'])
+def get_admin_amp_cache():
+    """A function to report the AMP response cache counters for this worker"""
+
+    # Make sure this worker's client and cache exist
+    get_amp_client()
+
+    response_object = {
+        'status': 'success',
+        'pid': os.getpid(),
+        'cache': _amp_cache.stats(),
+    }
+
+    return jsonify(response_object)
+
+
 @app.route('/api/amp/computer/<ip_address>', methods=['GET'])
+@upstream_proxy
 def get_amp_computer(ip_address):
     """A function to retrieve AMP computer data and return it as JSON"""
 
@@ -245,12 +770,14 @@ def get_amp_computer(ip_address):
     if not os.getenv("AMP_API_CLIENT_ID") or not os.getenv("AMP_API_KEY"):
         return json_no_content()
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Get the computers that have been at the internal IP
-    response = client.get_computers(internal_ip=ip_address)
+    try:
+        response = client.get_computers(internal_ip=ip_address)
+    except (amp_client.AmpError, requests.exceptions.RequestException) as error:
+        return json_bad_gateway("AMP computer lookup failed: {}".format(error))
 
     if response:
         # Return a JSON formatted response
@@ -260,6 +787,7 @@ def get_amp_computer(ip_address):
 
 
 @app.route('/api/amp/computer/<connector_guid>/group', methods=['POST'])
+@upstream_proxy
 def set_amp_computer_group(connector_guid):
     """A function to set the Group for a specific AMP computer"""
 
@@ -267,9 +795,8 @@ def set_amp_computer_group(connector_guid):
     if not os.getenv("AMP_API_CLIENT_ID") or not os.getenv("AMP_API_KEY"):
         return json_no_content()
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Patch the computer to change the group
     response = client.patch_computer(connector_guid=connector_guid, data=request.get_json())
@@ -278,10 +805,11 @@ def set_amp_computer_group(connector_guid):
         # Return a JSON formatted response
         return jsonify(response)
     else:
-        return json_no_content()
+        return json_bad_gateway("AMP group change failed")
 
 
 @app.route('/api/amp/groups', methods=['GET'])
+@upstream_proxy
 def get_amp_groups():
     """A function to get all groups from AMP"""
 
@@ -289,12 +817,14 @@ def get_amp_groups():
     if not os.getenv("AMP_API_CLIENT_ID") or not os.getenv("AMP_API_KEY"):
         return json_no_content()
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Get the groups that exist in AMP
-    response = client.get_groups()
+    try:
+        response = client.get_groups()
+    except (amp_client.AmpError, requests.exceptions.RequestException) as error:
+        return json_bad_gateway("AMP group lookup failed: {}".format(error))
 
     if response:
         # Return a JSON formatted response
@@ -304,12 +834,12 @@ def get_amp_groups():
 
 
 @app.route('/api/amp/computer/<connector_guid>/isolation', methods=['GET'])
+@upstream_proxy
 def get_amp_computer_isolation(connector_guid):
     """A function to get the AMP isolation status of a computer"""
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Get the AMP Isolation status
     response = client.get_isolation(guid=connector_guid)
@@ -322,12 +852,12 @@ def get_amp_computer_isolation(connector_guid):
 
 
 @app.route('/api/amp/computer/<connector_guid>/isolation', methods=['DELETE'])
+@upstream_proxy
 def delete_amp_computer_isolation(connector_guid):
     """A function to delete the AMP isolation status of a computer"""
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Delete the AMP Isolation status
     response = client.delete_isolation(guid=connector_guid, data=request.get_json())
@@ -340,12 +870,12 @@ def delete_amp_computer_isolation(connector_guid):
 
 
 @app.route('/api/amp/computer/<connector_guid>/isolation', methods=['PUT'])
+@upstream_proxy
 def put_amp_computer_isolation(connector_guid):
     """A function to put the AMP isolation status of a computer"""
 
-    # Create an AMP API Client
-    client = amp_client.AmpClient(client_id=os.getenv("AMP_API_CLIENT_ID"),
-                                  api_key=os.getenv("AMP_API_KEY"))
+    # Get this worker's AMP API Client
+    client = get_amp_client()
 
     # Put the AMP Isolation status
     response = client.put_isolation(guid=connector_guid, data=request.get_json())
@@ -359,6 +889,7 @@ def put_amp_computer_isolation(connector_guid):
 
 # Stealthwatch Functions
 @app.route('/api/stealthwatch/host-snapshot', methods=['GET'])
+@upstream_proxy
 def get_stealthwatch_host_snapshot():
     """A function to get host snapshots from Stealthwatch"""
 
@@ -370,28 +901,25 @@ def get_stealthwatch_host_snapshot():
     ):
         return json_no_content()
 
-    # Build the API URL
-    api_url = "https://{}/smc/swsService/hosts".format(os.getenv("STEALTHWATCH_API_ADDRESS"))
-
     # Get the XML that we'll send to Stealthwatch
     xml = _get_stealthwatch_host_snapshot_xml(request.args['host_ip'])
 
-    # Send the request to Stealthwatch
-    http_request = requests.post(api_url,
-                                 auth=HTTPBasicAuth(os.getenv("STEALTHWATCH_API_USERNAME"),
-                                                    os.getenv("STEALTHWATCH_API_PASSWORD")),
-                                 data=xml,
-                                 verify=False)
-
-    # Check to make sure the POST was successful
-    if http_request.status_code == 200:
+    try:
+        http_request = _stealthwatch_request('hosts', xml)
+    except (UpstreamError, requests.exceptions.RequestException) as error:
+        print(error)
+        return json_bad_gateway("Stealthwatch host snapshot request failed")
 
-        # Return JSON formatted flows
-        return jsonify(xmltodict.parse(http_request.text)['soapenc:Envelope']['soapenc:Body'])
+    # Parse the snapshot as it downloads rather than from one big string, nothing is sent until it's all read
+    try:
+        with http_request:
+            response = stealthwatch_stream.parse_body(http_request.iter_content(STEALTHWATCH_STREAM_CHUNK_SIZE))
+    except (requests.exceptions.RequestException, ElementTree.ParseError) as error:
+        print(error)
+        return json_bad_gateway("Stealthwatch host snapshot request failed")
 
-    else:
-        print('Stealthwatch Connection Failure - HTTP Return Code: {}\nResponse: {}'.format(http_request.status_code, http_request.text))
-        exit()
+    # Return the JSON formatted host snapshot
+    return jsonify(response)
 
 
 def _get_stealthwatch_host_snapshot_xml(host_ip):
@@ -415,6 +943,7 @@ def _get_stealthwatch_host_snapshot_xml(host_ip):
 
 
 @app.route('/api/stealthwatch/flows', methods=['GET'])
+@upstream_proxy
 def get_stealthwatch_flows():
     """A function to get recent flows from Stealthwatch"""
 
@@ -426,47 +955,41 @@ def get_stealthwatch_flows():
     ):
         return json_no_content()
 
-    # Build the API URL
-    api_url = "https://{}/smc/swsService/flows".format(os.getenv("STEALTHWATCH_API_ADDRESS"))
-
-    # Change the number of hours to milliseconds for Stealthwatch
-    duration = int(request.args['timeframe']) * 60 * 60 * 1000
-
-    # Get the XML that we'll send to Stealthwatch
-    xml = _get_stealthwatch_flows_xml(duration, request.args['host_ip'])
-
-    # Send the request to Stealthwatch
-    http_request = requests.post(api_url,
-                                 auth=HTTPBasicAuth(os.getenv("STEALTHWATCH_API_USERNAME"),
-                                                    os.getenv("STEALTHWATCH_API_PASSWORD")),
-                                 data=xml,
-                                 verify=False)
+    # Read the optional page size and field subset
+    (limit, fields, error) = _get_stealthwatch_flows_args()
+    if error:
+        return json_bad_request(error)
 
-    # Check to make sure the POST was successful
-    if http_request.status_code == 200:
+    flows = _iter_stealthwatch_flows(request.args['host_ip'], int(request.args['timeframe']), limit, fields)
 
-        response = xmltodict.parse(http_request.text)['soapenc:Envelope']['soapenc:Body']
+    # Read up to the first flow before answering, so a failure or an empty list can still change the status
+    try:
+        first_flow = next(flows, None)
+    except (UpstreamError, requests.exceptions.RequestException, ElementTree.ParseError) as error:
+        print(error)
+        return json_bad_gateway("Stealthwatch flows request failed")
 
-        if response['getFlowsResponse']['flow-list']:
-            # Return JSON formatted flows
-            return jsonify(response)
-        else:
-            return json_no_content()
+    if first_flow is None:
+        return json_no_content()
 
-    else:
-        print('Stealthwatch Connection Failure - HTTP Return Code: {}\nResponse: {}'.format(http_request.status_code, http_request.text))
-        exit()
+    # Stream the rest of the flows as a JSON array while they are parsed, a later failure aborts the response
+    return _streamed_json_response(stealthwatch_stream.json_array(
+        _abort_on_stealthwatch_stream_failure(itertools.chain([first_flow], flows))))
 
 
-def _get_stealthwatch_flows_xml(duration, host_ip):
+def _get_stealthwatch_flows_xml(duration, host_ip, max_rows=None):
     """A function to generate XML to fetch flows from Stealthwatch"""
 
+    # Ask for as many flows as the SMC will return unless told otherwise
+    if max_rows is None:
+        max_rows = STEALTHWATCH_FLOWS_MAX_ROWS
+
     # Build the XML
     return_xml = """<?xml version=\"1.0\" encoding=\"UTF-8\"?>
     <soapenc:Envelope xmlns:soapenc=\"http://schemas.xmlsoap.org/soap/envelope/\">
         <soapenc:Body>
             <getFlows>
-                <flow-filter max-rows=\"10000\" domain-id=\"{}\" remove-duplicates=\"true\" order-by=\"TOTAL_BYTES\" order-by-desc=\"true\" include-interface-data=\"false\">
+                <flow-filter max-rows=\"{}\" domain-id=\"{}\" remove-duplicates=\"true\" order-by=\"TOTAL_BYTES\" order-by-desc=\"true\" include-interface-data=\"false\">
                     <date-selection>
                         <time-window-selection duration=\"{}\"/>
                     </date-selection>
@@ -483,13 +1006,201 @@ def _get_stealthwatch_flows_xml(duration, host_ip):
                 </flow-filter>
             </getFlows>
         </soapenc:Body>
-    </soapenc:Envelope>""".format(os.getenv("STEALTHWATCH_API_TENANT"), duration, host_ip)
+    </soapenc:Envelope>""".format(max_rows, os.getenv("STEALTHWATCH_API_TENANT"), duration, host_ip)
 
     return return_xml
 
 
+def _stealthwatch_request(service, xml, timeout=None):
+    """A function to send a SOAP request to a Stealthwatch web service and return the response, still streaming"""
+
+    # Build the API URL
+    api_url = "https://{}/smc/swsService/{}".format(os.getenv("STEALTHWATCH_API_ADDRESS"), service)
+
+    # Threads aren't killed like a stuck sync worker was, so never wait on the SMC indefinitely
+    if timeout is None:
+        timeout = UPSTREAM_TIMEOUT
+
+    # Send the request to Stealthwatch, leaving the body to be read as it's parsed
+    http_request = requests.post(api_url,
+                                 auth=HTTPBasicAuth(os.getenv("STEALTHWATCH_API_USERNAME"),
+                                                    os.getenv("STEALTHWATCH_API_PASSWORD")),
+                                 data=xml,
+                                 verify=False,
+                                 timeout=timeout,
+                                 stream=True)
+
+    # Check to make sure the POST was successful
+    if http_request.status_code != 200:
+
+        # Read the error body before closing, a closed streamed response has nothing left to read
+        error_text = http_request.text
+        http_request.close()
+
+        raise UpstreamError('Stealthwatch Connection Failure - HTTP Return Code: {}\nResponse: {}'.format(
+            http_request.status_code, error_text))
+
+    return http_request
+
+
+def _iter_stealthwatch_flows(host_ip, timeframe, limit=None, fields=None, timeout=None):
+    """A generator that yields a host's flows from Stealthwatch as compact records while they are downloaded"""
+
+    # Change the number of hours to milliseconds for Stealthwatch, and ask for no more flows than we'll use
+    xml = _get_stealthwatch_flows_xml(timeframe * 60 * 60 * 1000, host_ip, limit or STEALTHWATCH_FLOWS_MAX_ROWS)
+
+    http_request = _stealthwatch_request('flows', xml, timeout=timeout)
+
+    # Closing the response also stops the download if we finish early
+    try:
+        yield from stealthwatch_stream.iter_flows(http_request.iter_content(STEALTHWATCH_STREAM_CHUNK_SIZE),
+                                                  limit=limit, fields=fields)
+    finally:
+        http_request.close()
+
+
+def _abort_on_stealthwatch_stream_failure(flows):
+    """A generator that passes flows on, and aborts the response if the download or parse fails part way"""
+
+    # The 200 and the first flows have already been sent, so re-raise to drop the connection before the chunked
+    # body's terminating chunk, a client then sees an incomplete response instead of a short but valid array
+    try:
+        yield from flows
+    except (requests.exceptions.RequestException, ElementTree.ParseError) as error:
+        print("Stealthwatch flows stream failed part way, aborting the response: {}".format(error))
+        raise
+
+
+def _get_stealthwatch_flows_args(prefix=''):
+    """A function to read the 'limit' and 'fields' flow arguments, returning (limit, fields, error)"""
+
+    limit = None
+    if prefix + 'limit' in request.args:
+        try:
+            limit = int(request.args[prefix + 'limit'])
+        except ValueError:
+            limit = 0
+
+        if limit < 1 or limit > STEALTHWATCH_FLOWS_MAX_ROWS:
+            return (None, None, "'{}limit' must be between 1 and {}".format(prefix, STEALTHWATCH_FLOWS_MAX_ROWS))
+
+    fields = None
+    if request.args.get(prefix + 'fields'):
+        fields = stealthwatch_stream.parse_fields(request.args[prefix + 'fields'])
+
+    return (limit, fields, None)
+
+
+def _streamed_json_response(chunks):
+    """A function to build a streamed JSON response, gzipped on the fly when the client accepts it"""
+
+    # Flask-Compress would read the whole stream to compress it, so compress each chunk as it goes instead
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return flask.Response(chunks, mimetype='application/json')
+
+    def generate_gzip():
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode())
+            if data:
+                yield data
+
+        yield compressor.flush()
+
+    response = flask.Response(generate_gzip(), mimetype='application/json')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    return response
+
+
 # ISE Functions
+_pxgrid_client = None
+_pxgrid_client_pid = None
+_pxgrid_client_lock = threading.Lock()
+
+
+def get_pxgrid_client():
+    """Returns the pxGrid client for this worker, creating it on first use."""
+
+    global _pxgrid_client, _pxgrid_client_pid
+
+    # The client's connections can't be shared across a fork, so each gunicorn worker builds its own
+    if _pxgrid_client is None or _pxgrid_client_pid != os.getpid():
+
+        with _pxgrid_client_lock:
+
+            if _pxgrid_client is None or _pxgrid_client_pid != os.getpid():
+
+                _pxgrid_client = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
+                                                                 os.getenv("ISE_PXGRID_CLIENT_NAME"),
+                                                                 os.getenv("ISE_PXGRID_CERT_PATH"),
+                                                                 os.getenv("ISE_PXGRID_KEY_PATH"),
+                                                                 cache_ttl=int(os.getenv("ISE_PXGRID_CACHE_TTL",
+                                                                                         "300")))
+                _pxgrid_client_pid = os.getpid()
+
+    return _pxgrid_client
+
+
+_session_index = None
+_session_index_pid = None
+_session_index_lock = threading.Lock()
+
+
+def get_session_index():
+    """Returns this worker's live ISE session index, starting its subscriber on first use."""
+
+    global _session_index, _session_index_pid
+
+    # The subscription is optional
+    if os.getenv("ISE_PXGRID_SUBSCRIBE") != "True" or not os.getenv("ISE_API_ADDRESS"):
+        return None
+
+    # Threads don't survive a fork, so each gunicorn worker runs its own subscriber
+    if _session_index is None or _session_index_pid != os.getpid():
+
+        with _session_index_lock:
+
+            if _session_index is None or _session_index_pid != os.getpid():
+
+                # Optionally write the sessions through to MongoDB for the other components
+                if os.getenv("ISE_SESSION_STORE_SHARED") == "True":
+                    collection = mongo_pool.get_collection("ise_sessions")
+                else:
+                    collection = None
+
+                session_index = ise_sessions.SessionIndex(collection=collection)
+
+                # The subscriber gets its own quiet client, the session snapshot is too large to log
+                pxgrid = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
+                                                         os.getenv("ISE_PXGRID_CLIENT_NAME"),
+                                                         os.getenv("ISE_PXGRID_CERT_PATH"),
+                                                         os.getenv("ISE_PXGRID_KEY_PATH"),
+                                                         cache_ttl=int(os.getenv("ISE_PXGRID_CACHE_TTL", "300")),
+                                                         debug=False)
+
+                ise_sessions.SessionSubscriber(pxgrid,
+                                               session_index,
+                                               reconnect_interval=int(os.getenv("ISE_PXGRID_RECONNECT_INTERVAL",
+                                                                                "5"))).start()
+
+                _session_index = session_index
+                _session_index_pid = os.getpid()
+
+    return _session_index
+
+
+@app.before_first_request
+def start_session_subscriber():
+    """A function to start following ISE sessions before the first host view asks for one"""
+
+    get_session_index()
+
+
 @app.route('/api/ise_actions', methods=['GET'])
+@upstream_proxy
 def get_ise_actions():
     """A function to get the ANC profiles from ISE"""
 
@@ -510,17 +1221,22 @@ def get_ise_actions():
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
     # Get ISE ANC Policies
-    http_request = requests.get(api_url, headers=headers, verify=False)
+    try:
+        http_request = requests.get(api_url, headers=headers, verify=False, timeout=UPSTREAM_TIMEOUT)
+    except requests.exceptions.RequestException as error:
+        print(error)
+        return json_bad_gateway("ISE ANC policy request failed")
 
     # Check to make sure the GET was successful
     if http_request.status_code == 200:
         return jsonify(http_request.json())
     else:
         print('ISE Connection Failure - HTTP Return Code: {}\nResponse: {}'.format(http_request.status_code, http_request.text))
-        exit()
+        return json_bad_gateway("ISE ANC policy request failed")
 
 
 @app.route('/api/ise_anc_status/<mac_address>', methods=['GET'])
+@upstream_proxy
 def get_ise_anc_assignment(mac_address):
     """A function to look up the ISE ANC assignment for a given MAC address"""
 
@@ -531,27 +1247,20 @@ def get_ise_anc_assignment(mac_address):
     ):
         return json_no_content()
 
-    pxgrid = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
-                                             os.getenv("ISE_PXGRID_CLIENT_NAME"),
-                                             os.getenv("ISE_PXGRID_CERT_PATH"),
-                                             os.getenv("ISE_PXGRID_KEY_PATH"))
+    # Get this worker's pxGrid client
+    pxgrid = get_pxgrid_client()
 
     # Check to see if the account is enabled
-    if pxgrid.account_activate()['accountState'] != 'ENABLED':
+    if not pxgrid.is_account_enabled():
         print("pxGrid Account is not enabled.")
         return '', 403
 
-    # Lookup the session service
-    service_lookup_response = pxgrid.service_lookup('com.cisco.ise.config.anc')
-
-    # Store the session service
-    session_service = service_lookup_response['services'][0]
-
-    # Build the URL to get session details
-    url = session_service['properties']['restBaseUrl'] + '/getEndpointByMacAddress'
+    # The service and operation to call, the client looks the service up and caches it
+    service_name = 'com.cisco.ise.config.anc'
+    operation = '/getEndpointByMacAddress'
 
     # Run the session query
-    pxgrid_response = pxgrid.send_rest_request(url, {"macAddress": mac_address})
+    pxgrid_response = pxgrid.send_service_request(service_name, operation, {"macAddress": mac_address})
 
     if pxgrid_response is not None:
         return jsonify(pxgrid_response)
@@ -560,6 +1269,7 @@ def get_ise_anc_assignment(mac_address):
 
 
 @app.route('/api/ise_anc_status', methods=['POST'])
+@upstream_proxy
 def set_ise_anc_assignment():
     """A function to set the ISE ANC assignment for a given MAC address"""
 
@@ -570,24 +1280,17 @@ def set_ise_anc_assignment():
     ):
         return json_no_content()
 
-    pxgrid = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
-                                             os.getenv("ISE_PXGRID_CLIENT_NAME"),
-                                             os.getenv("ISE_PXGRID_CERT_PATH"),
-                                             os.getenv("ISE_PXGRID_KEY_PATH"))
+    # Get this worker's pxGrid client
+    pxgrid = get_pxgrid_client()
 
     # Check to see if the account is enabled
-    if pxgrid.account_activate()['accountState'] != 'ENABLED':
+    if not pxgrid.is_account_enabled():
         print("pxGrid Account is not enabled.")
         return '', 403
 
-    # Lookup the session service
-    service_lookup_response = pxgrid.service_lookup('com.cisco.ise.config.anc')
-
-    # Store the session service
-    session_service = service_lookup_response['services'][0]
-
-    # Build the URL to get session details
-    url = session_service['properties']['restBaseUrl'] + '/applyEndpointByMacAddress'
+    # The service and operation to call, the client looks the service up and caches it
+    service_name = 'com.cisco.ise.config.anc'
+    operation = '/applyEndpointByMacAddress'
 
     # Get the POST data from the request
     post_data = request.get_json()
@@ -598,7 +1301,7 @@ def set_ise_anc_assignment():
     }
 
     # Run the session query
-    pxgrid_response = pxgrid.send_rest_request(url, pxgrid_data)
+    pxgrid_response = pxgrid.send_service_request(service_name, operation, pxgrid_data)
 
     if pxgrid_response is not None:
         return jsonify(pxgrid_response)
@@ -607,6 +1310,7 @@ def set_ise_anc_assignment():
 
 
 @app.route('/api/ise_anc_status/<mac_address>', methods=['DELETE'])
+@upstream_proxy
 def clear_ise_anc_assignment(mac_address):
     """A function to clear the ISE ANC assignment for a given MAC address"""
 
@@ -617,27 +1321,20 @@ def clear_ise_anc_assignment(mac_address):
     ):
         return json_no_content()
 
-    pxgrid = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
-                                             os.getenv("ISE_PXGRID_CLIENT_NAME"),
-                                             os.getenv("ISE_PXGRID_CERT_PATH"),
-                                             os.getenv("ISE_PXGRID_KEY_PATH"))
+    # Get this worker's pxGrid client
+    pxgrid = get_pxgrid_client()
 
     # Check to see if the account is enabled
-    if pxgrid.account_activate()['accountState'] != 'ENABLED':
+    if not pxgrid.is_account_enabled():
         print("pxGrid Account is not enabled.")
         return '', 403
 
-    # Lookup the session service
-    service_lookup_response = pxgrid.service_lookup('com.cisco.ise.config.anc')
-
-    # Store the session service
-    session_service = service_lookup_response['services'][0]
-
-    # Build the URL to get session details
-    url = session_service['properties']['restBaseUrl'] + '/clearEndpointByMacAddress'
+    # The service and operation to call, the client looks the service up and caches it
+    service_name = 'com.cisco.ise.config.anc'
+    operation = '/clearEndpointByMacAddress'
 
     # Run the session query
-    pxgrid_response = pxgrid.send_rest_request(url, {"macAddress": mac_address})
+    pxgrid_response = pxgrid.send_service_request(service_name, operation, {"macAddress": mac_address})
 
     if pxgrid_response is not None:
         return jsonify(pxgrid_response)
@@ -646,6 +1343,7 @@ def clear_ise_anc_assignment(mac_address):
 
 
 @app.route('/api/ise_session_data/<ip_address>', methods=['GET'])
+@upstream_proxy
 def get_ise_session_data(ip_address):
     """A function to look up the ISE session data for a given IP"""
 
@@ -656,27 +1354,77 @@ def get_ise_session_data(ip_address):
     ):
         return json_no_content()
 
-    pxgrid = pxgrid_controller.PxgridControl(os.getenv("ISE_API_ADDRESS"),
-                                             os.getenv("ISE_PXGRID_CLIENT_NAME"),
-                                             os.getenv("ISE_PXGRID_CERT_PATH"),
-                                             os.getenv("ISE_PXGRID_KEY_PATH"))
+    # Answer from the live session index while it is in step with ISE
+    session_index = get_session_index()
+
+    if session_index is not None and session_index.ready:
+
+        session = session_index.get_by_ip(ip_address)
+
+        if session is not None:
+            return jsonify(session)
+        else:
+            return json_no_content()
+
+    # Get this worker's pxGrid client
+    pxgrid = get_pxgrid_client()
 
     # Check to see if the account is enabled
-    if pxgrid.account_activate()['accountState'] != 'ENABLED':
+    if not pxgrid.is_account_enabled():
         print("pxGrid Account is not enabled.")
         return '', 403
 
-    # Lookup the session service
-    service_lookup_response = pxgrid.service_lookup('com.cisco.ise.session')
+    # The service and operation to call, the client looks the service up and caches it
+    service_name = 'com.cisco.ise.session'
+    operation = '/getSessionByIpAddress'
+
+    # Run the session query
+    pxgrid_response = pxgrid.send_service_request(service_name, operation, {"ipAddress": ip_address})
+
+    if pxgrid_response is not None:
+        return jsonify(pxgrid_response)
+    else:
+        return json_no_content()
 
-    # Store the session service
-    session_service = service_lookup_response['services'][0]
 
-    # Build the URL to get session details
-    url = session_service['properties']['restBaseUrl'] + '/getSessionByIpAddress'
+@app.route('/api/ise_session_data/mac/<mac_address>', methods=['GET'])
+@upstream_proxy
+def get_ise_session_data_by_mac(mac_address):
+    """A function to look up the ISE session data for a given MAC address"""
+
+    # Return HTTP 204 if not configured
+    if (
+        not os.getenv("ISE_API_ADDRESS") or
+        not os.getenv("ISE_PXGRID_CLIENT_NAME")
+    ):
+        return json_no_content()
+
+    # Answer from the live session index while it is in step with ISE
+    session_index = get_session_index()
+
+    if session_index is not None and session_index.ready:
+
+        session = session_index.get_by_mac(mac_address)
+
+        if session is not None:
+            return jsonify(session)
+        else:
+            return json_no_content()
+
+    # Get this worker's pxGrid client
+    pxgrid = get_pxgrid_client()
+
+    # Check to see if the account is enabled
+    if not pxgrid.is_account_enabled():
+        print("pxGrid Account is not enabled.")
+        return '', 403
+
+    # The service and operation to call, the client looks the service up and caches it
+    service_name = 'com.cisco.ise.session'
+    operation = '/getSessionByMacAddress'
 
     # Run the session query
-    pxgrid_response = pxgrid.send_rest_request(url, {"ipAddress": ip_address})
+    pxgrid_response = pxgrid.send_service_request(service_name, operation, {"macAddress": mac_address})
 
     if pxgrid_response is not None:
         return jsonify(pxgrid_response)
@@ -684,7 +1432,258 @@ def get_ise_session_data(ip_address):
         return json_no_content()
 
 
+# Host Context Functions
+HOST_CONTEXT_SOURCES = ('amp', 'ise', 'stealthwatch_flows', 'stealthwatch_host_snapshot')
+
+# The host page doesn't show the Stealthwatch host snapshot, so it is only fetched when asked for
+HOST_CONTEXT_DEFAULT_SOURCES = ('amp', 'ise', 'stealthwatch_flows')
+
+_host_context_executor = None
+_host_context_executor_pid = None
+_host_context_executor_lock = threading.Lock()
+
+
+def get_host_context_executor():
+    """Returns the thread pool that runs host context lookups for this worker, creating it on first use."""
+
+    global _host_context_executor, _host_context_executor_pid
+
+    # Threads don't survive a fork, so each gunicorn worker builds its own pool
+    if _host_context_executor is None or _host_context_executor_pid != os.getpid():
+
+        with _host_context_executor_lock:
+
+            if _host_context_executor is None or _host_context_executor_pid != os.getpid():
+
+                _host_context_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=int(os.getenv("HOST_CONTEXT_WORKERS", "16")),
+                    thread_name_prefix="host-context")
+                _host_context_executor_pid = os.getpid()
+
+    return _host_context_executor
+
+
+@app.route('/api/host/<ip_address>/context', methods=['GET'])
+@upstream_proxy
+def get_host_context(ip_address):
+    """A function to look a host up in AMP, ISE and Stealthwatch at the same time"""
+
+    # Optionally, only query some of the sources
+    if request.args.get('sources'):
+        sources = [source for source in request.args['sources'].split(',') if source]
+    else:
+        sources = list(HOST_CONTEXT_DEFAULT_SOURCES)
+
+    for source in sources:
+        if source not in HOST_CONTEXT_SOURCES:
+            return json_bad_request("Unknown source '{}'".format(source))
+
+    # Stealthwatch flow queries are limited to 24 hours
+    try:
+        timeframe = min(int(request.args.get('timeframe', '1')), 24)
+    except ValueError:
+        return json_bad_request("'timeframe' must be a number of hours")
+
+    # The flows can be trimmed the same way as from the flows endpoint
+    (flow_limit, flow_fields, error) = _get_stealthwatch_flows_args('flow_')
+    if error:
+        return json_bad_request(error)
+
+    # How long each source gets before we give up on it, the flow queries are the slowest
+    deadlines = {
+        'amp': float(os.getenv("HOST_CONTEXT_AMP_DEADLINE", "5")),
+        'ise': float(os.getenv("HOST_CONTEXT_ISE_DEADLINE", "5")),
+        'stealthwatch_flows': float(os.getenv("HOST_CONTEXT_STEALTHWATCH_DEADLINE", "20")),
+        'stealthwatch_host_snapshot': float(os.getenv("HOST_CONTEXT_STEALTHWATCH_DEADLINE", "20")),
+    }
+
+    # Each lookup's upstream timeout matches its deadline, so an abandoned lookup gives its pool thread back soon
+    lookups = {
+        'amp': lambda: _get_amp_host_context(ip_address, deadlines['amp']),
+        'ise': lambda: _get_ise_host_context(ip_address, deadlines['ise']),
+        'stealthwatch_flows': lambda: _get_stealthwatch_flows_host_context(ip_address, timeframe, flow_limit,
+                                                                           flow_fields, deadlines['stealthwatch_flows']),
+        'stealthwatch_host_snapshot': lambda: _get_stealthwatch_host_snapshot_host_context(
+            ip_address, deadlines['stealthwatch_host_snapshot']),
+    }
+
+    start_time = time.perf_counter()
+
+    response_object = {
+        'status': 'success',
+        'ip_address': ip_address,
+        'sources': {},
+    }
+
+    futures = {}
+
+    # Start every configured source at once
+    for source in sources:
+
+        if not _host_context_configured(source):
+            response_object['sources'][source] = {'status': 'not_configured', 'elapsed_ms': 0}
+            continue
+
+        futures[source] = get_host_context_executor().submit(_timed_host_context_lookup, lookups[source])
+
+    # Collect them in turn, each one only waits out what is left of its own deadline
+    for (source, future) in futures.items():
+
+        remaining = deadlines[source] - (time.perf_counter() - start_time)
+
+        try:
+            response_object['sources'][source] = future.result(timeout=max(remaining, 0))
+        except concurrent.futures.TimeoutError:
+            # Drop the lookup if it is still queued behind busy threads, a running one ends at its own timeout
+            future.cancel()
+            response_object['sources'][source] = {'status': 'timeout', 'elapsed_ms': deadlines[source] * 1000}
+
+        if response_object['sources'][source]['status'] in ('timeout', 'error'):
+            response_object['status'] = 'partial'
+
+    response_object['elapsed_ms'] = round((time.perf_counter() - start_time) * 1000, 1)
+
+    return jsonify(response_object)
+
+
+def _timed_host_context_lookup(lookup):
+    """A function to run one host context lookup and time it"""
+
+    start_time = time.perf_counter()
+
+    try:
+        data = lookup()
+
+        if data:
+            result = {'status': 'success', 'data': data}
+        else:
+            result = {'status': 'no_content'}
+
+    except (requests.exceptions.Timeout, socket.timeout):
+        result = {'status': 'timeout'}
+
+    except Exception as error:
+        print("Host context lookup failed: {}".format(error))
+        result = {'status': 'error', 'message': str(error)}
+
+    result['elapsed_ms'] = round((time.perf_counter() - start_time) * 1000, 1)
+
+    return result
+
+
+def _host_context_configured(source):
+    """A function to check that a host context source has the settings it needs"""
+
+    if source == 'amp':
+        return bool(os.getenv("AMP_API_CLIENT_ID") and os.getenv("AMP_API_KEY"))
+
+    if source == 'ise':
+        return bool(os.getenv("ISE_API_ADDRESS") and os.getenv("ISE_PXGRID_CLIENT_NAME"))
+
+    return bool(os.getenv("STEALTHWATCH_API_ADDRESS") and
+                os.getenv("STEALTHWATCH_API_USERNAME") and
+                os.getenv("STEALTHWATCH_API_PASSWORD"))
+
+
+def _get_amp_host_context(ip_address, timeout):
+    """A function to get the AMP computers that have been at an internal IP"""
+
+    return get_amp_client().get_computers(internal_ip=ip_address, timeout=timeout)
+
+
+def _get_ise_host_context(ip_address, timeout):
+    """A function to get the ISE session for an IP, and the ANC assignment for its MAC address"""
+
+    session_index = get_session_index()
+
+    pxgrid = get_pxgrid_client()
+
+    # Answer from the live session index while it is in step with ISE
+    if session_index is not None and session_index.ready:
+        session = session_index.get_by_ip(ip_address)
+
+    else:
+
+        if not pxgrid.is_account_enabled():
+            raise UpstreamError("pxGrid Account is not enabled.")
+
+        session = pxgrid.send_service_request('com.cisco.ise.session', '/getSessionByIpAddress',
+                                              {"ipAddress": ip_address}, timeout=timeout)
+
+    if not session:
+        return None
+
+    anc_status = None
+
+    # The ANC assignment is kept against the MAC address
+    if session.get('macAddress'):
+
+        if not pxgrid.is_account_enabled():
+            raise UpstreamError("pxGrid Account is not enabled.")
+
+        anc_status = pxgrid.send_service_request('com.cisco.ise.config.anc', '/getEndpointByMacAddress',
+                                                 {"macAddress": session['macAddress']}, timeout=timeout)
+
+    return {'session': session, 'anc_status': anc_status}
+
+
+def _get_stealthwatch_flows_host_context(ip_address, timeframe, limit, fields, timeout):
+    """A function to get a host's recent flows from Stealthwatch as compact records"""
+
+    return list(_iter_stealthwatch_flows(ip_address, timeframe, limit, fields, timeout=timeout))
+
+
+def _get_stealthwatch_host_snapshot_host_context(ip_address, timeout):
+    """A function to get a host snapshot from Stealthwatch"""
+
+    http_request = _stealthwatch_request('hosts', _get_stealthwatch_host_snapshot_xml(ip_address), timeout=timeout)
+
+    with http_request:
+        return stealthwatch_stream.parse_body(http_request.iter_content(STEALTHWATCH_STREAM_CHUNK_SIZE))
+
+
 # Helpers
+class UpstreamError(Exception):
+    """An upstream API answered with an error"""
+
+
+def json_bad_request(message):
+    """A function to return an HTTP 400 with an error message"""
+
+    response_object = {
+        'status': 'failure',
+        'message': message,
+    }
+
+    return jsonify(response_object), 400
+
+
+def json_bad_gateway(message):
+    """A function to return an HTTP 502 with an error message, for when an upstream API fails"""
+
+    response_object = {
+        'status': 'failure',
+        'message': message,
+    }
+
+    return jsonify(response_object), 502
+
+
+def json_service_unavailable(message):
+    """A function to return an HTTP 503 with an error message"""
+
+    response_object = {
+        'status': 'failure',
+        'message': message,
+    }
+
+    response = jsonify(response_object)
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+
+    return response
+
+
 def json_no_content():
     """A function to return an HTTP 204 with empty JSON"""
 
@@ -701,5 +1700,8 @@ def catch_all(path):
 
 if __name__ == '__main__':
 
+    # Gunicorn builds the managed indexes before starting its workers, the development server does it here
+    mongo_indexes.ensure_indexes(mongo_pool.get_database())
+
     # Run the webserver
     app.run(host='0.0.0.0')
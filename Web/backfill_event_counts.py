@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script rebuilds the 5-minute 'event_counts' rollups from the raw events
+
+Run it once after upgrading, or whenever the rollups need repairing. It's included in the Web image:
+
+    docker exec ccc_web python backfill_event_counts.py            # every retained event
+    docker exec ccc_web python backfill_event_counts.py --hours 24 # only the last day
+
+or from this directory outside of Docker:
+
+    PYTHONPATH=../Shared python backfill_event_counts.py
+"""
+
+import argparse
+import time
+
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from modules import event_counts
+from modules import mongo_indexes
+from modules import mongo_pool
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=int, default=None, help="only rebuild rollups for the last N hours")
+    args = parser.parse_args()
+
+    database = mongo_pool.get_database()
+
+    # The rollup upserts rely on the unique rollup index
+    mongo_indexes.ensure_indexes(database)
+
+    since = None
+    if args.hours:
+        since = datetime.utcnow() - timedelta(hours=args.hours)
+
+    start_time = time.perf_counter()
+    rollup_count = event_counts.backfill(database, since)
+
+    print("Rebuilt {} event count rollups in {:.1f} seconds".format(rollup_count, time.perf_counter() - start_time))
+
+
+if __name__ == "__main__":
+    main()
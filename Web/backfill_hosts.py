@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script rebuilds the per-host summaries in the 'hosts' collection from the raw events
+
+Run it once after upgrading, or whenever the summaries need repairing. Stop the importers first, events they
+store while it runs are left out of the rebuilt summaries and their updates to the old ones are lost. It's
+included in the Web image:
+
+    docker exec ccc_web python backfill_hosts.py
+
+or from this directory outside of Docker:
+
+    PYTHONPATH=../Shared python backfill_hosts.py
+"""
+
+import argparse
+import time
+
+from dotenv import load_dotenv
+
+from modules import host_summaries
+from modules import mongo_indexes
+from modules import mongo_pool
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    database = mongo_pool.get_database()
+
+    # The host list sorts on the summary indexes
+    mongo_indexes.ensure_indexes(database)
+
+    start_time = time.perf_counter()
+    host_count = host_summaries.backfill(database, mongo_indexes.HOSTS_INDEXES)
+
+    print("Rebuilt {} host summaries in {:.1f} seconds".format(host_count, time.perf_counter() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks /api/events latency with and without the shared MongoDB client
+
+It needs a reachable MongoDB configured through the usual .env variables.
+
+    PYTHONPATH=../Shared python benchmark_events_api.py --requests 500 --timeframe 24
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+import pymongo
+
+from dotenv import load_dotenv
+
+import app as command_center
+
+load_dotenv()
+
+# The clients built for the request in progress when every call gets its own
+_request_clients = []
+
+
+def _new_client_per_request():
+    """Mimics the old behaviour of building a MongoClient inside every route call."""
+
+    client = pymongo.MongoClient("mongodb://{}/".format(os.getenv("MONGO_INITDB_ADDRESS")),
+                                 username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
+                                 password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"))
+    _request_clients.append(client)
+
+    return client
+
+
+def _close_request_clients():
+    """Closes the clients built for the last request, so their sockets and monitor threads don't pile up."""
+
+    while _request_clients:
+        _request_clients.pop().close()
+
+
+def _time_requests(test_client, url, count, after_request=None):
+    """Calls the URL 'count' times and returns the per-request latencies in milliseconds."""
+
+    latencies = []
+
+    for _ in range(count):
+        start_time = time.perf_counter()
+        response = test_client.get(url)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        # Clean up outside the timed part, the old routes left their clients for the garbage collector
+        if after_request is not None:
+            after_request()
+
+        if response.status_code != 200:
+            raise SystemExit("Request failed with HTTP {}".format(response.status_code))
+
+    return latencies
+
+
+def _report(label, latencies):
+    """Prints p50/p99 for a list of latencies."""
+
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    print("{:<12} p50={:8.2f} ms  p99={:8.2f} ms  mean={:8.2f} ms".format(label,
+                                                                        statistics.median(latencies),
+                                                                        p99,
+                                                                        statistics.mean(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--timeframe", type=int, default=24)
+    args = parser.parse_args()
+
+    url = "/api/events?timeframe={}".format(args.timeframe)
+    test_client = command_center.app.test_client()
+
+    # Warm up so that the pooled run doesn't pay for the first connection
+    test_client.get(url)
+
+    pooled = _time_requests(test_client, url, args.requests)
+
+    # Swap the shared client for a factory that reconnects on every call
+    original_get_client = command_center.mongo_pool.get_client
+    command_center.mongo_pool.get_client = _new_client_per_request
+
+    try:
+        unpooled = _time_requests(test_client, url, args.requests, after_request=_close_request_clients)
+    finally:
+        command_center.mongo_pool.get_client = original_get_client
+        _close_request_clients()
+        command_center.mongo_pool.close_client()
+
+    _report("pooled", pooled)
+    _report("unpooled", unpooled)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks API response serialization on synthetic events
+
+It compares the old path (bson.json_util.dumps, json.loads, then json.dumps again) against the single pass
+encoder in modules/bson_json.py, with and without orjson, reporting CPU time and peak allocations.
+
+    python benchmark_json_encoder.py --events 100000
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+from bson.json_util import dumps as bson_dumps
+from bson.objectid import ObjectId
+
+from modules import bson_json
+
+PRODUCTS = ["AMP for Endpoints", "Firepower", "Stealthwatch", "Umbrella"]
+EVENT_NAMES = ["Threat Detected", "Umbrella Blocked Destination", "ET POLICY curl User-Agent Outbound",
+               "Suspect Data Hoarding", "Brute Force Login"]
+
+
+def _synthetic_events(count):
+    """Build events shaped like the /api/events projection."""
+
+    now = datetime.utcnow()
+    events = []
+
+    for index in range(count):
+        timestamp = now - timedelta(seconds=index)
+        events.append({
+            "_id": ObjectId(),
+            "event_name": random.choice(EVENT_NAMES),
+            "event_details": "Synthetic event {} for serialization benchmarking".format(index),
+            "product": random.choice(PRODUCTS),
+            "src_ip": "10.{}.{}.{}".format(random.randint(0, 255), random.randint(0, 255), random.randint(1, 254)),
+            "timestamp": timestamp,
+            "formatted_timestamp": timestamp.strftime("%b %d, %Y %H:%M:%S UTC"),
+        })
+
+    return events
+
+
+def _legacy(events):
+    """The previous route behaviour."""
+
+    return json.dumps({"status": "success", "events": [json.loads(bson_dumps(event)) for event in events]})
+
+
+def _stdlib_single_pass(events):
+    """The new encoder with orjson disabled."""
+
+    return json.dumps({"status": "success", "events": events}, default=bson_json.default, separators=(",", ":"))
+
+
+def _single_pass(events):
+    """The new encoder as the API uses it."""
+
+    return bson_json.dumps({"status": "success", "events": events})
+
+
+def _measure(label, serialize, events):
+    """Report CPU time and peak traced allocation for one serializer."""
+
+    # Time without tracemalloc, which slows allocation-heavy code a lot
+    start_cpu = time.process_time()
+    body = serialize(events)
+    cpu_seconds = time.process_time() - start_cpu
+
+    tracemalloc.start()
+    serialize(events)
+    (_, peak_bytes) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{:<22} cpu={:7.3f} s  peak_alloc={:8.1f} MiB  body={:8.1f} MiB".format(label,
+                                                                                 cpu_seconds,
+                                                                                 peak_bytes / 1048576,
+                                                                                 len(body) / 1048576))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    events = _synthetic_events(args.events)
+
+    # Both paths must produce the same document
+    assert json.loads(_legacy(events[:100])) == json.loads(_single_pass(events[:100]))
+
+    _measure("legacy (dumps+loads)", _legacy, events)
+    _measure("single pass (stdlib)", _stdlib_single_pass, events)
+
+    if bson_json.orjson is not None:
+        _measure("single pass (orjson)", _single_pass, events)
+    else:
+        print("orjson is not installed, skipping")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ export default new Vuex.Store({
   state: {
     errors: [],
     events: [],
+    eventsLoadId: 0,
+    eventsPageSize: 1000,
     loading: false,
     notification: null,
     timeframe: 24,
@@ -31,6 +33,12 @@ export default new Vuex.Store({
     SET_EVENTS(state, events) {
       state.events = events;
     },
+    APPEND_EVENTS(state, events) {
+      state.events = state.events.concat(events);
+    },
+    SET_EVENTS_LOAD_ID(state, loadId) {
+      state.eventsLoadId = loadId;
+    },
     SET_LOADING_STATUS(state, status) {
       state.loading = status;
     },
@@ -54,22 +62,51 @@ export default new Vuex.Store({
     setTimeframe(context, timeframe) {
       context.commit('SET_TIMEFRAME', timeframe);
     },
-    getEvents(context, hostIp) {
+    getEvents(context, filters = {}) {
       // Clear any existing timeout
       // context.commit('CLEAR_TIMEOUT');
 
       // Indicate that we're loading
       context.commit('SET_LOADING_STATUS', true);
 
-      // Get the event data
+      // Tag this load so that pages from an older load are ignored
+      const loadId = this.state.eventsLoadId + 1;
+      context.commit('SET_EVENTS_LOAD_ID', loadId);
+
+      // Get the event data a page at a time
       let path = `http://${window.location.hostname}:5000/api/events?timeframe=${this.state.timeframe}`;
-      if (hostIp) path = `${path}&host_ip=${encodeURIComponent(hostIp)}`;
+      path = `${path}&limit=${this.state.eventsPageSize}`;
+      if (filters.hostIp) path = `${path}&host_ip=${encodeURIComponent(filters.hostIp)}`;
+
+      // Let the API do the filtering, rather than downloading every event to filter here
+      if (filters.product) path = `${path}&product=${encodeURIComponent(filters.product)}`;
+      if (filters.eventName) path = `${path}&event_name=${encodeURIComponent(filters.eventName)}`;
+      if (filters.start) path = `${path}&start=${encodeURIComponent(filters.start.toISOString())}`;
+      if (filters.end) path = `${path}&end=${encodeURIComponent(filters.end.toISOString())}`;
       console.log(path);
-      axios.get(path, { timeout: 60000 })
-        .then((res) => {
-          context.commit('SET_EVENTS', res.data.events);
-          context.commit('SET_LOADING_STATUS', false);
-        })
+
+      const getPage = (cursor) => {
+        const pagePath = cursor ? `${path}&after=${encodeURIComponent(cursor)}` : path;
+
+        return axios.get(pagePath, { timeout: 60000 })
+          .then((res) => {
+            // A newer load has started, so drop this one
+            if (loadId !== this.state.eventsLoadId) return null;
+
+            if (cursor) {
+              context.commit('APPEND_EVENTS', res.data.events);
+            } else {
+              // Render as soon as the first page arrives
+              context.commit('SET_EVENTS', res.data.events);
+              context.commit('SET_LOADING_STATUS', false);
+            }
+
+            // Keep going until the API stops handing out cursors
+            return res.data.next ? getPage(res.data.next) : null;
+          });
+      };
+
+      getPage(null)
         .catch((error) => {
           console.error(error);
           context.commit('ADD_ERROR', { message: error });
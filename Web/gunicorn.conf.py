@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""This is the gunicorn configuration for Cisco Command Center
+
+The default 'gthread' profile runs a few workers with many threads each, so requests waiting on the AMP, ISE and
+Stealthwatch APIs only tie up a thread rather than a whole worker, and the event endpoints keep answering while
+slow upstream calls are in flight. WEB_WORKER_CLASS=sync restores the previous one request per worker behaviour.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load the .env, the app does the same once it's imported
+load_dotenv()
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:5000")
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+
+if worker_class == "gthread":
+    workers = int(os.getenv("WEB_WORKERS", "4"))
+    threads = int(os.getenv("WEB_THREADS", "64"))
+else:
+    workers = int(os.getenv("WEB_WORKERS", "10"))
+
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+
+
+def on_starting(server):
+    """Build any missing managed MongoDB indexes once, before the workers are started"""
+
+    # Imported here rather than at the top, the app's directory is on the path by the time gunicorn calls this
+    from modules import mongo_indexes
+    from modules import mongo_pool
+
+    try:
+        mongo_indexes.ensure_indexes(mongo_pool.get_database())
+    finally:
+        # The workers are forked from this process and build their own clients, so don't leave this one open
+        mongo_pool.close_client()
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script load tests the Web API while slow upstream calls are in flight
+
+It starts a mock SMC that takes --smc-delay seconds to answer each flow query, serves the app with gunicorn in
+each requested worker profile, and keeps --slow-requests flow queries open against it while timing /api/events
+every --interval seconds. Like benchmark_events_api.py it needs a reachable MongoDB configured through the usual
+.env variables. The mock SMC speaks HTTPS, any self-signed certificate will do:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -keyout stub.key -out stub.pem -days 30 -subj /CN=localhost
+    python load_test_upstream_proxy.py --cert stub.pem --key stub.key --profile sync --profile gthread
+"""
+
+import argparse
+import os
+import ssl
+import statistics
+import subprocess
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+FLOWS_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>'
+                  '<soapenc:Envelope xmlns:soapenc="http://schemas.xmlsoap.org/soap/envelope/"><soapenc:Body>'
+                  '<getFlowsResponse xmlns="http://www.lancope.com/sws/sws-service"><flow-list>'
+                  '<flow id="1" protocol="6" service="https" total-bytes="6600">'
+                  '<client ip-address="10.0.0.5" port="51000" bytes="1200" packets="10" country="XR"/>'
+                  '<server ip-address="93.184.216.34" port="443" bytes="5400" packets="12" country="US"/>'
+                  '</flow></flow-list></getFlowsResponse></soapenc:Body></soapenc:Envelope>').encode()
+
+
+class SlowSmcHandler(BaseHTTPRequestHandler):
+    """Answers every SOAP request with one flow, after the configured delay."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(FLOWS_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(FLOWS_RESPONSE)
+
+
+def _start_mock_smc(cert, key, delay):
+    """Start the mock SMC on a free port and return the port."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowSmcHandler)
+    server.daemon_threads = True
+    server.delay = delay
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=cert, keyfile=key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server.server_port
+
+
+def _start_web(args, profile, smc_port):
+    """Serve the app with gunicorn in a worker profile and wait until it answers."""
+
+    environment = dict(os.environ,
+                       WEB_WORKER_CLASS=profile,
+                       WEB_BIND="127.0.0.1:{}".format(args.port),
+                       STEALTHWATCH_API_ADDRESS="127.0.0.1:{}".format(smc_port),
+                       STEALTHWATCH_API_USERNAME="load-test",
+                       STEALTHWATCH_API_PASSWORD="load-test",
+                       STEALTHWATCH_API_TENANT="1")
+
+    web = subprocess.Popen(["gunicorn", "-c", "gunicorn.conf.py", args.app],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), env=environment,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            requests.get("http://127.0.0.1:{}/api/health".format(args.port), timeout=1)
+            return web
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+
+    web.terminate()
+    raise SystemExit("gunicorn didn't start in the '{}' profile".format(profile))
+
+
+def _hold_slow_requests(url, outcomes, lock, stopping):
+    """Keep one flow query open against the app until told to stop."""
+
+    while not stopping.is_set():
+
+        try:
+            outcome = str(requests.get(url, timeout=120).status_code)
+        except requests.exceptions.RequestException as error:
+            outcome = type(error).__name__
+
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        # Back off briefly when turned away, a browser would show the error rather than hammer the API
+        if outcome == "503":
+            stopping.wait(1)
+
+
+def _run_profile(args, profile, smc_port):
+    """Time /api/events while the slow flow queries are in flight, for one worker profile."""
+
+    web = _start_web(args, profile, smc_port)
+
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    outcomes = {}
+    lock = threading.Lock()
+    stopping = threading.Event()
+
+    try:
+        threads = [threading.Thread(target=_hold_slow_requests,
+                                    args=(base_url + "/api/stealthwatch/flows?host_ip=10.0.0.5&timeframe=1",
+                                          outcomes, lock, stopping),
+                                    daemon=True)
+                   for _ in range(args.slow_requests)]
+
+        for thread in threads:
+            thread.start()
+
+        # Let the slow requests take their workers or threads first
+        time.sleep(1)
+
+        latencies = []
+        failures = 0
+        end_time = time.monotonic() + args.duration
+
+        while time.monotonic() < end_time:
+
+            start_time = time.perf_counter()
+
+            try:
+                response = requests.get(base_url + "/api/events?timeframe=24&limit=100", timeout=args.events_timeout)
+                response.raise_for_status()
+                latencies.append((time.perf_counter() - start_time) * 1000)
+            except requests.exceptions.RequestException:
+                failures += 1
+
+            time.sleep(args.interval)
+
+        stopping.set()
+
+        # Take the counts before shutting down, which fails whatever is still in flight
+        with lock:
+            outcomes = dict(outcomes)
+
+    finally:
+        web.terminate()
+        web.wait()
+
+    if latencies:
+        latencies.sort()
+        print("{:<8} /api/events: {:>4} ok, {:>4} failed  p50={:8.1f} ms  p99={:8.1f} ms  max={:8.1f} ms".format(
+            profile, len(latencies), failures, statistics.median(latencies),
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], latencies[-1]))
+    else:
+        print("{:<8} /api/events: {:>4} ok, {:>4} failed".format(profile, 0, failures))
+
+    print("{:<8} flow queries: {}".format("", ", ".join("{} x {}".format(count, outcome)
+                                                          for (outcome, count) in sorted(outcomes.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--profile", action="append", choices=["sync", "gthread"],
+                        help="a gunicorn worker profile to test, may be given more than once")
+    parser.add_argument("--app", default="app:app", help="the WSGI app for gunicorn to serve")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--slow-requests", type=int, default=100)
+    parser.add_argument("--smc-delay", type=float, default=10.0)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--events-timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    smc_port = _start_mock_smc(args.cert, args.key, args.smc_delay)
+
+    for profile in args.profile or ["sync", "gthread"]:
+        _run_profile(args, profile, smc_port)
+
+
+if __name__ == "__main__":
+    main()
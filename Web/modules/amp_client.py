@@ -6,9 +6,17 @@ This is an API client for Cisco's AMP for Endpoints product.
 
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+
+class AmpError(Exception):
+    """AMP answered a request with an error, so a listing would be incomplete"""
 
 
 class AmpClient(object):
@@ -19,18 +27,61 @@ class AmpClient(object):
     __amp_client_id = None
     __amp_api_key = None
 
+    __session = None
+    __timeout = None
+    __page_size = None
+    __page_workers = None
+    __cache = None
+    __cache_ttls = None
+
     DEBUG = False
 
-    def __init__(self, fqdn="api.amp.cisco.com", client_id=None, api_key=None, debug=False):
+    # AMP answers 429 when the API rate limit is hit, these are worth retrying after a pause
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    # How long each cacheable lookup stays fresh, in seconds, groups and policies rarely change
+    DEFAULT_CACHE_TTLS = {"groups": 300, "policies": 300, "computers": 30}
+
+    def __init__(self, fqdn="api.amp.cisco.com", client_id=None, api_key=None, debug=False,
+                 pool_size=10, max_retries=3, backoff_factor=0.5, timeout=30, page_size=500, page_workers=1,
+                 cache=None, cache_ttls=None):
         """Initializes the AmpClient object."""
 
         self.__amp_fqdn = fqdn
         self.__amp_client_id = client_id
         self.__amp_api_key = api_key
+        self.__timeout = timeout
+        self.__page_size = page_size
+        self.__page_workers = page_workers
+        self.__cache = cache
+        self.__cache_ttls = dict(self.DEFAULT_CACHE_TTLS, **(cache_ttls or {}))
         self.DEBUG = debug
 
-    def get_computers(self, internal_ip=None, external_ip=None, group_guids=[], hostnames=[]):
-        """Get AMP Computers matching the specified criteria."""
+        # Retry idempotent methods with exponential backoff, honouring any Retry-After header from AMP
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=self.RETRY_STATUS_CODES,
+                      raise_on_status=False)
+
+        # One session keeps the TLS connections to AMP alive between requests
+        self.__session = requests.Session()
+        self.__session.auth = HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key)
+        self.__session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+
+    def close(self):
+        """Closes the pooled connections to AMP."""
+
+        self.__session.close()
+
+    def get_computers(self, internal_ip=None, external_ip=None, group_guids=[], hostnames=[], timeout=None):
+        """Get AMP Computers matching the specified criteria, 'timeout' overrides the client's for each request."""
+
+        return self._cached("computers", [internal_ip, external_ip, list(group_guids), list(hostnames)],
+                            lambda: list(self.iter_computers(internal_ip, external_ip, group_guids, hostnames,
+                                                             timeout=timeout)))
+
+    def iter_computers(self, internal_ip=None, external_ip=None, group_guids=[], hostnames=[], timeout=None):
+        """Iterate over the AMP Computers matching the specified criteria."""
 
         # Build the Computers URL
         url = "https://{}/v1/computers?".format(self.__amp_fqdn)
@@ -47,10 +98,8 @@ class AmpClient(object):
         for hostname in hostnames:
             url += "&hostname[]={}".format(hostname)
 
-        # Get the Computer data
-        response = self._get_paginated_data(url)
-
-        return response
+        # Get the Computer data a page at a time
+        return self._iter_paginated_data(url, timeout=timeout)
 
     def patch_computer(self, connector_guid=None, data=None):
         """Patch AMP Computer with the specified GUID and payload."""
@@ -60,12 +109,22 @@ class AmpClient(object):
 
         response = self._patch_request(url, data)
 
+        # The computer's group has changed
+        self.invalidate_cache("computers")
+
         return response
 
     def get_events(self, detection_sha256=None, application_sha256=None,
                    connector_guid=[], group_guid=[], start_date=None, event_type=[]):
         """Get AMP Events matching the specified criteria."""
 
+        return list(self.iter_events(detection_sha256, application_sha256,
+                                     connector_guid, group_guid, start_date, event_type))
+
+    def iter_events(self, detection_sha256=None, application_sha256=None,
+                    connector_guid=[], group_guid=[], start_date=None, event_type=[]):
+        """Iterate over the AMP Events matching the specified criteria."""
+
         # Build the Events URL
         url = "https://{}/v1/events?".format(self.__amp_fqdn)
 
@@ -87,10 +146,8 @@ class AmpClient(object):
         for type_id in event_type:
             url += "&event_type[]={}".format(type_id)
 
-        # Get the Event data
-        response = self._get_paginated_data(url)
-
-        return response
+        # Get the Event data a page at a time
+        return self._iter_paginated_data(url)
 
     def get_event_types(self):
         """Get the AMP Event Types."""
@@ -106,15 +163,18 @@ class AmpClient(object):
     def get_file_lists_application_blocking(self, names=[]):
         """Get the Application Blocking File Lists from AMP."""
 
+        return list(self.iter_file_lists_application_blocking(names))
+
+    def iter_file_lists_application_blocking(self, names=[]):
+        """Iterate over the Application Blocking File Lists from AMP."""
+
         # Build the Application Blocking File Lists URL
-        url = "https://{}/v1/file_lists/application_blocking".format(self.__amp_fqdn)
+        url = "https://{}/v1/file_lists/application_blocking?".format(self.__amp_fqdn)
 
         for name in names:
             url += "&name[]={}".format(name)
 
-        response = self._get_paginated_data(url)
-
-        return response
+        return self._iter_paginated_data(url)
 
     def get_group(self, guid=None):
         """Get a specific AMP Group."""
@@ -135,6 +195,11 @@ class AmpClient(object):
     def get_groups(self, name=None):
         """Get all AMP Groups with an optional 'name' filter."""
 
+        return self._cached("groups", [name], lambda: list(self.iter_groups(name)))
+
+    def iter_groups(self, name=None):
+        """Iterate over all AMP Groups with an optional 'name' filter."""
+
         # Build the Groups URL
         url = "https://{}/v1/groups?".format(self.__amp_fqdn)
 
@@ -143,9 +208,7 @@ class AmpClient(object):
             url += "&name={}".format(name)
 
         # Get all of the paginated Group data
-        response = self._get_paginated_data(url)
-
-        return response
+        return self._iter_paginated_data(url)
 
     def get_isolation(self, guid=None):
         """Get the isolation status for the specified GUID."""
@@ -176,6 +239,9 @@ class AmpClient(object):
             else:
                 response = self._delete_request(url)
 
+            # The computer's isolation state has changed
+            self.invalidate_cache("computers")
+
             return response
 
         else:
@@ -208,6 +274,9 @@ class AmpClient(object):
             # Get the Isolation data
             response = self._put_request(url, data)
 
+            # The computer's isolation state has changed
+            self.invalidate_cache("computers")
+
             return response
 
         else:
@@ -233,6 +302,11 @@ class AmpClient(object):
     def get_policies(self, name=None, product=None):
         """Get all AMP Policies with optional 'name' and 'product' filters."""
 
+        return self._cached("policies", [name, product], lambda: list(self.iter_policies(name, product)))
+
+    def iter_policies(self, name=None, product=None):
+        """Iterate over all AMP Policies with optional 'name' and 'product' filters."""
+
         # Build the Policies URL
         url = "https://{}/v1/policies?".format(self.__amp_fqdn)
 
@@ -245,9 +319,7 @@ class AmpClient(object):
             url += "&product={}".format(product)
 
         # Get all of the paginated Policy data
-        response = self._get_paginated_data(url)
-
-        return response
+        return self._iter_paginated_data(url)
 
     def get_version(self):
         """Get the version of the AMP API."""
@@ -263,6 +335,11 @@ class AmpClient(object):
     def get_vulnerabilities(self, start_time=None, end_time=None, group_guid=[], sha256=None):
         """Get Vulnerabilities that have been detected by AMP."""
 
+        return list(self.iter_vulnerabilities(start_time, end_time, group_guid, sha256))
+
+    def iter_vulnerabilities(self, start_time=None, end_time=None, group_guid=[], sha256=None):
+        """Iterate over the Vulnerabilities that have been detected by AMP."""
+
         # Build the Vulnerabilities URL
         if sha256:
             url = "https://{}/v1/vulnerabilities/{}/computers?".format(self.__amp_fqdn, sha256)
@@ -278,40 +355,95 @@ class AmpClient(object):
         for guid in group_guid:
             url += "&group_guid[]={}".format(guid)
 
-        # Get the Vulnerabilties data
-        response = self._get_paginated_data(url)
+        # Get the Vulnerabilties data a page at a time
+        return self._iter_paginated_data(url)
 
-        return response
+    def invalidate_cache(self, namespace):
+        """Drop cached responses for a lookup, if caching is enabled."""
+
+        if self.__cache is not None:
+            self.__cache.invalidate(namespace)
+
+    def _cached(self, namespace, arguments, fetch):
+        """Returns a lookup from the cache, or fetches and caches it."""
+
+        ttl = self.__cache_ttls.get(namespace, 0)
+
+        # A TTL of 0 turns caching off for that lookup
+        if self.__cache is None or ttl <= 0:
+            return fetch()
+
+        key = json.dumps(arguments, sort_keys=True)
+
+        (found, value) = self.__cache.get(namespace, key)
+
+        if found:
+            return value
+
+        value = fetch()
+
+        # Don't hold on to empty results either, so a computer that has only just appeared shows up at once
+        if value:
+            self.__cache.set(namespace, key, value, ttl)
+
+        return value
+
+    def _get_paginated_data(self, url=None, limit=None):
+        """Performs HTTP GET requests that return all paginated data."""
 
-    def _get_paginated_data(self, url=None, limit=10, offset=0):
-        """Performs an HTTP GET request that returns all paginated data."""
+        return list(self._iter_paginated_data(url, limit))
 
-        # A placeholder for looping
-        returned_results = limit
+    def _iter_paginated_data(self, url=None, limit=None, timeout=None):
+        """Performs HTTP GET requests that yield paginated data one item at a time."""
 
-        # A placeholder for return data
-        return_data = []
+        limit = limit or self.__page_size
 
-        # Loop through requests
-        while returned_results == limit:
+        # The first page also tells us how many items there are in total
+        response = self._get_page(url, limit, 0, timeout)
 
-            # Build the API URL
-            paginated_url = url + "&limit={}&offset={}".format(limit, offset)
+        yield from response["data"]
 
-            # Send the GET request
-            response = self._get_request(paginated_url)
+        if self.__page_workers > 1:
 
-            # Append all data to the return data
-            for item in response["data"]:
-                return_data.append(item)
+            # Fetch the remaining offsets a window at a time, so only one window of pages is held in memory
+            offsets = list(range(limit, response["metadata"]["results"]["total"], limit))
 
-            # Update the number of returned results
-            returned_results = response['metadata']['results']['current_item_count']
+            with ThreadPoolExecutor(max_workers=self.__page_workers) as executor:
 
-            # Increment the offset
-            offset += limit
+                for window_start in range(0, len(offsets), self.__page_workers):
 
-        return return_data
+                    window = offsets[window_start:window_start + self.__page_workers]
+
+                    # map() returns the pages in offset order
+                    for response in executor.map(lambda offset: self._get_page(url, limit, offset, timeout), window):
+                        yield from response["data"]
+
+        else:
+
+            offset = 0
+
+            # Keep going while AMP returns full pages
+            while response["metadata"]["results"]["current_item_count"] == limit:
+
+                offset += limit
+
+                response = self._get_page(url, limit, offset, timeout)
+
+                yield from response["data"]
+
+    def _get_page(self, url=None, limit=None, offset=0, timeout=None):
+        """Performs an HTTP GET request for one page of data, raising AmpError if AMP doesn't return it."""
+
+        # Build the API URL
+        paginated_url = url + "&limit={}&offset={}".format(limit, offset)
+
+        response = self._get_request(paginated_url, timeout)
+
+        # Stopping here quietly would hand back a partial listing as if it were complete
+        if response is None:
+            raise AmpError("AMP failed to return the page at offset {} of {}".format(offset, url))
+
+        return response
 
     def _delete_request(self, url=None, data=None):
         """Performs an HTTP DELETE request."""
@@ -320,7 +452,7 @@ class AmpClient(object):
             print("Delete URL: {}".format(url))
 
         # Perform the DELETE request
-        response = requests.delete(url, data=data, auth=HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key))
+        response = self.__session.delete(url, data=data, timeout=self.__timeout)
 
         # Check to see if the DELETE was successful
         if response.status_code >= 200 and response.status_code < 300:
@@ -336,14 +468,14 @@ class AmpClient(object):
                                                                                        response.text))
             return None
 
-    def _get_request(self, url=None):
+    def _get_request(self, url=None, timeout=None):
         """Performs an HTTP GET request."""
 
         if self.DEBUG:
             print("Get URL: {}".format(url))
 
         # Perform the GET request
-        response = requests.get(url, auth=HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key))
+        response = self.__session.get(url, timeout=timeout or self.__timeout)
 
         # Check to see if the GET was successful
         if response.status_code >= 200 and response.status_code < 300:
@@ -366,7 +498,7 @@ class AmpClient(object):
             print("Option URL: {}".format(url))
 
         # Perform the OPTIONS request
-        response = requests.options(url, auth=HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key))
+        response = self.__session.options(url, timeout=self.__timeout)
 
         # Check to see if the OPTIONS was successful
         if response.status_code >= 200 and response.status_code < 300:
@@ -389,7 +521,7 @@ class AmpClient(object):
             print("Patch URL: {}".format(url))
 
         # Perform the PATCH request
-        response = requests.patch(url, data, auth=HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key))
+        response = self.__session.patch(url, data, timeout=self.__timeout)
 
         # Check to see if the PATCH was successful
         if response.status_code >= 200 and response.status_code < 300:
@@ -403,7 +535,7 @@ class AmpClient(object):
         else:
             print("AMP Connection Failure.\nHTTP Return Code: {}\nResponse: {}".format(response.status_code,
                                                                                        response.text))
-            exit()
+            return None
 
     def _put_request(self, url=None, data=None):
         """Performs an HTTP PUT request."""
@@ -412,7 +544,7 @@ class AmpClient(object):
             print("Put URL: {}".format(url))
 
         # Perform the PUT request
-        response = requests.put(url, data, auth=HTTPBasicAuth(self.__amp_client_id, self.__amp_api_key))
+        response = self.__session.put(url, data, timeout=self.__timeout)
 
         # Check to see if the PUT was successful
         if response.status_code >= 200 and response.status_code < 300:
@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module serializes MongoDB documents to JSON in a single pass for Cisco Command Center
+
+ObjectIds and datetimes are written in the same extended JSON shape as bson.json_util ({"$oid": ...} and
+{"$date": <milliseconds>}), so the frontend sees no difference. If orjson is installed it does the encoding.
+"""
+
+import calendar
+import datetime
+import json
+
+from bson import json_util
+from bson.objectid import ObjectId
+from flask import current_app
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """Converts the BSON types found in events into JSON-friendly values."""
+
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+
+    if isinstance(obj, datetime.datetime):
+        # Naive datetimes from MongoDB are UTC, utctimetuple() also normalizes aware ones
+        return {"$date": calendar.timegm(obj.utctimetuple()) * 1000 + obj.microsecond // 1000}
+
+    # Anything rarer falls back to bson's own conversion, which raises TypeError for unknown types
+    return json_util.default(obj)
+
+
+def dumps(obj):
+    """Serializes an object containing BSON types to a JSON string."""
+
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+
+    return json.dumps(obj, default=default, separators=(",", ":"))
+
+
+def jsonify(obj, status=200):
+    """Builds a Flask JSON response from an object containing BSON types."""
+
+    return current_app.response_class(dumps(obj), status=status, mimetype=current_app.config["JSONIFY_MIMETYPE"])
+
+
+class BsonJSONEncoder(JSONEncoder):
+    """A Flask JSON encoder that understands ObjectIds and datetimes."""
+
+    def default(self, o):
+
+        try:
+            return default(o)
+        except TypeError:
+            return super().default(o)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module maintains the 5-minute event rollups in the 'event_counts' collection for Cisco Command Center
+
+Each rollup document counts the events for one (bucket, product, event_name, src_ip). The importers $inc them
+as they store events, and backfill() rebuilds them from the raw events. The bucketing itself lives in the shared
+event_store module that the importers use too.
+"""
+
+from pymongo import UpdateOne
+
+from event_store import BUCKET_MINUTES, bucket_start
+
+# The fields that identify a rollup document
+ROLLUP_KEY_FIELDS = ("bucket", "product", "event_name", "src_ip")
+
+# How many rollup upserts to send per bulk write during a backfill
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill(database, since=None):
+    """Rebuilds the rollups from the 'events' collection, optionally only from 'since' onwards."""
+
+    query_filter = {}
+
+    if since:
+        query_filter["timestamp"] = {"$gte": bucket_start(since)}
+
+    # Let MongoDB do the bucketing, this returns one document per rollup rather than per event
+    rollups = database["events"].aggregate([
+        {"$match": query_filter},
+        {"$group":
+            {"_id": {
+                "bucket": {"$toDate":
+                           {"$subtract": [
+                               {"$toLong": "$timestamp"},
+                               {"$mod": [{"$toLong": "$timestamp"}, 1000 * 60 * BUCKET_MINUTES]}
+                           ]}},
+                "product": "$product",
+                "event_name": "$event_name",
+                "src_ip": "$src_ip"},
+             "count": {"$sum": 1}}}
+    ], allowDiskUse=True)
+
+    event_counts = database["event_counts"]
+    operations = []
+    rollup_count = 0
+
+    for rollup in rollups:
+
+        # Missing fields are left out of the group key, store them as null like the importers do
+        rollup_key = {field: rollup["_id"].get(field) for field in ROLLUP_KEY_FIELDS}
+
+        # Set rather than increment, so running the backfill twice gives the same result
+        operations.append(UpdateOne(rollup_key, {"$set": {"count": rollup["count"]}}, upsert=True))
+        rollup_count += 1
+
+        if len(operations) >= BACKFILL_BATCH_SIZE:
+            event_counts.bulk_write(operations, ordered=False)
+            operations = []
+
+    if operations:
+        event_counts.bulk_write(operations, ordered=False)
+
+    return rollup_count
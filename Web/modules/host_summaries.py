@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module maintains the per-host summaries in the 'hosts' collection for Cisco Command Center
+
+Each summary is keyed on the host's IP and holds its first and last seen times, its event counts per product
+and per event name, and its most recent events. The importers update them as they store events with $min, $max,
+$inc and a sliced $push, and backfill() rebuilds them from the raw events. The field name escaping and the
+size of the latest events list live in the shared event_store module that the importers use too.
+
+The counts cover the events that are still retained, like the 'event_counts' rollups. expire() takes events
+that have aged out of the 'events' collection back out of the summaries, and drops hosts with none left.
+"""
+
+import collections
+
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING, DeleteOne, InsertOne, UpdateOne
+
+from event_store import EVENT_RETENTION_SECONDS, HOST_LATEST_EVENTS, latest_event, summary_key, summary_name
+
+# How many summaries to replace per bulk write during a backfill, or to update per bulk write during an expiry
+BACKFILL_BATCH_SIZE = 1000
+
+
+def to_response(summary):
+    """Converts a stored summary into the shape the API returns."""
+
+    return {
+        "src_ip": summary["_id"],
+        "first_seen": summary.get("first_seen"),
+        "last_seen": summary.get("last_seen"),
+        "event_count": summary.get("event_count", 0),
+        "product_counts": {summary_name(key): count for (key, count) in summary.get("product_counts", {}).items()},
+        "event_name_counts": {summary_name(key): count
+                              for (key, count) in summary.get("event_name_counts", {}).items()},
+        "latest_events": summary.get("latest_events", []),
+    }
+
+
+def backfill(database, index_models=()):
+    """Rebuilds every host summary from the 'events' collection, returning how many hosts it found.
+
+    The summaries are built in a separate collection with 'index_models' that then replaces 'hosts' in one step,
+    so the host list never shows a half-built set and hosts whose events have all expired drop out. Events stored
+    while it runs are not counted, so stop the importers first."""
+
+    # Walk the events host by host, newest first, which the 'src_ip_timestamp' index returns without a sort
+    events = database["events"].find({"src_ip": {"$nin": [None, ""]}},
+                                     {"src_ip": 1, "product": 1, "event_name": 1, "timestamp": 1},
+                                     sort=[("src_ip", ASCENDING), ("timestamp", DESCENDING)],
+                                     batch_size=BACKFILL_BATCH_SIZE)
+
+    rebuilt_hosts = database["hosts_backfill"]
+    rebuilt_hosts.drop()
+
+    operations = []
+    host_count = 0
+
+    summary = None
+
+    for event in events:
+
+        # The events come sorted by host, so a new IP means the previous host is complete
+        if summary is None or summary["_id"] != event["src_ip"]:
+
+            if summary is not None:
+                operations.append(_insert_summary(summary))
+                host_count += 1
+
+            # The first event seen for a host is its newest
+            summary = {"_id": event["src_ip"],
+                       "first_seen": event.get("timestamp"),
+                       "last_seen": event.get("timestamp"),
+                       "event_count": 0,
+                       "product_counts": collections.Counter(),
+                       "event_name_counts": collections.Counter(),
+                       "latest_events": []}
+
+        summary["first_seen"] = event.get("timestamp")
+        summary["event_count"] += 1
+        summary["product_counts"][summary_key(event.get("product"))] += 1
+        summary["event_name_counts"][summary_key(event.get("event_name"))] += 1
+
+        if len(summary["latest_events"]) < HOST_LATEST_EVENTS:
+            summary["latest_events"].append(latest_event(event))
+
+        if len(operations) >= BACKFILL_BATCH_SIZE:
+            rebuilt_hosts.bulk_write(operations, ordered=False)
+            operations = []
+
+    if summary is not None:
+        operations.append(_insert_summary(summary))
+        host_count += 1
+
+    if operations:
+        rebuilt_hosts.bulk_write(operations, ordered=False)
+
+    # The host list sorts on these, so the rebuilt collection needs them before it takes over
+    if index_models:
+        rebuilt_hosts.create_indexes(list(index_models))
+
+    if host_count:
+        rebuilt_hosts.rename("hosts", dropTarget=True)
+    else:
+        database["hosts"].delete_many({})
+
+    return host_count
+
+
+def _insert_summary(summary):
+    """Builds the insert for one host's summary."""
+
+    summary["product_counts"] = dict(summary["product_counts"])
+    summary["event_name_counts"] = dict(summary["event_name_counts"])
+
+    return InsertOne(summary)
+
+
+def expire(database, now=None):
+    """Takes events older than the retention period out of the host summaries, returning how many hosts changed.
+
+    Only hosts first seen before the cutoff can hold expired events, the 'first_seen_id' index finds them and
+    each one's counts are rebuilt from its retained events. An importer adding an event to a host while it's
+    rebuilt can be counted twice, until that host's events next age out."""
+
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=EVENT_RETENTION_SECONDS)
+
+    hosts = database["hosts"]
+    operations = []
+    host_count = 0
+
+    for summary in hosts.find({"first_seen": {"$lt": cutoff}}, {"_id": 1}):
+
+        # Count the host's retained events per product and event name, the 'src_ip_timestamp' index serves this
+        groups = list(database["events"].aggregate([
+            {"$match": {"src_ip": summary["_id"], "timestamp": {"$gte": cutoff}}},
+            {"$group": {"_id": {"product": "$product", "event_name": "$event_name"},
+                        "count": {"$sum": 1},
+                        "first_seen": {"$min": "$timestamp"}}}
+        ]))
+
+        # Only expired events left, so the host goes too
+        if not groups:
+            operations.append(DeleteOne({"_id": summary["_id"], "first_seen": {"$lt": cutoff}}))
+        else:
+            product_counts = collections.Counter()
+            event_name_counts = collections.Counter()
+
+            for group in groups:
+                product_counts[summary_key(group["_id"].get("product"))] += group["count"]
+                event_name_counts[summary_key(group["_id"].get("event_name"))] += group["count"]
+
+            # The latest events are the host's newest, so pulling the expired ones leaves its newest retained ones
+            operations.append(UpdateOne(
+                {"_id": summary["_id"]},
+                {"$set": {"first_seen": min(group["first_seen"] for group in groups),
+                          "event_count": sum(group["count"] for group in groups),
+                          "product_counts": dict(product_counts),
+                          "event_name_counts": dict(event_name_counts)},
+                 "$pull": {"latest_events": {"timestamp": {"$lt": cutoff}}}}))
+
+        host_count += 1
+
+        if len(operations) >= BACKFILL_BATCH_SIZE:
+            hosts.bulk_write(operations, ordered=False)
+            operations = []
+
+    if operations:
+        hosts.bulk_write(operations, ordered=False)
+
+    return host_count
@@ -0,0 +1,341 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module keeps a live index of ISE sessions for Cisco Command Center
+
+A SessionSubscriber follows the pxGrid session topic over WebSocket/STOMP, loads the active sessions once it is
+subscribed, and applies every update to a SessionIndex that answers IP and MAC lookups from memory. Given a
+MongoDB collection, the index also writes each session through to it so other components can read them.
+"""
+
+import base64
+import datetime
+import json
+import ssl
+import threading
+
+import websocket
+
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import PyMongoError
+
+SESSION_SERVICE = "com.cisco.ise.session"
+
+# The session states that mean the endpoint has gone away
+ENDED_STATES = ("DISCONNECTED",)
+
+
+def stomp_frame(command, headers=None, body=""):
+    """Builds a STOMP frame."""
+
+    lines = [command]
+
+    for (name, value) in (headers or {}).items():
+        lines.append("{}:{}".format(name, value))
+
+    return ("\n".join(lines) + "\n\n" + body + "\0").encode()
+
+
+def parse_stomp_frame(data):
+    """Splits a STOMP frame into its command, headers and body."""
+
+    if isinstance(data, bytes):
+        data = data.decode()
+
+    (head, _, body) = data.partition("\n\n")
+    (command, *header_lines) = head.lstrip("\n").split("\n")
+
+    headers = {}
+
+    for header_line in header_lines:
+        (name, _, value) = header_line.partition(":")
+        headers.setdefault(name, value)
+
+    return (command, headers, body.rstrip("\0\n"))
+
+
+def _sync_time():
+    """Returns the current time at the millisecond precision MongoDB stores."""
+
+    now = datetime.datetime.utcnow()
+
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def session_key(session):
+    """Returns the key a session is indexed under, its MAC address or else its first IP."""
+
+    if session.get("macAddress"):
+        return session["macAddress"].upper()
+
+    if session.get("ipAddresses"):
+        return session["ipAddresses"][0]
+
+    return None
+
+
+class SessionIndex(object):
+    """An in-memory IP and MAC to session index, optionally written through to MongoDB."""
+
+    def __init__(self, collection=None):
+        """Initializes the SessionIndex object."""
+
+        self.collection = collection
+
+        # Set once the snapshot is loaded and the subscription is live, cleared when it drops
+        self.ready = False
+
+        self._sessions = {}
+        self._by_ip = {}
+        self._by_mac = {}
+        self._lock = threading.Lock()
+
+    def get_by_ip(self, ip_address):
+        """Returns the session for an IP address, or None."""
+
+        with self._lock:
+            key = self._by_ip.get(ip_address)
+            return self._sessions.get(key)
+
+    def get_by_mac(self, mac_address):
+        """Returns the session for a MAC address, or None."""
+
+        with self._lock:
+            key = self._by_mac.get(mac_address.upper())
+            return self._sessions.get(key)
+
+    def replace_all(self, sessions):
+        """Rebuilds the index from a snapshot of the active sessions."""
+
+        with self._lock:
+
+            self._sessions.clear()
+            self._by_ip.clear()
+            self._by_mac.clear()
+
+            for session in sessions:
+                self._set(session)
+
+        if self.collection is not None:
+
+            synced_at = _sync_time()
+            keys = [session_key(session) for session in sessions if session_key(session)]
+
+            self._write([ReplaceOne({"_id": session_key(session)}, self._document(session, synced_at), upsert=True)
+                         for session in sessions if session_key(session)])
+
+            # Anything missing from the snapshot has ended while we weren't listening. Every worker writes through
+            # to the same collection, so only prune by key, a session another worker stored since our snapshot
+            # also reaches us on the topic and is written back when we apply it.
+            try:
+                self.collection.delete_many({"_id": {"$nin": keys}, "synced_at": {"$lt": synced_at}})
+            except PyMongoError as error:
+                print("Unable to prune the stored ISE sessions: {}".format(error))
+
+    def apply(self, sessions):
+        """Applies session updates from the topic."""
+
+        operations = []
+        synced_at = _sync_time()
+
+        with self._lock:
+
+            for session in sessions:
+
+                key = session_key(session)
+
+                if key is None:
+                    continue
+
+                self._remove(key)
+
+                if session.get("state") in ENDED_STATES:
+                    operations.append(DeleteOne({"_id": key}))
+                else:
+                    self._set(session)
+                    operations.append(ReplaceOne({"_id": key}, self._document(session, synced_at), upsert=True))
+
+        if self.collection is not None:
+            self._write(operations)
+
+    def stats(self):
+        """Returns the size of the index."""
+
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "sessions": len(self._sessions),
+                "ip_addresses": len(self._by_ip),
+                "mac_addresses": len(self._by_mac),
+            }
+
+    def _set(self, session):
+        """Indexes a session, the lock must be held."""
+
+        key = session_key(session)
+
+        if key is None:
+            return
+
+        self._sessions[key] = session
+
+        for ip_address in session.get("ipAddresses") or []:
+            self._by_ip[ip_address] = key
+
+        if session.get("macAddress"):
+            self._by_mac[session["macAddress"].upper()] = key
+
+    def _remove(self, key):
+        """Drops a session and any lookups that still point at it, the lock must be held."""
+
+        session = self._sessions.pop(key, None)
+
+        if session is None:
+            return
+
+        for ip_address in session.get("ipAddresses") or []:
+            if self._by_ip.get(ip_address) == key:
+                del self._by_ip[ip_address]
+
+        if session.get("macAddress") and self._by_mac.get(session["macAddress"].upper()) == key:
+            del self._by_mac[session["macAddress"].upper()]
+
+    def _document(self, session, synced_at):
+        """Builds the stored form of a session."""
+
+        return {
+            "ip_addresses": session.get("ipAddresses") or [],
+            "mac_address": session["macAddress"].upper() if session.get("macAddress") else None,
+            "session": session,
+            "synced_at": synced_at,
+        }
+
+    def _write(self, operations):
+        """Writes session changes to MongoDB, the in-memory index stays authoritative if this fails."""
+
+        if not operations:
+            return
+
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except PyMongoError as error:
+            print("Unable to store ISE sessions: {}".format(error))
+
+
+class SessionSubscriber(threading.Thread):
+    """A background thread that keeps a SessionIndex in step with the pxGrid session topic."""
+
+    def __init__(self, pxgrid, index, reconnect_interval=5, ping_interval=30, ping_timeout=10):
+        """Initializes the SessionSubscriber object."""
+
+        super().__init__(name="ise-session-subscriber", daemon=True)
+
+        self.pxgrid = pxgrid
+        self.index = index
+        self.reconnect_interval = reconnect_interval
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self._websocket = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        """Subscribes, and resubscribes after a pause whenever the connection drops."""
+
+        while not self._stopping.is_set():
+
+            try:
+                self._subscribe()
+            except Exception as error:
+                print("ISE session subscription failed: {}".format(error))
+
+            self.index.ready = False
+
+            # The node, secret or account may have changed, so start the next attempt from scratch
+            self.pxgrid.invalidate()
+
+            self._stopping.wait(self.reconnect_interval)
+
+    def stop(self):
+        """Closes the subscription and stops reconnecting."""
+
+        self._stopping.set()
+
+        if self._websocket is not None:
+            self._websocket.close()
+
+    def _subscribe(self):
+        """Runs one WebSocket connection until it closes."""
+
+        if not self.pxgrid.is_account_enabled():
+            print("pxGrid Account is not enabled.")
+            return
+
+        # The session service names the topic and the pubsub service that carries it
+        session_service = self.pxgrid.get_service(SESSION_SERVICE)
+        topic = session_service["properties"]["sessionTopic"]
+
+        pubsub_service = self.pxgrid.get_service(session_service["properties"]["wsPubsubService"])
+        node_name = pubsub_service["nodeName"]
+
+        # The pubsub node only accepts us with a secret it has issued for this client
+        secret = self.pxgrid.get_cached_access_secret(node_name)
+        credentials = base64.b64encode("{}:{}".format(self.pxgrid.client_name, secret).encode()).decode()
+
+        def on_open(ws):
+            ws.send(stomp_frame("CONNECT", {"accept-version": "1.2", "host": node_name}),
+                    opcode=websocket.ABNF.OPCODE_BINARY)
+
+        def on_message(ws, message):
+            (command, headers, body) = parse_stomp_frame(message)
+
+            if command == "CONNECTED":
+
+                ws.send(stomp_frame("SUBSCRIBE", {"destination": topic, "id": "command-center"}),
+                        opcode=websocket.ABNF.OPCODE_BINARY)
+
+                # Take the snapshot after subscribing, so no update can fall between the two. websocket-client
+                # only logs an exception raised in here and keeps the connection, which would leave the index
+                # subscribed but never ready, so close it instead and let run() start over
+                try:
+                    snapshot = self.pxgrid.send_service_request(SESSION_SERVICE, "/getSessions", {}) or {}
+                    self.index.replace_all(snapshot.get("sessions", []))
+                except Exception as error:
+                    print("Unable to load the ISE session snapshot, reconnecting: {}".format(error))
+                    ws.close()
+                    return
+
+                self.index.ready = True
+
+                print("ISE session index loaded with {} sessions".format(self.index.stats()["sessions"]))
+
+            elif command == "MESSAGE":
+                self.index.apply(json.loads(body).get("sessions", []))
+
+            elif command == "ERROR":
+                print("pxGrid returned a STOMP error: {} {}".format(headers.get("message"), body))
+                ws.close()
+
+        def on_error(ws, error):
+            print("ISE session WebSocket error: {}".format(error))
+
+        def on_close(ws, *args):
+            self.index.ready = False
+
+        self._websocket = websocket.WebSocketApp(pubsub_service["properties"]["wsUrl"],
+                                                 header=["Authorization: Basic {}".format(credentials)],
+                                                 on_open=on_open,
+                                                 on_message=on_message,
+                                                 on_error=on_error,
+                                                 on_close=on_close)
+
+        # Present the pxGrid client certificate, the ISE node's certificate isn't verified as with REST
+        sslopt = {"cert_reqs": ssl.CERT_NONE, "check_hostname": False}
+
+        if self.pxgrid.client_cert is not None:
+            sslopt["certfile"] = self.pxgrid.client_cert
+            sslopt["keyfile"] = self.pxgrid.client_key
+
+        # Without a ping timeout a dead connection, or a close from stop(), is never noticed
+        self._websocket.run_forever(sslopt=sslopt, ping_interval=self.ping_interval, ping_timeout=self.ping_timeout)
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module manages the indexes on the Cisco Command Center collections
+
+The managed indexes are versioned. Bump INDEX_VERSION whenever MANAGED_INDEXES changes and the next
+startup will build the new set and drop managed indexes that are no longer listed.
+"""
+
+import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
+
+from event_store import EVENT_RETENTION_SECONDS
+
+INDEX_VERSION = 5
+
+# The importers create 'product_timestamp' themselves with this exact definition, keep them in step
+EVENTS_INDEXES = [
+    IndexModel([("product", ASCENDING), ("timestamp", DESCENDING)], name="product_timestamp"),
+    IndexModel([("src_ip", ASCENDING), ("timestamp", DESCENDING)], name="src_ip_timestamp"),
+    IndexModel([("event_name", ASCENDING), ("timestamp", DESCENDING)], name="event_name_timestamp"),
+    IndexModel([("timestamp", DESCENDING), ("_id", DESCENDING)], name="timestamp_id"),
+]
+
+# The importers upsert rollups on this exact key, and buckets expire with the events they count
+EVENT_COUNTS_INDEXES = [
+    IndexModel([("bucket", ASCENDING), ("product", ASCENDING), ("event_name", ASCENDING), ("src_ip", ASCENDING)],
+               name="bucket_product_event_name_src_ip", unique=True),
+    IndexModel([("bucket", ASCENDING)], name="bucket_ttl", expireAfterSeconds=EVENT_RETENTION_SECONDS),
+]
+
+# The shared AMP response cache, entries are swept once they expire
+AMP_CACHE_INDEXES = [
+    IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    IndexModel([("namespace", ASCENDING)], name="namespace"),
+]
+
+# The ISE sessions written through by the session subscriber
+ISE_SESSIONS_INDEXES = [
+    IndexModel([("ip_addresses", ASCENDING)], name="ip_addresses"),
+    IndexModel([("mac_address", ASCENDING)], name="mac_address"),
+    IndexModel([("synced_at", ASCENDING)], name="synced_at"),
+]
+
+# The per-host summaries the importers maintain, one index per sort the host list offers
+HOSTS_INDEXES = [
+    IndexModel([("last_seen", DESCENDING), ("_id", DESCENDING)], name="last_seen_id"),
+    IndexModel([("first_seen", DESCENDING), ("_id", DESCENDING)], name="first_seen_id"),
+    IndexModel([("event_count", DESCENDING), ("_id", DESCENDING)], name="event_count_id"),
+]
+
+MANAGED_INDEXES = {
+    "events": EVENTS_INDEXES,
+    "event_counts": EVENT_COUNTS_INDEXES,
+    "amp_cache": AMP_CACHE_INDEXES,
+    "ise_sessions": ISE_SESSIONS_INDEXES,
+    "hosts": HOSTS_INDEXES,
+}
+
+# The collection that records which index version has been applied
+SCHEMA_COLLECTION = "schema_versions"
+
+
+def ensure_indexes(database):
+    """Builds the managed indexes for any collection whose recorded version is behind.
+
+    Each collection is applied on its own, so one that fails doesn't hold back the rest. A failure is recorded
+    on the collection's 'schema_versions' document, which keeps its old version so the next start retries it.
+    Returns the errors by collection name."""
+
+    schema_versions = database[SCHEMA_COLLECTION]
+    errors = {}
+
+    for (collection_name, index_models) in MANAGED_INDEXES.items():
+
+        try:
+            _apply_indexes(database, collection_name, index_models)
+        except ConnectionFailure as error:
+            # Nothing else will get through to an unreachable server either, so don't wait out each collection
+            print("Unable to reach MongoDB to apply index version {}: {}".format(INDEX_VERSION, error))
+            errors[collection_name] = str(error)
+            break
+        except PyMongoError as error:
+            print("Unable to apply {} index version {}: {}".format(collection_name, INDEX_VERSION, error))
+            errors[collection_name] = str(error)
+
+            try:
+                schema_versions.update_one({"_id": "{}_indexes".format(collection_name)},
+                                           {"$set": {"error": str(error),
+                                                     "failed_version": INDEX_VERSION,
+                                                     "failed_at": datetime.datetime.utcnow()}},
+                                           upsert=True)
+            except PyMongoError:
+                pass
+
+    return errors
+
+
+def _apply_indexes(database, collection_name, index_models):
+    """Builds one collection's managed indexes and records the version, unless it's already applied."""
+
+    schema_versions = database[SCHEMA_COLLECTION]
+
+    applied = schema_versions.find_one({"_id": "{}_indexes".format(collection_name)}) or {}
+
+    # Nothing to do if another worker or an earlier start already applied this version
+    if applied.get("version", 0) >= INDEX_VERSION:
+        return
+
+    collection = database[collection_name]
+
+    # Build the current set, create_indexes is a no-op for indexes that already exist
+    index_names = collection.create_indexes(index_models)
+
+    # Drop indexes we managed before but no longer want
+    for index_name in applied.get("index_names", []):
+
+        if index_name not in index_names:
+            try:
+                collection.drop_index(index_name)
+            except OperationFailure:
+                pass
+
+    schema_versions.update_one({"_id": "{}_indexes".format(collection_name)},
+                               {"$set": {"version": INDEX_VERSION,
+                                         "index_names": index_names,
+                                         "updated_at": datetime.datetime.utcnow()},
+                                "$unset": {"error": "", "failed_version": "", "failed_at": ""}},
+                               upsert=True)
+
+    print("Applied {} index version {}: {}".format(collection_name, INDEX_VERSION, ", ".join(index_names)))
+
+
+def index_report(database):
+    """Returns usage statistics for every index on the 'events' collection."""
+
+    events = database["events"]
+
+    applied = database[SCHEMA_COLLECTION].find_one({"_id": "events_indexes"}) or {}
+    managed_names = set(applied.get("index_names", []))
+
+    indexes = []
+    index_stats_error = None
+
+    # $indexStats needs the indexStats privilege and isn't available everywhere, so report why it's missing
+    try:
+        for index_stats in events.aggregate([{"$indexStats": {}}]):
+            indexes.append({
+                "name": index_stats["name"],
+                "key": index_stats["key"],
+                "managed": index_stats["name"] in managed_names,
+                "ops": index_stats["accesses"]["ops"],
+                "since": index_stats["accesses"]["since"],
+                "host": index_stats.get("host"),
+            })
+    except PyMongoError as error:
+        indexes = []
+        index_stats_error = str(error)
+
+    # Least used first, so the indexes worth questioning are at the top
+    indexes.sort(key=lambda index: index["ops"])
+
+    report = {
+        "index_version": applied.get("version", 0),
+        "expected_index_version": INDEX_VERSION,
+        "indexes": indexes,
+        "index_stats_error": index_stats_error,
+        "index_errors": {},
+        "collection_scans": None,
+    }
+
+    # Collections whose managed indexes failed to build on the last start, and why
+    try:
+        for schema_version in database[SCHEMA_COLLECTION].find({"error": {"$exists": True}}):
+            report["index_errors"][schema_version["_id"][:-len("_indexes")]] = {
+                "error": schema_version["error"],
+                "version": schema_version.get("version", 0),
+                "failed_version": schema_version.get("failed_version"),
+                "failed_at": schema_version.get("failed_at"),
+            }
+    except PyMongoError:
+        pass
+
+    # Queries that found no usable index show up as collection scans in the server metrics
+    try:
+        query_executor = database.client.admin.command("serverStatus")["metrics"]["queryExecutor"]
+        report["collection_scans"] = query_executor.get("collectionScans")
+        report["documents_scanned"] = query_executor.get("scannedObjects")
+        report["keys_scanned"] = query_executor.get("scanned")
+    except (PyMongoError, KeyError):
+        pass
+
+    return report
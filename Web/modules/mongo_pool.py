@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module manages the shared MongoDB client for Cisco Command Center
+"""
+
+import os
+import threading
+import time
+
+import pymongo
+
+from pymongo.errors import PyMongoError
+
+# The process-wide client and the PID that created it
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the MongoDB client for this process, creating it on first use."""
+
+    global _client, _client_pid
+
+    # Gunicorn forks its workers, and a client inherited from the parent isn't fork-safe, so each PID builds its own
+    if _client is None or _client_pid != os.getpid():
+
+        with _client_lock:
+
+            if _client is None or _client_pid != os.getpid():
+
+                _client = pymongo.MongoClient("mongodb://{}/".format(os.getenv("MONGO_INITDB_ADDRESS")),
+                                              username=os.getenv("MONGO_INITDB_ROOT_USERNAME"),
+                                              password=os.getenv("MONGO_INITDB_ROOT_PASSWORD"),
+                                              maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "20")),
+                                              minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+                                              maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+                                              connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+                                              socketTimeoutMS=int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000")),
+                                              serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS",
+                                                                                     "5000")),
+                                              connect=False)
+                _client_pid = os.getpid()
+
+    return _client
+
+
+def get_database():
+    """Returns the 'commandcenter' database from the shared client."""
+
+    return get_client()[os.getenv("MONGO_INITDB_DATABASE", "commandcenter")]
+
+
+def get_collection(name="events"):
+    """Returns a collection from the 'commandcenter' database."""
+
+    return get_database()[name]
+
+
+def health_check():
+    """Pings MongoDB through the shared client and reports the round-trip time."""
+
+    start_time = time.perf_counter()
+
+    try:
+        get_client().admin.command("ping")
+    except PyMongoError as error:
+        return {"status": "failure", "error": str(error)}
+
+    return {"status": "success", "latency_ms": round((time.perf_counter() - start_time) * 1000, 3)}
+
+
+def close_client():
+    """Closes the shared client so that the next call to get_client() reconnects."""
+
+    global _client, _client_pid
+
+    with _client_lock:
+
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+
+        _client = None
+        _client_pid = None
@@ -3,45 +3,76 @@
 
 """
 This module is used to communicate with pxGrid for Cisco Command Center
+
+A PxgridControl keeps one SSL context and a keep-alive connection per thread to each pxGrid node, and remembers
+the account activation, service lookups and access secrets until they expire or ISE rejects them.
 """
 
 import base64
+import http.client
+import io
 import json
+import select
+import socket
 import ssl
+import threading
 import time
-import urllib.request
+import urllib.error
+import urllib.parse
+
+
+class RequestNotSentError(ConnectionError):
+    """The request never reached the pxGrid node, so it is safe to send again"""
 
 
 class PxgridControl:
-    def __init__(self, address, client_name, client_cert, client_key):
+    def __init__(self, address, client_name, client_cert, client_key, cache_ttl=300, timeout=30, debug=True):
         self.address = address
         self.client_name = client_name
         self.client_cert = client_cert
         self.client_key = client_key
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.debug = debug
+
+        # Built once, loading the certificate chain is the expensive part of a handshake
+        self._ssl_context = None
+
+        # Connections aren't safe to share between threads, so each thread keeps its own
+        self._local = threading.local()
 
-    def send_rest_request(self, api_url, payload):
+        # Control-plane answers, keyed by what was asked, with the time they expire
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def send_rest_request(self, api_url, payload, timeout=None):
 
         # Make the payload into JSON
         json_string = json.dumps(payload)
 
-        print("API URL: " + api_url)
-        print("Payload: " + json_string)
+        if self.debug:
+            print("API URL: " + api_url)
+            print("Payload: " + json_string)
+
+        b64 = base64.b64encode((self.client_name + ':').encode()).decode()
 
-        # Build the SSL Context
-        handler = urllib.request.HTTPSHandler(context=self.get_ssl_context())
-        opener = urllib.request.build_opener(handler)
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': 'Basic ' + b64,
+        }
 
-        rest_request = urllib.request.Request(url=api_url, data=str.encode(json_string))
-        rest_request.add_header('Content-Type', 'application/json')
-        rest_request.add_header('Accept', 'application/json')
+        (status, reason, response_headers, body) = self._post(api_url, str.encode(json_string), headers, timeout)
 
-        b64 = base64.b64encode((self.client_name + ':').encode()).decode()
-        rest_request.add_header('Authorization', 'Basic ' + b64)
-        rest_response = opener.open(rest_request)
-        response = rest_response.read().decode()
+        # Fail the same way urllib did, so callers can still catch HTTPError
+        if status >= 400:
+            raise urllib.error.HTTPError(api_url, status, reason, response_headers, io.BytesIO(body))
 
-        if response is not '':
-            print("Response:" + json.dumps(json.loads(response), indent=4))
+        response = body.decode()
+
+        if response:
+            if self.debug:
+                print("Response:" + json.dumps(json.loads(response), indent=4))
             return json.loads(response)
         else:
             return None
@@ -62,14 +93,187 @@ class PxgridControl:
         api_url = 'https://{}:8910/pxgrid/{}'.format(self.address, 'control/AccessSecret')
         return self.send_rest_request(api_url, payload)
 
+    def is_account_enabled(self):
+        """Returns True if the pxGrid account is enabled, activating it at most once per TTL."""
+
+        account_state = self._get_cached(('activation',))
+
+        if account_state is None:
+
+            account_state = self.account_activate()['accountState']
+
+            # A pending account may be approved at any moment, so only remember the enabled state
+            if account_state == 'ENABLED':
+                self._set_cached(('activation',), account_state)
+
+        return account_state == 'ENABLED'
+
+    def get_service(self, service_name):
+        """Returns the first node offering a pxGrid service, looking it up at most once per TTL."""
+
+        service = self._get_cached(('service', service_name))
+
+        if service is None:
+
+            service = self.service_lookup(service_name)['services'][0]
+            self._set_cached(('service', service_name), service)
+
+        return service
+
+    def get_cached_access_secret(self, peer_node_name):
+        """Returns the access secret for a peer node, requesting it at most once per TTL."""
+
+        secret = self._get_cached(('secret', peer_node_name))
+
+        if secret is None:
+
+            secret = self.get_access_secret(peer_node_name)['secret']
+            self._set_cached(('secret', peer_node_name), secret)
+
+        return secret
+
+    def send_service_request(self, service_name, operation, payload, timeout=None):
+        """Sends a request to a pxGrid service, refreshing the control-plane state once if it has gone stale.
+
+        'timeout' overrides the client's timeout for the service request itself."""
+
+        try:
+            return self.send_rest_request(self.get_service(service_name)['properties']['restBaseUrl'] + operation,
+                                          payload, timeout)
+
+        except urllib.error.HTTPError as error:
+
+            # Anything other than an auth failure isn't down to stale state
+            if error.code not in (401, 403):
+                raise
+
+            print("pxGrid rejected the request with HTTP {}, refreshing the control-plane state".format(error.code))
+            stale_error = error
+
+        except (RequestNotSentError, socket.gaierror) as error:
+
+            # The node we looked up may have gone away, but only retry when it never saw the request, since
+            # ANC changes aren't idempotent and a timed out request may still have been carried out
+            print("Unable to reach the pxGrid {} service: {}, looking it up again".format(service_name, error))
+            stale_error = error
+
+        self.invalidate()
+
+        # If the account has been disabled there is nothing to retry
+        if not self.is_account_enabled():
+            raise stale_error
+
+        return self.send_rest_request(self.get_service(service_name)['properties']['restBaseUrl'] + operation,
+                                      payload, timeout)
+
+    def invalidate(self):
+        """Forgets the cached activation, service lookups and access secrets."""
+
+        with self._cache_lock:
+            self._cache.clear()
+
     def get_ssl_context(self):
 
-        # Create an SSL context for client auth
-        context = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+        # Reuse the context once it has been built
+        if self._ssl_context is not None:
+            return self._ssl_context
+
+        # Create a client SSL context, the ISE node's certificate isn't verified as before
+        # (Purpose.CLIENT_AUTH gave the same result on older Pythons but builds a server-side context since 3.10)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
 
         # Load the client certificate
         if self.client_cert is not None:
             context.load_cert_chain(certfile=self.client_cert,
                                     keyfile=self.client_key)
 
+        self._ssl_context = context
+
         return context
+
+    def _get_cached(self, key):
+        """Returns a cached control-plane answer, or None if it is missing or expired."""
+
+        with self._cache_lock:
+
+            entry = self._cache.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+
+            return entry[1]
+
+    def _set_cached(self, key, value):
+        """Remembers a control-plane answer for the TTL."""
+
+        with self._cache_lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, value)
+
+    def _post(self, api_url, data, headers, timeout=None):
+        """POSTs over this thread's keep-alive connection to the node, reconnecting once if it couldn't be sent."""
+
+        url = urllib.parse.urlsplit(api_url)
+
+        node = (url.hostname, url.port or 443)
+        path = url.path + ('?' + url.query if url.query else '')
+
+        connections = self._local.__dict__.setdefault('connections', {})
+
+        for attempt in range(2):
+
+            connection = connections.get(node)
+
+            # The node closes idle connections, so don't send on one it has already hung up
+            if connection is not None and _connection_dropped(connection):
+                connection.close()
+                connection = None
+
+            if connection is None:
+                connection = http.client.HTTPSConnection(node[0], node[1], context=self.get_ssl_context(),
+                                                         timeout=self.timeout)
+                connections[node] = connection
+
+            # Connections are kept between requests, so set this request's timeout on the socket each time
+            connection.timeout = timeout or self.timeout
+
+            if connection.sock is not None:
+                connection.sock.settimeout(connection.timeout)
+
+            try:
+                connection.request('POST', path, body=data, headers=headers)
+
+            except (http.client.HTTPException, ConnectionError, socket.gaierror) as error:
+
+                # Nothing reached the node, so sending again can't repeat the request
+                connection.close()
+                del connections[node]
+
+                if attempt == 1:
+                    raise RequestNotSentError("Unable to send to {}:{}: {}".format(node[0], node[1], error)) from error
+
+                continue
+
+            # Once the request is sent it may have been carried out, so a failure from here on is never retried
+            try:
+                response = connection.getresponse()
+
+                return (response.status, response.reason, response.headers, response.read())
+
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                del connections[node]
+                raise
+
+
+def _connection_dropped(connection):
+    """Returns True if an idle connection's socket has been closed by the other end."""
+
+    if connection.sock is None:
+        return False
+
+    # An idle keep-alive socket has nothing to read unless the node has closed it
+    (readable, _, _) = select.select([connection.sock], [], [], 0)
+
+    return bool(readable)
@@ -0,0 +1,188 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module caches upstream API responses for Cisco Command Center
+
+Entries are grouped by namespace (one per cached endpoint) and expire after that namespace's TTL. By default the
+cache lives in the worker's memory and evicts the least recently used entry once it is full. Given a MongoDB
+collection instead, every gunicorn worker reads and writes the same entries, and invalidations reach them all.
+Shared entries are swept by the collection's TTL index once they expire, and trimmed to max_entries, soonest to
+expire first.
+"""
+
+import collections
+import datetime
+import threading
+import time
+
+from bson.errors import InvalidDocument
+from pymongo.errors import PyMongoError
+
+
+# How many shared writes may go by between checks of the shared collection's size
+SHARED_TRIM_INTERVAL = 32
+
+
+class ResponseCache(object):
+    """A TTL cache with LRU eviction, optionally shared through a MongoDB collection."""
+
+    def __init__(self, max_entries=256, shared_collection=None):
+        """Initializes the ResponseCache object."""
+
+        self.max_entries = max_entries
+        self.shared_collection = shared_collection
+
+        # (namespace, key) -> (expires_at, value), oldest use first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Per-namespace counters
+        self._stats = collections.defaultdict(collections.Counter)
+
+        # Shared writes since the shared collection's size was last checked, and entries trimmed from it
+        self._shared_writes = 0
+        self._shared_evictions = 0
+
+    def get(self, namespace, key):
+        """Returns a tuple of (found, value) for a cached response."""
+
+        if self.shared_collection is not None:
+            (found, value) = self._get_shared(namespace, key)
+        else:
+            (found, value) = self._get_local(namespace, key)
+
+        with self._lock:
+            self._stats[namespace]["hits" if found else "misses"] += 1
+
+        return (found, value)
+
+    def set(self, namespace, key, value, ttl):
+        """Caches a response for 'ttl' seconds."""
+
+        if self.shared_collection is not None:
+            self._set_shared(namespace, key, value, ttl)
+            return
+
+        with self._lock:
+
+            self._entries[(namespace, key)] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end((namespace, key))
+
+            # Drop the least recently used entries once the cache is full
+            while len(self._entries) > self.max_entries:
+                ((evicted_namespace, _), _) = self._entries.popitem(last=False)
+                self._stats[evicted_namespace]["evictions"] += 1
+
+    def invalidate(self, namespace):
+        """Drops every cached response in a namespace."""
+
+        if self.shared_collection is not None:
+            try:
+                self.shared_collection.delete_many({"namespace": namespace})
+            except PyMongoError as error:
+                print("Unable to invalidate the shared {} cache: {}".format(namespace, error))
+
+        with self._lock:
+
+            for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == namespace]:
+                del self._entries[entry_key]
+
+            self._stats[namespace]["invalidations"] += 1
+
+    def stats(self):
+        """Returns the counters for each namespace, plus the size of the local cache."""
+
+        with self._lock:
+            return {
+                "shared": self.shared_collection is not None,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "shared_evictions": self._shared_evictions,
+                "namespaces": {namespace: dict(counters) for (namespace, counters) in self._stats.items()},
+            }
+
+    def _get_local(self, namespace, key):
+        """Looks up a response in this worker's memory."""
+
+        with self._lock:
+
+            entry = self._entries.get((namespace, key))
+
+            if entry is None:
+                return (False, None)
+
+            (expires_at, value) = entry
+
+            if expires_at <= time.monotonic():
+                del self._entries[(namespace, key)]
+                return (False, None)
+
+            # Mark the entry as the most recently used
+            self._entries.move_to_end((namespace, key))
+
+            return (True, value)
+
+    def _get_shared(self, namespace, key):
+        """Looks up a response in the shared collection."""
+
+        try:
+            # The TTL index only sweeps once a minute, so check the expiry here too
+            document = self.shared_collection.find_one({"_id": "{}:{}".format(namespace, key),
+                                                        "expires_at": {"$gt": datetime.datetime.utcnow()}})
+        except PyMongoError as error:
+            print("Unable to read the shared {} cache: {}".format(namespace, error))
+            return (False, None)
+
+        if document is None:
+            return (False, None)
+
+        return (True, document["value"])
+
+    def _set_shared(self, namespace, key, value, ttl):
+        """Stores a response in the shared collection."""
+
+        try:
+            self.shared_collection.replace_one({"_id": "{}:{}".format(namespace, key)},
+                                               {"namespace": namespace,
+                                                "value": value,
+                                                "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)},
+                                               upsert=True)
+        except (PyMongoError, InvalidDocument) as error:
+            # An oversized or unstorable response is simply not cached
+            print("Unable to write the shared {} cache: {}".format(namespace, error))
+            return
+
+        with self._lock:
+            self._shared_writes += 1
+            check_size = self._shared_writes >= SHARED_TRIM_INTERVAL
+
+            if check_size:
+                self._shared_writes = 0
+
+        if check_size:
+            self._trim_shared()
+
+    def _trim_shared(self):
+        """Drops the shared entries closest to expiry once there are more than max_entries."""
+
+        try:
+            # The estimate comes from the collection's metadata, so checking is cheap
+            surplus = self.shared_collection.estimated_document_count() - self.max_entries
+
+            if surplus <= 0:
+                return
+
+            # Served by the TTL index on expires_at
+            evicted_ids = [document["_id"] for document in self.shared_collection.find({}, {"_id": 1})
+                                                                                  .sort("expires_at", 1)
+                                                                                  .limit(surplus)]
+
+            result = self.shared_collection.delete_many({"_id": {"$in": evicted_ids}})
+
+        except PyMongoError as error:
+            print("Unable to trim the shared cache: {}".format(error))
+            return
+
+        with self._lock:
+            self._shared_evictions += result.deleted_count
@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module parses Stealthwatch SOAP responses as they stream in for Cisco Command Center
+
+The SMC can return up to 10,000 flows per request. Rather than holding the whole body as text and converting it
+to a dict tree, the parsers here feed each chunk to a pull parser and hand on each flow as soon as its element
+closes, as a compact record, then drop it from the tree so memory stays flat however many flows come back.
+"""
+
+import json
+
+from xml.etree import ElementTree
+
+
+def parse_fields(fields):
+    """Turns a 'total_bytes,client.ip_address' style list into {'total_bytes': None, 'client': {'ip_address'}}.
+
+    None means the whole value, so 'client' on its own keeps every client attribute."""
+
+    selected = {}
+
+    for field in (field.strip() for field in fields.split(",")):
+
+        if not field:
+            continue
+
+        (name, _, attribute) = field.partition(".")
+
+        if not attribute or selected.get(name, set()) is None:
+            selected[name] = None
+        else:
+            selected.setdefault(name, set()).add(attribute)
+
+    return selected
+
+
+def iter_flows(chunks, limit=None, fields=None):
+    """Yields a compact record per flow in a getFlows response, stopping after 'limit' flows."""
+
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    flow_list = None
+    count = 0
+
+    for chunk in chunks:
+
+        parser.feed(chunk)
+
+        for (event, element) in parser.read_events():
+
+            tag = _local_name(element.tag)
+
+            if event == "start":
+                if tag == "flow-list":
+                    flow_list = element
+                continue
+
+            if tag != "flow":
+                continue
+
+            yield _select(_compact(element), fields)
+
+            # Forget the flow once it's been handed on, so the tree never holds more than one
+            element.clear()
+            if flow_list is not None:
+                flow_list.remove(element)
+
+            count += 1
+
+            # Stop reading as soon as we have enough, the caller closes the connection
+            if limit is not None and count >= limit:
+                return
+
+    parser.close()
+
+
+def parse_body(chunks):
+    """Parses a smaller SOAP response, like a host snapshot, into the same shape xmltodict gave the Body."""
+
+    parser = ElementTree.XMLPullParser(events=("end",))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+        for (_, element) in parser.read_events():
+            if _local_name(element.tag) == "Body":
+                return _element_dict(element)
+
+    parser.close()
+
+    return None
+
+
+def json_array(records):
+    """Yields a JSON array one record at a time."""
+
+    yield "["
+
+    for (index, record) in enumerate(records):
+        yield ("," if index else "") + json.dumps(record, separators=(",", ":"))
+
+    yield "]"
+
+
+def _local_name(tag):
+    """Strips the namespace ElementTree puts in front of a tag."""
+
+    return tag.rpartition("}")[2]
+
+
+def _value(value):
+    """The SMC sends counters, ports and IDs as strings, so hand those on as numbers."""
+
+    return int(value) if value.isdigit() else value
+
+
+def _compact(element):
+    """Builds a compact record from an element's attributes and children, with names in snake_case."""
+
+    record = {name.replace("-", "_"): _value(value) for (name, value) in element.attrib.items()}
+
+    for child in element:
+
+        name = _local_name(child.tag).replace("-", "_")
+        value = _compact(child) if len(child) or child.attrib else (child.text or "").strip()
+
+        # Repeated children become a list
+        if name in record:
+            if not isinstance(record[name], list):
+                record[name] = [record[name]]
+            record[name].append(value)
+        else:
+            record[name] = value
+
+    return record
+
+
+def _select(record, fields):
+    """Keeps only the requested fields of a record."""
+
+    if not fields:
+        return record
+
+    selected = {}
+
+    for (name, attributes) in fields.items():
+
+        if name not in record:
+            continue
+
+        value = record[name]
+
+        if attributes is not None and isinstance(value, dict):
+            value = {attribute: value[attribute] for attribute in attributes if attribute in value}
+
+        selected[name] = value
+
+    return selected
+
+
+def _element_dict(element):
+    """Converts an element the way xmltodict does, with '@' attributes and '#text', for existing consumers."""
+
+    result = {"@" + name: value for (name, value) in element.attrib.items()}
+    text = (element.text or "").strip()
+
+    for child in element:
+
+        name = _local_name(child.tag)
+        value = _element_dict(child)
+
+        if name in result:
+            if not isinstance(result[name], list):
+                result[name] = [result[name]]
+            result[name].append(value)
+        else:
+            result[name] = value
+
+    if not result:
+        return text or None
+
+    if text:
+        result["#text"] = text
+
+    return result
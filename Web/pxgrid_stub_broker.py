@@ -0,0 +1,346 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This script runs a local stand-in for an ISE pxGrid node, for trying the session subscriber without ISE
+
+It answers the pxGrid control calls (AccountActivate, ServiceLookup, AccessSecret), the session and ANC REST
+services, and a WebSocket/STOMP pubsub endpoint that publishes synthetic session updates to subscribers. Any
+self-signed certificate will do, the Web app doesn't verify the node:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -keyout stub.key -out stub.pem -days 30 -subj /CN=localhost
+    python pxgrid_stub_broker.py --cert stub.pem --key stub.key --sessions 1000 --interval 0.5
+
+Then point the Web app at it with ISE_API_ADDRESS=localhost, ISE_PXGRID_CLIENT_NAME set and
+ISE_PXGRID_SUBSCRIBE=True.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import ssl
+import struct
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+SESSION_TOPIC = "/topic/com.cisco.ise.session"
+NODE_NAME = "stub-ise"
+ACCESS_SECRET = "stub-secret"
+
+
+def _synthetic_session(index):
+    """Build an active session shaped like the pxGrid session service's."""
+
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "state": "STARTED",
+        "userName": "user{}".format(index),
+        "callingStationId": "00:50:56:{:02X}:{:02X}:{:02X}".format(index >> 16 & 255, index >> 8 & 255, index & 255),
+        "macAddress": "00:50:56:{:02X}:{:02X}:{:02X}".format(index >> 16 & 255, index >> 8 & 255, index & 255),
+        "ipAddresses": ["10.{}.{}.{}".format(index >> 16 & 255, index >> 8 & 255, index & 255 or 1)],
+        "nasIpAddress": "192.168.1.1",
+        "endpointProfile": "Workstation",
+        "adNormalizedUser": "user{}".format(index),
+    }
+
+
+class StubBroker(object):
+    """The shared state behind the stub: sessions, ANC assignments and STOMP subscribers."""
+
+    def __init__(self, advertise, port, session_count):
+
+        self.base_url = "https://{}:{}/pxgrid".format(advertise, port)
+        self.ws_url = "wss://{}:{}/pxgrid/ise/pubsub".format(advertise, port)
+
+        self.sessions = {session["macAddress"]: session
+                         for session in (_synthetic_session(index) for index in range(1, session_count + 1))}
+        self.anc_assignments = {}
+
+        # (send_frame, subscription id) for each live subscription
+        self.subscribers = []
+        self.published = 0
+        self.lock = threading.Lock()
+
+        # How many of the next session snapshots to fail, for trying how a subscriber recovers
+        self.failing_snapshots = 0
+
+    def service_lookup(self, name):
+        """Return the services the real node would offer for a name."""
+
+        properties = {
+            "com.cisco.ise.session": {"restBaseUrl": self.base_url + "/ise/mnt/sd",
+                                      "sessionTopic": SESSION_TOPIC,
+                                      "wsPubsubService": "com.cisco.ise.pubsub"},
+            "com.cisco.ise.pubsub": {"wsUrl": self.ws_url},
+            "com.cisco.ise.config.anc": {"restBaseUrl": self.base_url + "/ise/config/anc"},
+        }
+
+        if name not in properties:
+            return {"services": []}
+
+        return {"services": [{"name": name, "nodeName": NODE_NAME, "properties": properties[name]}]}
+
+    def publish_changes(self, interval):
+        """Move random sessions between states and publish each change to every subscriber."""
+
+        while True:
+
+            time.sleep(interval)
+
+            with self.lock:
+
+                session = dict(random.choice(list(self.sessions.values())))
+
+            # Roughly a fifth of the updates end a session, the rest start it again on a new address
+            if session["state"] == "STARTED" and random.random() < 0.2:
+                session["state"] = "DISCONNECTED"
+            else:
+                session["state"] = "STARTED"
+                session["ipAddresses"] = ["10.200.{}.{}".format(random.randint(0, 255), random.randint(1, 254))]
+
+            self.publish(session)
+
+    def publish(self, session):
+        """Store a changed session and publish it to every subscriber."""
+
+        with self.lock:
+
+            session["timestamp"] = datetime.utcnow().isoformat() + "Z"
+            self.sessions[session["macAddress"]] = session
+
+            subscribers = list(self.subscribers)
+            self.published += 1
+            message_id = self.published
+
+        body = json.dumps({"sessions": [session]})
+
+        for (send_frame, subscription_id) in subscribers:
+            try:
+                send_frame("MESSAGE\ndestination:{}\nsubscription:{}\nmessage-id:{}\n"
+                           "content-type:application/json\n\n{}\0".format(SESSION_TOPIC, subscription_id,
+                                                                          message_id, body).encode())
+            except OSError:
+                with self.lock:
+                    if (send_frame, subscription_id) in self.subscribers:
+                        self.subscribers.remove((send_frame, subscription_id))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the REST calls and the pubsub WebSocket."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+
+        broker = self.server.broker
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+        operation = self.path.rsplit("/", 1)[-1]
+
+        with broker.lock:
+
+            if operation == "AccountActivate":
+                response = {"accountState": "ENABLED", "version": "2.0"}
+
+            elif operation == "ServiceLookup":
+                response = broker.service_lookup(request.get("name"))
+
+            elif operation == "AccessSecret":
+                response = {"secret": ACCESS_SECRET}
+
+            elif operation == "getSessions" and broker.failing_snapshots:
+                broker.failing_snapshots -= 1
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            elif operation == "getSessions":
+                response = {"sessions": [session for session in broker.sessions.values()
+                                         if session["state"] == "STARTED"]}
+
+            elif operation == "getSessionByIpAddress":
+                response = next((session for session in broker.sessions.values()
+                                 if session["state"] == "STARTED" and request.get("ipAddress") in session["ipAddresses"]),
+                                None)
+
+            elif operation == "getSessionByMacAddress":
+                session = broker.sessions.get(str(request.get("macAddress")).upper())
+                response = session if session and session["state"] == "STARTED" else None
+
+            elif operation == "getEndpointByMacAddress":
+                response = broker.anc_assignments.get(str(request.get("macAddress")).upper())
+
+            elif operation == "applyEndpointByMacAddress":
+                response = {"macAddress": request.get("macAddress"), "policyName": request.get("policyName"),
+                            "status": "SUCCESS"}
+                broker.anc_assignments[str(request.get("macAddress")).upper()] = response
+
+            elif operation == "clearEndpointByMacAddress":
+                broker.anc_assignments.pop(str(request.get("macAddress")).upper(), None)
+                response = {"macAddress": request.get("macAddress"), "status": "SUCCESS"}
+
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        # pxGrid answers a lookup that found nothing with no content
+        body = json.dumps(response).encode() if response is not None else b""
+
+        self.send_response(200 if body else 204)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path != "/pxgrid/ise/pubsub" or self.headers.get("Upgrade", "").lower() != "websocket":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        # The real node only lets clients in with the secret it handed out
+        expected = "Basic " + base64.b64encode("{}:{}".format(self._client_name(), ACCESS_SECRET).encode()).decode()
+
+        if self.headers.get("Authorization") != expected:
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()).digest())
+
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+
+        self._serve_websocket()
+        self.close_connection = True
+
+    def _client_name(self):
+        """The client name from the Authorization header."""
+
+        try:
+            credentials = base64.b64decode(self.headers.get("Authorization", "").split(" ", 1)[1]).decode()
+        except (IndexError, ValueError):
+            return ""
+
+        return credentials.split(":", 1)[0]
+
+    def _serve_websocket(self):
+        """Speak just enough WebSocket and STOMP for a pxGrid subscriber."""
+
+        broker = self.server.broker
+        send_lock = threading.Lock()
+        subscriptions = []
+
+        def send_frame(payload, opcode=0x2):
+
+            if len(payload) < 126:
+                header = struct.pack("!BB", 0x80 | opcode, len(payload))
+            elif len(payload) < 65536:
+                header = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+            else:
+                header = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+
+            with send_lock:
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+
+        try:
+            while True:
+
+                (first, second) = struct.unpack("!BB", self.rfile.read(2))
+                opcode = first & 0x0F
+                length = second & 0x7F
+
+                if length == 126:
+                    (length,) = struct.unpack("!H", self.rfile.read(2))
+                elif length == 127:
+                    (length,) = struct.unpack("!Q", self.rfile.read(8))
+
+                # Client frames are always masked
+                mask = self.rfile.read(4) if second & 0x80 else b"\0\0\0\0"
+                payload = bytes(byte ^ mask[index % 4] for (index, byte) in enumerate(self.rfile.read(length)))
+
+                if opcode == 0x8:
+                    send_frame(payload[:2], opcode=0x8)
+                    break
+
+                if opcode == 0x9:
+                    send_frame(payload, opcode=0xA)
+                    continue
+
+                if opcode not in (0x1, 0x2):
+                    continue
+
+                (command, _, rest) = payload.decode().lstrip("\n").partition("\n")
+                headers = dict(line.split(":", 1) for line in rest.split("\n\n", 1)[0].split("\n") if ":" in line)
+
+                if command == "CONNECT":
+                    send_frame("CONNECTED\nversion:1.2\nserver:pxgrid-stub\n\n\0".encode())
+
+                elif command == "SUBSCRIBE":
+                    with broker.lock:
+                        broker.subscribers.append((send_frame, headers.get("id")))
+                        subscriptions.append((send_frame, headers.get("id")))
+
+                elif command == "DISCONNECT":
+                    break
+
+        except (OSError, struct.error):
+            pass
+
+        finally:
+            with broker.lock:
+                for subscription in subscriptions:
+                    if subscription in broker.subscribers:
+                        broker.subscribers.remove(subscription)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8910)
+    parser.add_argument("--advertise", default="localhost", help="the host name given out in service lookups")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between published session updates")
+    parser.add_argument("--fail-snapshots", type=int, default=0, help="how many session snapshots to fail first")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    server.broker = StubBroker(args.advertise, args.port, args.sessions)
+    server.broker.failing_snapshots = args.fail_snapshots
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=args.cert, keyfile=args.key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    threading.Thread(target=server.broker.publish_changes, args=(args.interval,), daemon=True).start()
+
+    print("pxGrid stub listening on {}:{} with {} sessions".format(args.host, args.port, args.sessions))
+
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
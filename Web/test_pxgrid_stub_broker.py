@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the ISE session subscriber against the pxGrid stub broker
+
+The stub listens on 127.0.0.1:8910, the port the pxGrid client always uses, with a throwaway certificate made
+by openssl. Run from this directory:
+
+    PYTHONPATH=../Shared python -m unittest test_pxgrid_stub_broker
+"""
+
+import datetime
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from http.server import ThreadingHTTPServer
+
+import pxgrid_stub_broker
+
+from modules import ise_sessions
+from modules import pxgrid_controller
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+SESSION_COUNT = 50
+
+
+def wait_for(condition, timeout=10):
+    """Polls a condition until it's true or the timeout passes, returning whether it came true."""
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+
+    return condition()
+
+
+@unittest.skipUnless(shutil.which("openssl"), "openssl is needed to make the stub's certificate")
+class SessionSubscriberTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.certificate_directory = tempfile.mkdtemp()
+        certificate = os.path.join(cls.certificate_directory, "stub.pem")
+        key = os.path.join(cls.certificate_directory, "stub.key")
+
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out",
+                        certificate, "-days", "1", "-subj", "/CN=localhost"], check=True, capture_output=True)
+
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 8910), pxgrid_stub_broker.StubHandler)
+        cls.server.daemon_threads = True
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=certificate, keyfile=key)
+        cls.server.socket = context.wrap_socket(cls.server.socket, server_side=True)
+
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.certificate_directory)
+
+    def setUp(self):
+        # A fresh set of sessions for every test, the published changes come from the test rather than a timer
+        self.broker = pxgrid_stub_broker.StubBroker("127.0.0.1", 8910, SESSION_COUNT)
+        self.server.broker = self.broker
+
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.subscriber is not None:
+            self.subscriber.stop()
+            self.subscriber.join(5)
+
+    def subscribe(self, collection=None):
+        index = ise_sessions.SessionIndex(collection=collection)
+        pxgrid = pxgrid_controller.PxgridControl("127.0.0.1", "command-center-test", None, None, debug=False)
+
+        self.subscriber = ise_sessions.SessionSubscriber(pxgrid, index, reconnect_interval=0.2)
+        self.subscriber.start()
+
+        return index
+
+    def test_index_loads_the_snapshot_and_follows_the_topic(self):
+        index = self.subscribe()
+
+        self.assertTrue(wait_for(lambda: index.ready))
+        self.assertEqual(index.stats()["sessions"], SESSION_COUNT)
+        self.assertEqual(index.get_by_ip("10.0.0.7")["userName"], "user7")
+
+        # Wait for the subscription to be registered before publishing to it
+        self.assertTrue(wait_for(lambda: self.broker.subscribers))
+
+        session = dict(self.broker.sessions["00:50:56:00:00:07"], state="DISCONNECTED")
+        self.broker.publish(session)
+
+        self.assertTrue(wait_for(lambda: index.get_by_mac("00:50:56:00:00:07") is None))
+        self.assertIsNone(index.get_by_ip("10.0.0.7"))
+        self.assertEqual(index.stats()["sessions"], SESSION_COUNT - 1)
+
+    @unittest.skipUnless(mongomock, "mongomock is needed to check the stored sessions")
+    def test_snapshot_prunes_stored_sessions_that_ended(self):
+        collection = mongomock.MongoClient().db.ise_sessions
+
+        # A session stored before the subscriber last lost its connection, which ended meanwhile
+        collection.insert_one({"_id": "00:50:56:FF:FF:FF", "ip_addresses": ["10.255.255.255"],
+                               "mac_address": "00:50:56:FF:FF:FF", "session": {},
+                               "synced_at": datetime.datetime.utcnow() - datetime.timedelta(hours=1)})
+
+        index = self.subscribe(collection)
+
+        self.assertTrue(wait_for(lambda: index.ready))
+        self.assertIsNone(collection.find_one({"_id": "00:50:56:FF:FF:FF"}))
+        self.assertEqual(collection.count_documents({}), SESSION_COUNT)
+
+    def test_failed_snapshot_reconnects(self):
+        self.broker.failing_snapshots = 1
+
+        index = self.subscribe()
+
+        self.assertTrue(wait_for(lambda: index.ready))
+        self.assertEqual(self.broker.failing_snapshots, 0)
+        self.assertEqual(index.stats()["sessions"], SESSION_COUNT)
+
+
+if __name__ == "__main__":
+    unittest.main()